@@ -0,0 +1,45 @@
+import cmpy
+import random
+import time
+
+
+def _key(tripAB: cmpy.TripAB):
+    return (tripAB.origin_stop.id, tripAB.destination_stop.id, tripAB.origin_time,
+            tripAB.destination_time, tripAB.route.id, tripAB.trip.trip_id)
+
+
+if __name__ == "__main__":
+    # compares get_trips_routes_db (pickled routes, filtered in Python) with
+    # get_trips_sql (normalized tables, filtered by SQLite) on the full dataset
+    print("Building databases...", flush=True)
+    cmpy.find_or_build_route_db()
+    cmpy.find_or_build_timetable_db()
+    stops = cmpy.get_all_stops()
+
+    # the commuter pairs from the examples, plus random pairs of stop names
+    pairs = [('R Dom João V 51', 'Campo Grande'), ('Av 25 Abril 1 (B Sousas)', 'Campo Grande')]
+    random.seed(0)
+    names = sorted({stop.name for stop in stops})
+    pairs += [tuple(random.sample(names, 2)) for _ in range(20)]
+    day = "20230629"
+
+    total_db = 0.0
+    total_sql = 0.0
+    for origin_name, destination_name in pairs:
+        for a, b in [(origin_name, destination_name), (destination_name, origin_name)]:
+            origins = cmpy.get_stops_containing(a, stops)
+            destinations = cmpy.get_stops_containing(b, stops)
+
+            t0 = time.perf_counter()
+            trips_db = cmpy.get_trips_routes_db(origins, destinations, day)
+            t1 = time.perf_counter()
+            trips_sql = cmpy.get_trips_sql(origins, destinations, day)
+            t2 = time.perf_counter()
+            total_db += t1 - t0
+            total_sql += t2 - t1
+
+            if sorted(map(_key, trips_db)) != sorted(map(_key, trips_sql)):
+                print(f"MISMATCH {a} -> {b}: {len(trips_db)} vs {len(trips_sql)} trips")
+            print(f"{a} -> {b}: {len(trips_db)} trips, routes_db {1000*(t1-t0):.1f} ms, sql {1000*(t2-t1):.1f} ms")
+
+    print(f"Total: routes_db {total_db:.3f} s, sql {total_sql:.3f} s")
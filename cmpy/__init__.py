@@ -1,2 +1,12 @@
 from .api import *
 from .lib import *
+from .relational import *
+from .boards import *
+from .search import *
+from .spatial import *
+from .snapshot import *
+from .engine import *
+from .results import *
+from .executor import *
+from .daily import *
+from .journey import *
@@ -1,21 +1,80 @@
-from typing import Generator, Union
+from typing import Callable, Generator, Union
 import requests
 import urllib
 import os
 import pickle
 import datetime
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, InitVar
 import msgspec
+from . import cache
+from . import database
 import multiprocessing
 import itertools
 import sys
 import sqlite3
+import functools
+import hashlib
+import uuid
+from array import array
+import threading
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-json_decoder = msgspec.json.Decoder()
+
+# Schemas of the API responses. Decoding goes straight into these structs, and
+# the fields we don't use (_id, municipalities, *_operation times, ...) are
+# skipped by the decoder instead of being allocated.
+class RouteSummary(msgspec.Struct, gc=False):
+    route_id: str
+    route_short_name: str
+    route_long_name: str
+    route_color: str
+    route_text_color: str
+
+class ScheduleDetail(msgspec.Struct, gc=False):
+    stop_sequence: int  # sent as a string, converted by the (non strict) decoder
+    stop_id: str
+    stop_name: str
+    stop_lat: str
+    stop_lon: str
+    arrival_time: str
+    departure_time: str
+
+class TripDetail(msgspec.Struct):
+    trip_id: str
+    service_id: str
+    dates: list[str]
+    schedule: list[ScheduleDetail]
+
+class DirectionDetail(msgspec.Struct):
+    headsign: str
+    trips: list[TripDetail]
+
+class RouteDetail(msgspec.Struct):
+    directions: list[DirectionDetail]
+
+summary_decoder = msgspec.json.Decoder(list[RouteSummary])
+route_detail_decoder = msgspec.json.Decoder(list[RouteDetail], strict=False)
 
 DAYS_FOR_STATIC_DATA = ["2023-06-06", "2023-01-31"]
 routes_database_file = os.path.join("cache", "routes.db")
+# bump whenever the pickled objects or the tables change, so that old databases
+# are rebuilt instead of misread
+ROUTES_DB_VERSION = 5
+# connections to the route database (see database.Database), and the same once
+# it has been checked or built by find_or_build_route_db
+_routes_db = None
 db = None
+# base of the schedules API. Can be pointed to another server, e.g. a local
+# stub serving recorded responses, with the CMPY_API_BASE_URL variable
+API_BASE_URL = os.environ.get("CMPY_API_BASE_URL", "https://schedules.carrismetropolitana.pt/api")
+
+def _summary_url() -> str:
+    return f"{API_BASE_URL}/routes/summary"
+
+def _route_url(route_short_name: str) -> str:
+    return f"{API_BASE_URL}/routes/route_short_name/{route_short_name}"
 
 
 @dataclass
@@ -44,7 +103,7 @@ class Stop:
 @dataclass
 class StopTimes:
     stop: Stop
-    times: list[str]
+    times: list[int]  # seconds since the start of the service day
 
 @dataclass
 class RouteStops:
@@ -57,13 +116,61 @@ class Route:
     long_name: str
     color: str
     text_color: str
-    _has_stops_and_trips: bool = field(init=False, default=False)
-    stops: dict[str, Stop] = field(init=False, default_factory=dict)
-    trips: list["Trip"] = field(init=False, default_factory=list)
+    _has_stops_and_trips: bool = field(init=False, default=False, repr=False, compare=False)
+    _stops: dict[str, Stop] = field(init=False, default_factory=dict, repr=False, compare=False)
+    _trips: list["Trip"] = field(init=False, default_factory=list, repr=False, compare=False)
+    _patterns: list["Pattern"] = field(init=False, default_factory=list, repr=False, compare=False)
+    fetch: InitVar[bool] = True
 
-    def __post_init__(self):
+    def __post_init__(self, fetch: bool):
+        # the stops and trips are only loaded when first accessed. fetch=False
+        # builds an empty route instead, for backends which fill the stops and
+        # trips themselves
+        if not fetch:
+            self._has_stops_and_trips = True
+
+    def load(self, use_db: bool=True) -> None:
+        """Loads the stops and trips of the route: from the route database, if
+        it has the route (and use_db), else from the cached (or fetched)
+        response.
+        """
+        if use_db and os.path.exists(routes_database_file):
+            stored = get_route(self.id)
+            if stored is not None:
+                self._stops, self._trips, self._patterns = stored.stops, stored.trips, stored.patterns
+                self._has_stops_and_trips = True
+                return
+        self._stops, self._trips, self._patterns = {}, [], []
+        # set first, as parsing fills the stops and patterns through the route
         self._has_stops_and_trips = True
-        self.trips = get_route_stops_and_trips(self)
+        self._trips = get_route_stops_and_trips(self)
+
+    def release(self) -> None:
+        """Drops the stops and trips, which are loaded again if needed"""
+        self._stops, self._trips, self._patterns = {}, [], []
+        self._has_stops_and_trips = False
+
+    @property
+    def stops(self) -> dict[str, Stop]:
+        if not self._has_stops_and_trips:
+            self.load()
+        return self._stops
+
+    @property
+    def trips(self) -> list["Trip"]:
+        if not self._has_stops_and_trips:
+            self.load()
+        return self._trips
+
+    @trips.setter
+    def trips(self, trips: list["Trip"]) -> None:
+        self._trips = trips
+
+    @property
+    def patterns(self) -> list["Pattern"]:
+        if not self._has_stops_and_trips:
+            self.load()
+        return self._patterns
 
     def has_stop(self, stop: Union[Stop, str]) -> bool:
         if isinstance(stop, Stop):
@@ -74,7 +181,28 @@ class Route:
         return self.stops[stop_id]
     
     def add_stop(self, stop: Stop) -> None:
-        self.stops[stop.id] = stop
+        self._stops[stop.id] = stop
+
+    def add_trip(self, trip_id: str, service_id: str, calendar: "ServiceCalendar", direction: str, schedule: list["TimedStop"]) -> "Trip":
+        """Builds a trip, adding its times to the pattern of its stops (which
+        is created if it's the first trip visiting them). Does not add it to
+        self.trips.
+        """
+        schedule = sorted(schedule, key=lambda timed_stop: timed_stop.stop_sequence)
+        stop_ids = tuple(timed_stop.stop_id for timed_stop in schedule)
+        stop_sequences = tuple(timed_stop.stop_sequence for timed_stop in schedule)
+        for pattern in self._patterns:
+            if pattern.direction == direction and pattern.stop_ids == stop_ids and pattern.stop_sequences == stop_sequences:
+                break
+        else:
+            stop_names = tuple(timed_stop.stop_name for timed_stop in schedule)
+            pattern = Pattern(direction, stop_ids, stop_names, stop_sequences)
+            self._patterns.append(pattern)
+        trip = Trip(trip_id, service_id, calendar, direction)
+        pattern.add_trip(trip,
+                         [timed_stop.arrival_time for timed_stop in schedule],
+                         [timed_stop.departure_time for timed_stop in schedule])
+        return trip
 
     def __str__(self) -> str:
         return f"{self.long_name} ({self.id})"
@@ -86,8 +214,8 @@ class Route:
         size = 0
         for trip in self.trips:
             size += sys.getsizeof(trip)
-            for sched in trip.schedule.values():
-                size += sys.getsizeof(sched)
+        for pattern in self.patterns:
+            size += sys.getsizeof(pattern) + sys.getsizeof(pattern.arrivals) + sys.getsizeof(pattern.departures)
         for stop in self.stops.values():
             size += sys.getsizeof(stop)
         return size + sys.getsizeof(self) + sys.getsizeof(self.stops) + sys.getsizeof(self.trips)
@@ -96,8 +224,9 @@ class Route:
 class TripAB:
     origin_stop: Stop
     destination_stop: Stop
-    origin_time: str
-    destination_time: str
+    # seconds since the start of the service day, see seconds_to_time
+    origin_time: int
+    destination_time: int
     route: Route
     trip: "Trip"
 
@@ -106,15 +235,205 @@ class TimedStop:
     stop_id: str
     stop_name: str
     stop_sequence: int
-    arrival_time: str
-    departure_time: str
+    # seconds since the start of the service day
+    arrival_time: int
+    departure_time: int
+
+@functools.lru_cache(maxsize=65536)
+def time_to_seconds(time: str) -> int:
+    """HH:MM:SS (or HH:MM) -> seconds since the start of the service day.
+    Hours may go past 24, for trips running after midnight.
+    """
+    hours, minutes, *seconds = time.split(':')
+    return int(hours)*60*60 + int(minutes)*60 + (int(seconds[0]) if seconds else 0)
+
+def seconds_to_time(seconds: int) -> str:
+    """seconds since the start of the service day -> HH:MM:SS"""
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+@dataclass
+class Pattern:
+    """A unique sequence of stops of a route in one direction. The stops are
+    stored once, and the times of the trips visiting them as trips x stops
+    row-major matrices of seconds, so that checking the order of two stops is
+    done once for all the trips, and their times at a stop are one slice.
+    """
+    direction: str
+    stop_ids: tuple[str, ...]
+    stop_names: tuple[str, ...]
+    stop_sequences: tuple[int, ...]
+    trips: list["Trip"] = field(default_factory=list, repr=False)
+    arrivals: array = field(default_factory=lambda: array('i'), repr=False)
+    departures: array = field(default_factory=lambda: array('i'), repr=False)
+    # position of the last visit to each stop, like the old per trip schedules
+    stop_index: dict[str, int] = field(init=False, repr=False)
+    # rows of the trips by departure from the first stop, and whether the trips
+    # keep that order at every stop (no overtaking, as on most patterns), so
+    # that the departures at any stop can be bisected in it. Computed when the
+    # pattern is pickled, so the routes in the database have it, or on first
+    # use for a pattern being built
+    departure_order: Union[array, None] = field(init=False, default=None, repr=False, compare=False)
+    fifo: bool = field(init=False, default=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.stop_index = {stop_id: i for i, stop_id in enumerate(self.stop_ids)}
+
+    def __getstate__(self):
+        self._sort_departures()
+        return self.__dict__.copy()
+
+    def add_trip(self, trip: "Trip", arrivals: list[int], departures: list[int]) -> None:
+        trip.pattern = self
+        trip.row = len(self.trips)
+        self.trips.append(trip)
+        self.arrivals.extend(arrivals)
+        self.departures.extend(departures)
+        self.departure_order = None
+
+    def in_sequence(self, stopA: str, stopB: str) -> bool:
+        """Returns true if stopA is before stopB in the pattern"""
+        a = self.stop_index.get(stopA)
+        b = self.stop_index.get(stopB)
+        return a is not None and b is not None and a < b
+
+    def arrival_times(self, position: int) -> array:
+        """Arrival times of all the trips at the stop in the given position"""
+        return self.arrivals[position::len(self.stop_ids)]
+
+    def departure_times(self, position: int) -> array:
+        """Departure times of all the trips at the stop in the given position"""
+        return self.departures[position::len(self.stop_ids)]
+
+    def _sort_departures(self) -> None:
+        if self.departure_order is not None:
+            return
+        n = len(self.stop_ids)
+        departures = self.departures
+        # ties at the first stop are broken by the next stops
+        order = array('i', sorted(range(len(self.trips)), key=lambda row: departures[row * n:(row + 1) * n]))
+        self.fifo = all(departures[a * n + i] <= departures[b * n + i]
+                        for a, b in zip(order, order[1:]) for i in range(n))
+        self.departure_order = order
+
+    def rows_departing_between(self, position: int, start: int, end: int) -> array:
+        """Rows of the trips departing from the stop in the given position at
+        start <= seconds <= end, by departure from the first stop. Bisected in
+        departure_order if the trips never overtake each other, and filtered
+        from it otherwise.
+        """
+        self._sort_departures()
+        order = self.departure_order
+        n = len(self.stop_ids)
+        departures = self.departures
+        if not self.fifo:
+            return array('i', (row for row in order if start <= departures[row * n + position] <= end))
+        # bisect_left for start and bisect_right for end, on the departures
+        # at position in the order of the rows
+        bounds = []
+        for value, right in ((start, False), (end, True)):
+            low, high = 0, len(order)
+            while low < high:
+                middle = (low + high) // 2
+                departure = departures[order[middle] * n + position]
+                if departure < value or (right and departure == value):
+                    low = middle + 1
+                else:
+                    high = middle
+            bounds.append(low)
+        return order[bounds[0]:bounds[1]]
+
+@functools.lru_cache(maxsize=4096)
+def _day_ordinal(day: str) -> int:
+    """YYYYMMDD -> proleptic Gregorian ordinal"""
+    return datetime.date(int(day[:4]), int(day[4:6]), int(day[6:8])).toordinal()
+
+@dataclass
+class ServiceCalendar:
+    """The days in which a service runs, as a bitset of day offsets: bit i of
+    bits is set if the service runs on the day with ordinal start + i.
+    There is one calendar per service_id, shared by all its trips.
+    """
+    service_id: str
+    start: int
+    bits: bytes
+
+    def is_active(self, day: str) -> bool:
+        """O(1) check if the service runs on day (YYYYMMDD)"""
+        offset = _day_ordinal(day) - self.start
+        if offset < 0 or offset >= len(self.bits) * 8:
+            return False
+        return bool(self.bits[offset >> 3] >> (offset & 7) & 1)
+
+    def dates(self) -> list[str]:
+        """The days in which the service runs, as YYYYMMDD strings"""
+        return [datetime.date.fromordinal(self.start + offset).strftime("%Y%m%d")
+                for offset in range(len(self.bits) * 8)
+                if self.bits[offset >> 3] >> (offset & 7) & 1]
+
+    def __reduce__(self):
+        # unpickled calendars are interned, so routes loaded from the database
+        # share them too
+        return (_intern_calendar, (self.service_id, self.start, self.bits))
+
+service_calendars: dict[str, ServiceCalendar] = {}
+
+def _intern_calendar(service_id: str, start: int, bits: bytes) -> ServiceCalendar:
+    calendar = service_calendars.get(service_id)
+    if calendar is None or calendar.start != start or calendar.bits != bits:
+        # new service, or its days changed since it was interned
+        calendar = ServiceCalendar(service_id, start, bits)
+        service_calendars[service_id] = calendar
+    return calendar
+
+def intern_calendar(service_id: str, dates: list[str]) -> ServiceCalendar:
+    """Returns the calendar of service_id running on the given dates (YYYYMMDD),
+    reusing the existing one if the dates did not change.
+    """
+    if not dates:
+        return _intern_calendar(service_id, 0, b"")
+    ordinals = [_day_ordinal(date) for date in dates]
+    start = min(ordinals)
+    bits = bytearray((max(ordinals) - start) // 8 + 1)
+    for ordinal in ordinals:
+        offset = ordinal - start
+        bits[offset >> 3] |= 1 << (offset & 7)
+    return _intern_calendar(service_id, start, bytes(bits))
+
+def is_active(service_id: str, day: str) -> bool:
+    """Returns true if the (interned) service runs on day (YYYYMMDD)"""
+    calendar = service_calendars.get(service_id)
+    return calendar is not None and calendar.is_active(day)
+
 @dataclass
 class Trip:
     trip_id: str
     service_id: str
-    schedule: dict[str, TimedStop] # for O(1) stop lookup
-    dates: list[str]
+    calendar: ServiceCalendar
     direction: str
+    # the stops and times are kept by the pattern, in the given row
+    pattern: Pattern = field(default=None, repr=False, compare=False)
+    row: int = field(default=0, repr=False, compare=False)
+
+    @property
+    def dates(self) -> list[str]:
+        return self.calendar.dates()
+
+    @property
+    def schedule(self) -> dict[str, TimedStop]:
+        """The stops of the trip by id. Built on each access, prefer using the
+        pattern directly.
+        """
+        pattern = self.pattern
+        n = len(pattern.stop_ids)
+        base = self.row * n
+        return {
+            stop_id: TimedStop(stop_id, pattern.stop_names[i], pattern.stop_sequences[i],
+                               pattern.arrivals[base + i], pattern.departures[base + i])
+            for i, stop_id in enumerate(pattern.stop_ids)
+        }
+
+    def is_active(self, day: str) -> bool:
+        return self.calendar.is_active(day)
 
     def in_sequence(self, stopA: Union[Stop, str], stopB: Union[Stop, str]):
         """Returns true if stopA is before stopB in the trip"""
@@ -122,37 +441,142 @@ class Trip:
             stopA = stopA.id
         if isinstance(stopB, Stop):
             stopB = stopB.id
-        if stopA not in self.schedule or stopB not in self.schedule:
-            return False
-        return self.schedule[stopA].stop_sequence < self.schedule[stopB].stop_sequence
+        return self.pattern.in_sequence(stopA, stopB)
+
+    def departure_time(self, stop_id: str) -> int:
+        """Departure time (seconds) at the last visit to stop_id"""
+        pattern = self.pattern
+        return pattern.departures[self.row * len(pattern.stop_ids) + pattern.stop_index[stop_id]]
+
+    def arrival_time(self, stop_id: str) -> int:
+        """Arrival time (seconds) at the last visit to stop_id"""
+        pattern = self.pattern
+        return pattern.arrivals[self.row * len(pattern.stop_ids) + pattern.stop_index[stop_id]]
         
 
 
-def __cached_request(url: str, key: str, cache_dir="cache", overwrite=False) -> str:
-    """Cache the request in a file with the same name as the url"""
-    if not os.path.isdir(cache_dir):
-        os.mkdir(cache_dir)
-    filename = key + ".pkl"
-    filename = os.path.join(cache_dir, filename)
-    try:
-        if overwrite:
-            # delete file first, to ensure it's not corrupted
-            os.remove(filename)
-            raise FileNotFoundError
-        with open(filename, "rb") as f:
-            response = pickle.load(f)
-    except FileNotFoundError:
-        response = requests.request("GET", url)
+_session = None
+_session_lock = threading.Lock()
+
+def _get_session(pool_size: int=16, retries: int=3, backoff: float=0.5) -> requests.Session:
+    """Returns the shared session, which keeps connections to the API alive
+    and retries failed requests with exponential backoff.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
+_caches: dict[str, cache.ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+def _get_cache(cache_dir="cache") -> cache.ResponseCache:
+    """Returns the response cache in cache_dir, moving the responses of the
+    old pickled cache into it the first time.
+    """
+    with _caches_lock:
+        if cache_dir not in _caches:
+            response_cache = cache.ResponseCache(cache_dir)
+            migrated = response_cache.migrate_pickles()
+            if migrated:
+                print(f"Migrated {migrated} cached responses")
+            _caches[cache_dir] = response_cache
+        return _caches[cache_dir]
+
+def _store_response(key: str, response: requests.Response, cache_dir="cache") -> None:
+    _get_cache(cache_dir).put(key, response.url, response.content,
+                              response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+def __cached_request(url: str, key: str, cache_dir="cache", overwrite=False) -> bytes:
+    """Cache the body of the request under key"""
+    response_cache = _get_cache(cache_dir)
+    body = None if overwrite else response_cache.get(key)
+    if body is None:
+        response = _get_session().get(url)
         if not response.ok:
             print(f"Error {response.status_code} for {url}")
             raise requests.exceptions.ConnectionError
-        with open(filename, "wb") as f:
-            pickle.dump(response, f)
+        _store_response(key, response, cache_dir)
+        body = response.content
+
+    return body
+
+def _revalidate_cached_request(url: str, key: str, cache_dir="cache") -> tuple[bytes, bool]:
+    """Revalidates a cached request with the server, sending the validators
+    (ETag, Last-Modified) stored with the cached body. Returns the current body
+    and whether it changed: a 304, or a body with the same hash as the cached
+    one, counts as unchanged. The cached body is only replaced by a successful
+    response, and kept on errors.
+    """
+    response_cache = _get_cache(cache_dir)
+    entry = response_cache.get_entry(key)
+
+    headers = {}
+    if entry is not None:
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+    response = _get_session().get(url, headers=headers, timeout=60)
 
-    return response
+    if response.status_code == 304 and entry is not None:
+        body = response_cache.get(key)
+        if body is not None:
+            # still fresh, only renew its age for _delete_older_than
+            response_cache.touch(key)
+            return body, False
+        # the body went missing, fetch it again
+        response = _get_session().get(url, timeout=60)
+    if not response.ok:
+        print(f"Error {response.status_code} for {url}")
+        raise requests.exceptions.ConnectionError
+    changed = entry is None or hashlib.sha256(response.content).digest() != entry.sha256
+    # stored even if unchanged, to keep the new validators
+    _store_response(key, response, cache_dir)
+    return response.content, changed
+
+def prefetch_routes(route_short_names: list[str], workers: int=8, overwrite: bool=False,
+                    progress: Union[Callable[[int, int, str], None], None]=None, cache_dir="cache") -> dict[str, Exception]:
+    """Fetches the given routes into the cache concurrently, with at most
+    workers requests in flight over the shared session. Routes already cached
+    are skipped, unless overwrite. progress(done, total, route_short_name) is
+    called as each route finishes.
+    Returns the routes which could not be fetched, with the error.
+    """
+    response_cache = _get_cache(cache_dir)
+    if not overwrite:
+        route_short_names = [name for name in route_short_names if response_cache.get_entry(name) is None]
+    if progress is None:
+        def progress(done, total, route_short_name):
+            print(f"Fetched route {done}/{total}", end="\r" if done < total else "\n")
+    session = _get_session(pool_size=max(workers, 16))
+
+    def fetch(route_short_name: str) -> None:
+        response = session.get(_route_url(route_short_name), timeout=60)
+        response.raise_for_status()
+        _store_response(route_short_name, response, cache_dir)
+
+    failed = {}
+    total = len(route_short_names)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, name): name for name in route_short_names}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            route_short_name = futures[future]
+            try:
+                future.result()
+            except requests.exceptions.RequestException as e:
+                failed[route_short_name] = e
+                print(f"Error fetching route {route_short_name}: {e}")
+            progress(done, total, route_short_name)
+    return failed
 
 cache_dict = {}
-def _cached_request(url: str, key: str, cache_dir: os.PathLike="cache", overwrite=False) -> str:
+def _cached_request(url: str, key: str, cache_dir: os.PathLike="cache", overwrite=False) -> bytes:
     """Uses __cached_request, but places the response in a more accessible dict
     """
     # not right now
@@ -167,19 +591,11 @@ def _cached_request(url: str, key: str, cache_dir: os.PathLike="cache", overwrit
 
 def _delete_cached_request(url: str, params: dict[str, str], cache_dir="cache"):
     """Delete the cached request"""
-    if not os.path.isdir(cache_dir):
-        os.mkdir(cache_dir)
-    filename = urllib.parse.urlencode(params) + ".pkl"
-    filename = os.path.join(cache_dir, filename)
-    try:
-        os.remove(filename)
-    except FileNotFoundError:
-        pass
+    _get_cache(cache_dir).delete(urllib.parse.urlencode(params))
 
 def _delete_older_than(days: int, cache_dir="cache"):
-    """Delete all cached requests older than days"""
-    if not os.path.isdir(cache_dir):
-        os.mkdir(cache_dir)
+    """Delete all cached requests (and other cached pickles) older than days"""
+    _get_cache(cache_dir).delete_older_than(days)
     for filename in os.listdir(cache_dir):
         if filename.endswith(".pkl"):
             filepath = os.path.join(cache_dir, filename)
@@ -188,14 +604,14 @@ def _delete_older_than(days: int, cache_dir="cache"):
                 os.remove(filepath)
 
 def get_all_routes() -> list[Route]:
-    summary_url = "https://schedules.carrismetropolitana.pt/api/routes/summary"
+    summary_url = _summary_url()
     try:
-        response = _cached_request(summary_url, "routes_summary", overwrite=False)
+        body = _cached_request(summary_url, "routes_summary", overwrite=False)
     except requests.exceptions.ConnectionError:
         print("Connection error")
         return []
 
-    # example response.text:
+    # example response body:
     # '[
     # {
     #     "_id": "6474e02e155a72200ee0dcf1",
@@ -258,25 +674,30 @@ def get_all_routes() -> list[Route]:
     # convert the response to a list of routes
     routes = []
     # use msgspec to decode the json
-    for route in json_decoder.decode(response.text):
-        route_id = route['route_id']
-        route_short_name = route['route_short_name']
-        route_long_name = route['route_long_name']
-        route_color = route['route_color']
-        route_text_color = route['route_text_color']
+    # the routes are cheap to build, their stops and trips are only loaded
+    # when first accessed
+    for route in summary_decoder.decode(body):
+        route_id = route.route_id
+        route_short_name = route.route_short_name
+        route_long_name = route.route_long_name
+        route_color = route.route_color
+        route_text_color = route.route_text_color
         routes.append(Route(route_id, route_short_name, route_long_name, route_color, route_text_color))
     
     return routes
 
-def _process_chunk(chunk: list[dict]) -> list[Route]:
+def _process_chunk(chunk: list[RouteSummary]) -> list[Route]:
     routes = []
     for route in chunk:
-        route_id = route['route_id']
-        route_short_name = route['route_short_name']
-        route_long_name = route['route_long_name']
-        route_color = route['route_color']
-        route_text_color = route['route_text_color']
+        route_id = route.route_id
+        route_short_name = route.route_short_name
+        route_long_name = route.route_long_name
+        route_color = route.route_color
+        route_text_color = route.route_text_color
         routes.append(Route(route_id, route_short_name, route_long_name, route_color, route_text_color))
+    # load them here, so that the work is done by the pool
+    for route in routes:
+        route.load()
     return routes
 
 def get_all_routes_pool(chunksize: int=10, n_workers: int=4) -> list[Route]:
@@ -286,14 +707,15 @@ def get_all_routes_pool(chunksize: int=10, n_workers: int=4) -> list[Route]:
     # to prevent doing it all at once, we split the work into chunks of chunksize
     # and run each chunk in a subprocess
     # we process the chunks in parallel using n_workers processes
-    summary_url = "https://schedules.carrismetropolitana.pt/api/routes/summary"
+    summary_url = _summary_url()
     try:
-        response = _cached_request(summary_url, "routes_summary", overwrite=False)
+        body = _cached_request(summary_url, "routes_summary", overwrite=False)
     except requests.exceptions.ConnectionError:
         print("Connection error")
         return []
 
-    summary_json = response.json()
+    summary_json = summary_decoder.decode(body)
+    prefetch_routes([route.route_short_name for route in summary_json])
 
     chunks = [summary_json[i:i + chunksize] for i in range(0, len(summary_json), chunksize)]
 
@@ -303,61 +725,22 @@ def get_all_routes_pool(chunksize: int=10, n_workers: int=4) -> list[Route]:
     return list(itertools.chain.from_iterable(routes))
 
 
-def _process_and_queue_chunk(chunk: list[dict], queue: multiprocessing.Queue) -> None:
-    routes = _process_chunk(chunk)
-    queue.put(routes)
-    # terminate the process
-    # import sys
-    # sys.exit(0)
-    
-
 def get_all_routes_ephemeral_processes(chunksize: int=10, workers: int=4) -> list[Route]:
-    # same as get_all_routes_pool, but using new processes for each chunk, ensuring
-    # that the memory is released to the OS
-    summary_url = "https://schedules.carrismetropolitana.pt/api/routes/summary"
-    try:
-        response = _cached_request(summary_url, "routes_summary", overwrite=False)
-    except requests.exceptions.ConnectionError:
-        print("Connection error")
-        return []
-
-    summary_json = response.json()
-
-    chunks = [summary_json[i:i + chunksize] for i in range(0, len(summary_json), chunksize)]
-    queue = multiprocessing.Queue()
-
-    routes = []
-    N = len(chunks)
-    i = 0
-    for j in range(0, N, workers):
-        i += workers
-        print(f"Processing chunks {i}/{N}", flush=True)
-        n_chunks = min(workers, N - j)
-        batch = chunks[j:j + n_chunks]
-        # flush
-        p: list[multiprocessing.Process] = []
-        for chunk in batch:
-            process = multiprocessing.Process(target=_process_and_queue_chunk, args=(chunk, queue))
-            p.append(process)
-        for process in p:
-            process.start()
-        for process in p:
-            routes.extend(queue.get())
-        for process in p:
-            process.join()
-
-
-    return routes
+    # used to build each chunk in a new process, so that the memory used by the
+    # untyped JSON decoding was released to the OS. The typed decoding no
+    # longer allocates the unused fields, so this is the same as get_all_routes
+    # (kept for compatibility)
+    return get_all_routes()
 
 def get_route_stops_and_trips(route: Route) -> list[Trip]:
-    url = f"https://schedules.carrismetropolitana.pt/api/routes/route_short_name/{route.short_name}"
+    url = _route_url(route.short_name)
     try:
-        response = _cached_request(url, route.short_name)
+        body = _cached_request(url, route.short_name)
     except requests.exceptions.ConnectionError:
         print("Connection error")
         return []
     
-    # example response.text:
+    # example response body:
     # '[
     # {
     # "trip_id":"p0_1002_0_1_0730_0759_0_7",
@@ -398,137 +781,335 @@ def get_route_stops_and_trips(route: Route) -> list[Trip]:
     #       "stop_name":"Av Força Aérea Port (Passagem Peões)",
     # ...
     trips = []
-    for direction in json_decoder.decode(response.text)[0]['directions']:
-        for trip in direction['trips']:
-            trip_id = trip['trip_id']
-            service_id = trip['service_id']
-            dates = trip['dates']
-            direction_str = direction['headsign']
-            schedule = {}
-            for stop in trip['schedule']:
-                if not route.has_stop(stop['stop_id']):
-                    route.add_stop(Stop(stop['stop_id'], stop['stop_name'], stop['stop_lat'], stop['stop_lon']))
-                stop_id = stop['stop_id']
-                stop_name = stop['stop_name']
-                stop_sequence = stop['stop_sequence']
-                arrival_time = stop['arrival_time']
-                departure_time = stop['departure_time']
-                timedStop = TimedStop(stop_id, stop_name, stop_sequence, arrival_time, departure_time)
-                schedule[stop_id] = timedStop
-            trips.append(Trip(trip_id, service_id, schedule, dates, direction_str))
+    for direction in route_detail_decoder.decode(body)[0].directions:
+        for trip in direction.trips:
+            trip_id = trip.trip_id
+            service_id = trip.service_id
+            calendar = intern_calendar(service_id, trip.dates)
+            direction_str = direction.headsign
+            schedule = []
+            for stop in trip.schedule:
+                if not route.has_stop(stop.stop_id):
+                    route.add_stop(Stop(stop.stop_id, stop.stop_name, stop.stop_lat, stop.stop_lon))
+                stop_id = stop.stop_id
+                stop_name = stop.stop_name
+                stop_sequence = stop.stop_sequence
+                arrival_time = time_to_seconds(stop.arrival_time)
+                departure_time = time_to_seconds(stop.departure_time)
+                schedule.append(TimedStop(stop_id, stop_name, stop_sequence, arrival_time, departure_time))
+            trips.append(route.add_trip(trip_id, service_id, calendar, direction_str, schedule))
 
     return trips
 
 def get_all_routes_naive_generator() -> Generator[Route, None, None]:
-    summary_url = "https://schedules.carrismetropolitana.pt/api/routes/summary"
+    summary_url = _summary_url()
     try:
-        response = _cached_request(summary_url, "routes_summary", overwrite=False)
+        body = _cached_request(summary_url, "routes_summary", overwrite=False)
     except requests.exceptions.ConnectionError:
         print("Connection error")
         return
 
-    for route in json_decoder.decode(response.text):
-        route_id = route['route_id']
-        route_short_name = route['route_short_name']
-        route_long_name = route['route_long_name']
-        route_color = route['route_color']
-        route_text_color = route['route_text_color']
+    summary = summary_decoder.decode(body)
+    # fill the cache concurrently before the routes fetch their trips
+    prefetch_routes([route.route_short_name for route in summary])
+    for route in summary:
+        route_id = route.route_id
+        route_short_name = route.route_short_name
+        route_long_name = route.route_long_name
+        route_color = route.route_color
+        route_text_color = route.route_text_color
         yield Route(route_id, route_short_name, route_long_name, route_color, route_text_color)
 
-def find_or_build_route_db():    
+def _index_route(db: sqlite3.Connection, route: Route) -> None:
+    """(Re)writes the stop_routes rows of a route, so that the stop -> route
+    index stays in sync with the pickled route.
+    """
+    db.execute("DELETE FROM stop_routes WHERE route_id = ?", (route.id,))
+    db.executemany("INSERT OR IGNORE INTO stop_routes (stop_id, route_id) VALUES (?, ?)",
+                   ((stop_id, route.id) for stop_id in route.stops))
+
+def _create_stop_routes_index(db: sqlite3.Connection) -> None:
+    db.execute("CREATE TABLE IF NOT EXISTS stop_routes (stop_id TEXT, route_id TEXT, PRIMARY KEY (stop_id, route_id)) WITHOUT ROWID")
+    db.execute("CREATE INDEX IF NOT EXISTS stop_routes_route_id ON stop_routes (route_id)")
+
+def _create_meta_tables(db: sqlite3.Connection) -> None:
+    # meta holds the id of the database, new at each (re)build, and its data
+    # version, bumped by every write of routes. route_versions holds the data
+    # version at which each route last changed. Together they tell whether
+    # something derived from the routes (snapshot, day timetables) is current.
+    # route_sources holds the hash of the response each route was built from,
+    # to tell whether a route must be rebuilt from its cached response
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+    db.execute("CREATE TABLE IF NOT EXISTS route_versions (route_id TEXT PRIMARY KEY, version INTEGER)")
+    db.execute("CREATE TABLE IF NOT EXISTS route_sources (route_id TEXT PRIMARY KEY, sha256 BLOB)")
+    db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('database_id', ?)", (uuid.uuid4().hex,))
+    db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0)")
+
+def _bump_data_version(db: sqlite3.Connection, route_ids: list[str]) -> int:
+    """Increments the data version, recording it as the version of the given
+    routes. Called in the transaction writing them. Returns the new version.
+    """
+    db.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_version'")
+    version = db.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+    db.executemany("INSERT OR REPLACE INTO route_versions (route_id, version) VALUES (?, ?)",
+                   ((route_id, version) for route_id in route_ids))
+    return version
+
+def get_data_version() -> tuple[str, int]:
+    """(database id, data version) of the route database"""
+    rows = dict(_get_routes_db().reader().execute("SELECT key, value FROM meta WHERE key IN ('database_id', 'data_version')"))
+    return rows["database_id"], rows["data_version"]
+
+def get_routes_changed_since(version: int) -> list[str]:
+    """Ids of the routes written after the given data version"""
+    return [route_id for (route_id,) in _get_routes_db().reader().execute(
+        "SELECT route_id FROM route_versions WHERE version > ?", (version,))]
+
+def _get_route_source(route_id: str) -> Union[bytes, None]:
+    """sha256 of the response the route in the database was built from"""
+    row = _get_routes_db().reader().execute("SELECT sha256 FROM route_sources WHERE route_id = ?", (route_id,)).fetchone()
+    return None if row is None else row[0]
+
+def _build_routes_chunk(chunk: list[tuple[str, str, str, str, str]]) -> list[tuple[str, bytes, list[str], bytes]]:
+    """Parses and pickles a chunk of routes, in a build worker. Returns
+    (route id, pickled route, stop ids, sha256 of the response) of each route.
+    """
+    built = []
+    for fields in chunk:
+        route = Route(*fields)
+        route.load(use_db=False)
+        entry = _get_cache().get_entry(route.short_name)
+        built.append((route.id, pickle.dumps(route), list(route.stops), None if entry is None else entry.sha256))
+    return built
+
+def _build_route_db(routes_db: database.Database, chunksize: int=8, n_workers: Union[int, None]=None) -> bool:
+    """Adds the routes missing from the database, resuming an interrupted
+    build: routes are fetched concurrently, parsed and pickled by a process
+    pool, and written by this process, one transaction per chunk, each
+    recording a checkpoint per route. Returns True if all the routes were
+    built.
+    """
+    done = {route_id for (route_id,) in routes_db.reader().execute("SELECT route_id FROM build_checkpoints")}
+    routes = get_all_routes()
+    if not routes:
+        return False
+    todo = [route for route in routes if route.id not in done]
+    if done:
+        print(f"Resuming build: {len(done)} routes already built, {len(todo)} to go")
+    # routes whose response can't be fetched are left for the next build,
+    # instead of being stored without trips
+    errors = prefetch_routes([route.short_name for route in todo])
+    if errors:
+        print(f"Skipping {len(errors)} routes which couldn't be fetched")
+    todo = [(route.id, route.short_name, route.long_name, route.color, route.text_color)
+            for route in todo if route.short_name not in errors]
+    chunks = [todo[i:i + chunksize] for i in range(0, len(todo), chunksize)]
+
+    start = datetime.datetime.now()
+    n_routes = 0
+    n_bytes = 0
+    with multiprocessing.Pool(n_workers) as pool:
+        for built in pool.imap_unordered(_build_routes_chunk, chunks):
+            with routes_db.writer() as writer:
+                # the departure boards (see boards.py) may have been built from
+                # the routes of an interrupted build, they are rebuilt on the
+                # next find_or_build_departure_boards
+                writer.execute("DROP TABLE IF EXISTS departure_boards")
+                for route_id, pickled, stop_ids, sha256 in built:
+                    writer.execute("INSERT OR REPLACE INTO routes (id, route) VALUES (?, ?)", (route_id, pickled))
+                    writer.execute("INSERT OR REPLACE INTO route_sources (route_id, sha256) VALUES (?, ?)", (route_id, sha256))
+                    writer.execute("DELETE FROM stop_routes WHERE route_id = ?", (route_id,))
+                    writer.executemany("INSERT OR IGNORE INTO stop_routes (stop_id, route_id) VALUES (?, ?)",
+                                       ((stop_id, route_id) for stop_id in stop_ids))
+                    writer.execute("INSERT OR REPLACE INTO build_checkpoints (route_id, built_at) VALUES (?, ?)",
+                                   (route_id, datetime.datetime.now().timestamp()))
+                    n_bytes += len(pickled)
+                _bump_data_version(writer, [route_id for route_id, *_ in built])
+            n_routes += len(built)
+            seconds = max((datetime.datetime.now() - start).total_seconds(), 1e-6)
+            print(f"Built {n_routes}/{len(todo)} routes ({n_routes / seconds:.1f} routes/s, {n_bytes / seconds / 2**20:.1f} MB/s)", end="\r")
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    print(f"\nBuilt {n_routes} routes ({n_bytes / 2**20:.1f} MB) in {seconds:.1f}s")
+    return not errors
+
+def _get_routes_db() -> database.Database:
+    global _routes_db
+    if _routes_db is None or _routes_db.filename != routes_database_file:
+        _routes_db = database.Database(routes_database_file)
+    return _routes_db
+
+def _remove_route_db() -> None:
+    _get_routes_db().close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(routes_database_file + suffix):
+            os.remove(routes_database_file + suffix)
+
+def find_or_build_route_db() -> sqlite3.Connection:
+    """Checks the route database, building (or resuming the build of) it if
+    needed. Returns the read connection of the calling thread.
+    """
     global db
     if db is None:
-        # check if the database exists
+        # check if the database exists. A build in progress (or interrupted)
+        # has user_version -ROUTES_DB_VERSION, and is resumed
+        routes_db = _get_routes_db()
         if os.path.exists(routes_database_file):
-            db = sqlite3.connect(routes_database_file)
-            print("Found existing database")
+            version = routes_db.reader().execute("PRAGMA user_version").fetchone()[0]
+            if version not in (ROUTES_DB_VERSION, -ROUTES_DB_VERSION):
+                print(f"Found outdated database (version {version}), rebuilding")
+                _remove_route_db()
+                return find_or_build_route_db()
+            # databases from before the data version (or the route sources)
+            # get it here
+            if routes_db.reader().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'route_sources'").fetchone() is None:
+                with routes_db.writer() as writer:
+                    _create_meta_tables(writer)
+            if version == ROUTES_DB_VERSION:
+                print("Found existing database")
+                db = routes_db
+                return db.reader()
         else:
             # build the database
             print("Building database")
-            i = 0
-            db = sqlite3.connect(routes_database_file)
-            db.execute("CREATE TABLE routes (id TEXT PRIMARY KEY, route BLOB)")
-            db.commit()
-            for route in get_all_routes_naive_generator():
-                i += 1
-                print(f"Processing route {i}", end="\r")
-                idx = route.id
-                val = pickle.dumps(route)
-                db.execute("INSERT INTO routes (id, route) VALUES (?, ?)", (idx, val))
-            db.commit()
-            print("\nBuilt database")
-
-    return db
+            os.makedirs(os.path.dirname(routes_database_file), exist_ok=True)
+            with routes_db.writer() as writer:
+                writer.execute("CREATE TABLE routes (id TEXT PRIMARY KEY, route BLOB)")
+                _create_stop_routes_index(writer)
+                _create_meta_tables(writer)
+                writer.execute("CREATE TABLE build_checkpoints (route_id TEXT PRIMARY KEY, built_at REAL)")
+                writer.execute(f"PRAGMA user_version = {-ROUTES_DB_VERSION}")
+        if _build_route_db(routes_db):
+            with routes_db.writer() as writer:
+                writer.execute("DROP TABLE build_checkpoints")
+                writer.execute(f"PRAGMA user_version = {ROUTES_DB_VERSION}")
+            print("Built database")
+        else:
+            print("Some routes couldn't be fetched, the build will resume on the next start")
+        db = routes_db
+
+    return db.reader()
 
 def get_route(route_id: str) -> Route:
-    new_db_connection = sqlite3.connect(routes_database_file)
-    cursor = new_db_connection.execute("SELECT route FROM routes")
-    cursor = new_db_connection.execute("SELECT route FROM routes WHERE id = ?", (route_id,))
-    route = cursor.fetchone()
-    if route is None:
+    row = _get_routes_db().reader().execute("SELECT route FROM routes WHERE id = ?", (route_id,)).fetchone()
+    if row is None:
         return None
     else:
-        return pickle.loads(route[0])
+        return pickle.loads(row[0])
 
-def get_all_routes_generator() -> Generator[Route, None, None]:
-    new_db_connection = sqlite3.connect(routes_database_file)
-    cursor = new_db_connection.execute("SELECT route FROM routes")
-    # get 10 routes at a time, for memory efficiency
+def get_all_routes_generator(batch_size: int=64) -> Generator[Route, None, None]:
+    cursor = _get_routes_db().reader().execute("SELECT route FROM routes")
+    # fetch the rows in batches, but only unpickle one route at a time, for
+    # memory efficiency
     while True:
-        routes = cursor.fetchmany(1)
-        if len(routes) == 0:
+        rows = cursor.fetchmany(batch_size)
+        if len(rows) == 0:
             break
-        for route in routes:
-            yield pickle.loads(route[0])
+        for row in rows:
+            yield pickle.loads(row[0])
+
+def get_route_ids_serving(origins: list[Union[Stop, str]], destinations: list[Union[Stop, str]]) -> list[str]:
+    """Returns the ids of the routes which serve at least one of the origins and
+    at least one of the destinations, using the stop -> route index.
+    """
+    origin_ids = [o.id if isinstance(o, Stop) else o for o in origins]
+    destination_ids = [d.id if isinstance(d, Stop) else d for d in destinations]
+    if not origin_ids or not destination_ids:
+        return []
+    cursor = _get_routes_db().reader().execute(
+        f"SELECT route_id FROM stop_routes WHERE stop_id IN ({','.join('?' * len(origin_ids))}) "
+        f"INTERSECT SELECT route_id FROM stop_routes WHERE stop_id IN ({','.join('?' * len(destination_ids))})",
+        origin_ids + destination_ids)
+    return [row[0] for row in cursor.fetchall()]
+
+def get_routes_generator(route_ids: list[str], batch_size: int=64) -> Generator[Route, None, None]:
+    """Same as get_all_routes_generator, but only unpickles the given routes,
+    in the given order. They are fetched batch_size at a time.
+    """
+    reader = _get_routes_db().reader()
+    for i in range(0, len(route_ids), batch_size):
+        batch = route_ids[i:i + batch_size]
+        rows = dict(reader.execute(f"SELECT id, route FROM routes WHERE id IN ({','.join('?' * len(batch))})", batch))
+        for route_id in batch:
+            if route_id in rows:
+                yield pickle.loads(rows[route_id])
+
+def get_routes_serving_generator(origins: list[Union[Stop, str]], destinations: list[Union[Stop, str]]) -> Generator[Route, None, None]:
+    """Yields only the routes which may contain a trip from one of the origins
+    to one of the destinations. Every other route is never unpickled.
+    """
+    yield from get_routes_generator(get_route_ids_serving(origins, destinations))
+
+# called with (old_route, new_route) by the cache renewal worker, after the
+# updated route (and the data version) is committed to the database
+route_update_listeners: list[Callable[[Route, Route], None]] = []
+
+def _renew_route(route_id: str, route_short_name: str) -> bool:
+    """Revalidates the cached response of a route, and rewrites the route in
+    the database if the response differs from the one it was built from,
+    then calls the route update listeners. Returns whether it was rewritten.
+    The change is told by the hash stored with the route, not by the cache,
+    so a route whose rewrite fails is rewritten on the next try.
+    """
+    body, _ = _revalidate_cached_request(_route_url(route_short_name), route_short_name)
+    sha256 = hashlib.sha256(body).digest()
+    if sha256 == _get_route_source(route_id):
+        # same content as the route in the database, nothing to parse or write
+        return False
+    route = get_route(route_id)
+    if route is None:
+        return False
+
+    # uses newly fetched cached data
+    new_route = Route(route.id, route.short_name, route.long_name, route.color, route.text_color)
+    new_route.load(use_db=False)
+
+    # update the database
+    with _get_routes_db().writer() as writer:
+        writer.execute("UPDATE routes SET route = ? WHERE id = ?", (pickle.dumps(new_route), route_id))
+        _index_route(writer, new_route)
+        _bump_data_version(writer, [route_id])
+        writer.execute("INSERT OR REPLACE INTO route_sources (route_id, sha256) VALUES (?, ?)", (route_id, sha256))
+    # the route is written, a failing listener doesn't keep the others from it
+    for listener in route_update_listeners:
+        try:
+            listener(route, new_route)
+        except Exception as e:
+            print(f"Error updating route {route_short_name} in {listener}: {e!r}")
+    return True
 
 def start_cache_renewal_worker(period_seconds: int=120):
     import threading
     import time
     def worker():
-        summary_url = "https://schedules.carrismetropolitana.pt/api/routes/summary"
+        summary_url = _summary_url()
         try:
-            response = _cached_request(summary_url, "routes_summary", overwrite=False)
+            body = _cached_request(summary_url, "routes_summary", overwrite=False)
         except requests.exceptions.ConnectionError:
             print("Connection error")
             return []
-        route_short_names = []
-        for route in json_decoder.decode(response.text):
-            route_short_name = route['route_short_name']
-            route_short_names.append(route_short_name)
+        def read_route_keys(body):
+            return [(route.route_id, route.route_short_name) for route in summary_decoder.decode(body)]
+        route_keys = read_route_keys(body)
         
         i = 0
         while True:
-            route_short_name = route_short_names[i%len(route_short_names)]
-            url = f"https://schedules.carrismetropolitana.pt/api/routes/route_short_name/{route_short_name}"
+            route_id, route_short_name = route_keys[i%len(route_keys)]
+            # an error only skips this route, which is retried on its next turn
             try:
-                response = _cached_request(url, route_short_name, overwrite=True)
-            except requests.exceptions.ConnectionError:
+                if _renew_route(route_id, route_short_name):
+                    print(f"Processed route {route_short_name} ({i} total)", end="\r")
+            except requests.exceptions.RequestException:
                 print(f"Connection error for route {route_short_name}")
+            except Exception as e:
+                print(f"Error renewing route {route_short_name}: {e!r}")
             if i % 1000 == 0:
                 try:
-                    response = _cached_request(summary_url, "routes_summary", overwrite=True)
-                except requests.exceptions.ConnectionError:
+                    body, summary_changed = _revalidate_cached_request(summary_url, "routes_summary")
+                    if summary_changed:
+                        route_keys = read_route_keys(body)
+                except requests.exceptions.RequestException:
                     print("Connection error for summary")
             i += 1
-            route = get_route(route_short_name)
-
-            if route is None:
-                time.sleep(period_seconds)
-                continue
-            route_id = route.id
-            route_short_name = route.short_name
-            route_long_name = route.long_name
-            route_color = route.color
-            route_text_color = route.text_color
-
-            # uses newly fetched cached data
-            new_route = Route(route_id, route_short_name, route_long_name, route_color, route_text_color)
-
-            print(f"Processed route {route_short_name} ({i} total)", end="\r")
-            # update the database
-            db = sqlite3.connect("routes.db")
-            db.execute("UPDATE routes SET route = ? WHERE id = ?", (pickle.dumps(new_route), route_id))
-            db.commit()
             time.sleep(period_seconds)
 
     renewer = threading.Thread(target=worker, daemon=True)
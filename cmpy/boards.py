@@ -0,0 +1,204 @@
+from . import api
+from typing import Union
+from array import array
+from dataclasses import dataclass, field
+import bisect
+import collections
+import datetime
+import pickle
+import sqlite3
+import threading
+
+# Departure boards: for each stop, the departures of all the routes serving it,
+# as one sorted array of departure seconds per service (i.e. per set of service
+# days), so that the next departures at a stop are found with a binary search
+# per service running on the requested day.
+# The boards are stored in routes.db, one pickled DepartureBoard per stop, and
+# kept in memory once loaded, up to max_loaded_boards per process (the least
+# recently used are dropped, and read again from routes.db when needed).
+
+
+@dataclass
+class BoardTrip:
+    route_id: str
+    route_short_name: str
+    route_long_name: str
+    trip_id: str
+    direction: str
+
+
+@dataclass
+class DepartureBoard:
+    stop_id: str
+    trips: list[BoardTrip] = field(default_factory=list)
+    calendars: dict[str, api.ServiceCalendar] = field(default_factory=dict)
+    # service_id -> (sorted departure seconds, index in trips of each departure)
+    services: dict[str, tuple[array, array]] = field(default_factory=dict)
+
+    def add(self, calendar: api.ServiceCalendar, departure: int, trip_index: int) -> None:
+        """Adds a departure. The board must be sorted before being queried."""
+        if calendar.service_id not in self.services:
+            self.calendars[calendar.service_id] = calendar
+            self.services[calendar.service_id] = (array('i'), array('i'))
+        departures, trips = self.services[calendar.service_id]
+        departures.append(departure)
+        trips.append(trip_index)
+
+    def sort(self) -> None:
+        for service_id, (departures, trips) in self.services.items():
+            order = sorted(range(len(departures)), key=departures.__getitem__)
+            self.services[service_id] = (array('i', (departures[i] for i in order)), array('i', (trips[i] for i in order)))
+
+
+@dataclass
+class Departure:
+    stop_id: str
+    time: datetime.datetime
+    departure_time: int  # seconds since the start of the service day
+    route_id: str
+    route_short_name: str
+    route_long_name: str
+    trip_id: str
+    direction: str
+
+
+max_loaded_boards = 2048
+departure_boards: collections.OrderedDict[str, DepartureBoard] = collections.OrderedDict()
+_departure_boards_lock = threading.Lock()
+# bumped by each update of the boards, so that a board read from the database
+# before an update isn't kept after it
+_departure_boards_version = 0
+
+
+def _add_route(route_boards: dict[str, DepartureBoard], route: api.Route, stop_ids: Union[set[str], None] = None) -> None:
+    """Adds the departures of a route to the boards of its stops (or only of
+    the given stops), creating them as needed.
+    """
+    for pattern in route.patterns:
+        n = len(pattern.stop_ids)
+        for trip in pattern.trips:
+            board_trip = BoardTrip(route.id, route.short_name, route.long_name, trip.trip_id, trip.direction)
+            base = trip.row * n
+            # there are no departures from the last stop
+            for i, stop_id in enumerate(pattern.stop_ids[:-1]):
+                if stop_ids is not None and stop_id not in stop_ids:
+                    continue
+                board = route_boards.get(stop_id)
+                if board is None:
+                    board = route_boards[stop_id] = DepartureBoard(stop_id)
+                if not board.trips or board.trips[-1] is not board_trip:
+                    board.trips.append(board_trip)
+                board.add(trip.calendar, pattern.departures[base + i], len(board.trips) - 1)
+
+
+def _create_table(db: sqlite3.Connection) -> None:
+    db.execute("CREATE TABLE IF NOT EXISTS departure_boards (stop_id TEXT PRIMARY KEY, board BLOB)")
+
+
+def _has_table(db: sqlite3.Connection) -> bool:
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'departure_boards'").fetchone() is not None
+
+
+def find_or_build_departure_boards() -> None:
+    """Builds the departure boards of all the stops into the route database,
+    if they aren't there yet. As they are derived from the routes, the
+    database build drops them whenever it writes routes (resuming included),
+    so they are rebuilt after it.
+    """
+    if _has_table(api.find_or_build_route_db()):
+        return
+    print("Building departure boards")
+    route_boards: dict[str, DepartureBoard] = {}
+    for route in api.get_all_routes_generator():
+        _add_route(route_boards, route)
+    for board in route_boards.values():
+        board.sort()
+    with api._get_routes_db().writer() as writer:
+        _create_table(writer)
+        writer.executemany("INSERT INTO departure_boards (stop_id, board) VALUES (?, ?)",
+                           ((stop_id, pickle.dumps(board)) for stop_id, board in route_boards.items()))
+    print(f"Built departure boards for {len(route_boards)} stops")
+
+
+def get_departure_board(stop_id: str) -> Union[DepartureBoard, None]:
+    """Returns the departure board of a stop, loading it on first use"""
+    with _departure_boards_lock:
+        board = departure_boards.get(stop_id)
+        if board is not None:
+            departure_boards.move_to_end(stop_id)
+            return board
+        version = _departure_boards_version
+    row = api._get_routes_db().reader().execute("SELECT board FROM departure_boards WHERE stop_id = ?", (stop_id,)).fetchone()
+    if row is None:
+        return None
+    board = pickle.loads(row[0])
+    with _departure_boards_lock:
+        if version == _departure_boards_version:
+            departure_boards[stop_id] = board
+            while len(departure_boards) > max_loaded_boards:
+                departure_boards.popitem(last=False)
+    return board
+
+
+def _on_route_updated(old_route: api.Route, new_route: api.Route) -> None:
+    """Rebuilds the boards of the stops of an updated route, from all the
+    routes serving them. Without boards (not built yet, or dropped by the
+    build) there is nothing to update: writing only these would make
+    find_or_build_departure_boards take them for all the boards.
+    """
+    if not _has_table(api._get_routes_db().reader()):
+        return
+    stop_ids = set(old_route.stops) | set(new_route.stops)
+    route_ids = [row[0] for row in api._get_routes_db().reader().execute(
+        f"SELECT DISTINCT route_id FROM stop_routes WHERE stop_id IN ({','.join('?' * len(stop_ids))})", list(stop_ids))]
+    route_boards: dict[str, DepartureBoard] = {stop_id: DepartureBoard(stop_id) for stop_id in stop_ids}
+    for route in api.get_routes_generator(route_ids):
+        _add_route(route_boards, route, stop_ids)
+    for board in route_boards.values():
+        board.sort()
+    with api._get_routes_db().writer() as writer:
+        if not _has_table(writer):
+            return
+        writer.executemany("INSERT OR REPLACE INTO departure_boards (stop_id, board) VALUES (?, ?)",
+                           ((stop_id, pickle.dumps(board)) for stop_id, board in route_boards.items()))
+    global _departure_boards_version
+    with _departure_boards_lock:
+        _departure_boards_version += 1
+        for stop_id, board in route_boards.items():
+            if stop_id in departure_boards:
+                departure_boards[stop_id] = board
+
+api.route_update_listeners.append(_on_route_updated)
+
+
+def next_departures(stop_ids: list[Union[api.Stop, str]], when: Union[datetime.datetime, None] = None, n: int = 10) -> list[Departure]:
+    """Returns the next n departures from any of the given stops, at or after
+    when (default: now), sorted by time. Trips of the previous service day
+    running past midnight are included.
+    """
+    if when is None:
+        when = datetime.datetime.now()
+    stop_ids = [stop.id if isinstance(stop, api.Stop) else stop for stop in stop_ids]
+    midnight = datetime.datetime.combine(when.date(), datetime.time(), tzinfo=when.tzinfo)
+    now_seconds = int((when - midnight).total_seconds())
+    # (seconds since today's midnight, service day seconds, stop id, trip)
+    candidates = []
+    for days_before in (1, 0):
+        day = (when.date() - datetime.timedelta(days=days_before)).strftime("%Y%m%d")
+        offset = days_before * 24*60*60
+        for stop_id in stop_ids:
+            board = get_departure_board(stop_id)
+            if board is None:
+                continue
+            for service_id, (departures, trips) in board.services.items():
+                if not board.calendars[service_id].is_active(day):
+                    continue
+                start = bisect.bisect_left(departures, now_seconds + offset)
+                for i in range(start, min(start + n, len(departures))):
+                    candidates.append((departures[i] - offset, departures[i], stop_id, board.trips[trips[i]]))
+    candidates.sort(key=lambda candidate: candidate[0])
+    return [
+        Departure(stop_id, midnight + datetime.timedelta(seconds=seconds), service_seconds,
+                  trip.route_id, trip.route_short_name, trip.route_long_name, trip.trip_id, trip.direction)
+        for seconds, service_seconds, stop_id, trip in candidates[:n]
+    ]
@@ -0,0 +1,139 @@
+from . import database
+from dataclasses import dataclass
+from typing import Union
+import datetime
+import hashlib
+import os
+import pickle
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used otherwise
+    zstandard = None
+
+# Cache of API responses: only the raw body is kept, compressed, in
+# <cache_dir>/<key>.body, and an index database (<cache_dir>/index.db) holds
+# the url, fetch time, validators and hash of each body. Reads return the
+# decompressed bytes, ready for msgspec, without building a requests.Response.
+# The index connections are reused (see database.Database), as the cache is
+# read for every route fetched.
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    url: str
+    fetched_at: float  # unix time of the last fetch or revalidation
+    etag: Union[str, None]
+    last_modified: Union[str, None]
+    sha256: bytes
+    codec: str
+
+
+def _compress(body: bytes) -> tuple[bytes, str]:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(body), "zstd"
+    return zlib.compress(body, 6), "zlib"
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("cache entry compressed with zstd, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class ResponseCache:
+    def __init__(self, cache_dir: os.PathLike = "cache"):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, "index.db")
+        # the index is small, so it gets a small page cache and no mapping
+        self.db = database.Database(self.index_file, mmap_size=0, cache_size_kib=2 * 2**10)
+        with self.db.writer() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, url TEXT, fetched_at REAL, "
+                       "etag TEXT, last_modified TEXT, sha256 BLOB, codec TEXT)")
+
+    def _body_filename(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".body")
+
+    def get_entry(self, key: str) -> Union[CacheEntry, None]:
+        row = self.db.reader().execute("SELECT key, url, fetched_at, etag, last_modified, sha256, codec FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else CacheEntry(*row)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        """Returns the cached body of key, or None if it isn't cached"""
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+        try:
+            with open(self._body_filename(key), "rb") as f:
+                return _decompress(f.read(), entry.codec)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, url: str, body: bytes, etag: Union[str, None] = None,
+            last_modified: Union[str, None] = None, fetched_at: Union[float, None] = None) -> None:
+        """Stores a body and its metadata. The body file is replaced atomically,
+        so concurrent readers never see a partial file.
+        """
+        data, codec = _compress(body)
+        filename = self._body_filename(key)
+        tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+        with self.db.writer() as db:
+            db.execute("INSERT OR REPLACE INTO entries (key, url, fetched_at, etag, last_modified, sha256, codec) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (key, url, time.time() if fetched_at is None else fetched_at, etag, last_modified,
+                        hashlib.sha256(body).digest(), codec))
+
+    def touch(self, key: str) -> None:
+        """Marks a cached body as fresh, after a successful revalidation"""
+        with self.db.writer() as db:
+            db.execute("UPDATE entries SET fetched_at = ? WHERE key = ?", (time.time(), key))
+
+    def delete(self, key: str) -> None:
+        with self.db.writer() as db:
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        try:
+            os.remove(self._body_filename(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_older_than(self, days: int) -> None:
+        """Deletes the entries fetched (or revalidated) more than days ago"""
+        cutoff = time.time() - datetime.timedelta(days=days).total_seconds()
+        keys = [key for (key,) in self.db.reader().execute("SELECT key FROM entries WHERE fetched_at < ?", (cutoff,))]
+        for key in keys:
+            self.delete(key)
+
+    def migrate_pickles(self) -> int:
+        """Moves the pickled requests.Response files of the old cache
+        (<key>.pkl) into the store. Other pickles (e.g. stops.pkl) are left
+        alone. Returns the number of migrated responses.
+        """
+        import requests
+        migrated = 0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".pkl"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                with open(path, "rb") as f:
+                    response = pickle.load(f)
+            except Exception:
+                continue
+            if not isinstance(response, requests.Response):
+                continue
+            key = filename[:-len(".pkl")]
+            if self.get_entry(key) is None:
+                self.put(key, response.url, response.content, response.headers.get("ETag"),
+                         response.headers.get("Last-Modified"), os.path.getmtime(path))
+            os.remove(path)
+            migrated += 1
+        return migrated
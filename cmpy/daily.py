@@ -0,0 +1,265 @@
+from . import api
+from typing import Union
+from array import array
+from dataclasses import dataclass, field
+import datetime
+import os
+import pickle
+import threading
+import time
+
+# Timetables materialized per service day: for today and the next few days,
+# only the trips running that day, grouped by route and pattern, with an index
+# of the patterns visiting each stop. Queries for those days only touch that
+# day's trips. The days are persisted in cache/days/<YYYYMMDD>.pkl, stamped
+# with the data version of the route database (see api.get_data_version), so
+# a restart loads them, only replacing the routes written since, instead of
+# building them. A background worker builds
+# the next days shortly before midnight. New views are swapped in with a single
+# assignment, so queries never see a partial one.
+
+day_timetables_dir = os.path.join("cache", "days")
+
+
+@dataclass
+class DayPattern:
+    """The trips of a pattern running on one day, as trips x stops row-major
+    matrices of seconds like api.Pattern
+    """
+    route: api.Route  # without stops or trips
+    direction: str
+    stop_ids: tuple[str, ...]
+    trips: list[api.Trip] = field(default_factory=list)  # without pattern
+    arrivals: array = field(default_factory=lambda: array('i'))
+    departures: array = field(default_factory=lambda: array('i'))
+
+
+@dataclass
+class DayTimetable:
+    day: str
+    # the route database the day was built from, and its data version
+    database_id: str = ""
+    data_version: int = 0
+    # route id -> its patterns with trips running on the day
+    route_patterns: dict[str, list[DayPattern]] = field(default_factory=dict)
+    # stop id -> (pattern, position of the last visit)
+    stop_patterns: dict[str, list[tuple[DayPattern, int]]] = field(default_factory=dict)
+
+    def _index(self, patterns: list[DayPattern]) -> None:
+        for day_pattern in patterns:
+            positions = {stop_id: i for i, stop_id in enumerate(day_pattern.stop_ids)}
+            for stop_id, position in positions.items():
+                self.stop_patterns.setdefault(stop_id, []).append((day_pattern, position))
+
+    def add_route(self, route: api.Route) -> None:
+        patterns = []
+        active: dict[str, bool] = {}
+        header = api.Route(route.id, route.short_name, route.long_name, route.color, route.text_color, fetch=False)
+        for pattern in route.patterns:
+            n = len(pattern.stop_ids)
+            day_pattern = None
+            for trip in pattern.trips:
+                if trip.service_id not in active:
+                    active[trip.service_id] = trip.is_active(self.day)
+                if not active[trip.service_id]:
+                    continue
+                if day_pattern is None:
+                    day_pattern = DayPattern(header, pattern.direction, pattern.stop_ids)
+                    patterns.append(day_pattern)
+                day_pattern.trips.append(api.Trip(trip.trip_id, trip.service_id, trip.calendar, trip.direction))
+                day_pattern.arrivals.extend(pattern.arrivals[trip.row * n:(trip.row + 1) * n])
+                day_pattern.departures.extend(pattern.departures[trip.row * n:(trip.row + 1) * n])
+        if patterns:
+            self.route_patterns[route.id] = patterns
+            self._index(patterns)
+
+    def with_routes(self, routes: list[api.Route]) -> "DayTimetable":
+        """A copy with the trips of the routes replaced by their current ones.
+        The stop lists touched are copied, so self can still be queried
+        meanwhile.
+        """
+        updated = DayTimetable(self.day, self.database_id, self.data_version,
+                               dict(self.route_patterns), dict(self.stop_patterns))
+        old_patterns = [day_pattern for route in routes for day_pattern in updated.route_patterns.pop(route.id, [])]
+        old_ids = {id(day_pattern) for day_pattern in old_patterns}
+        for stop_id in {stop_id for day_pattern in old_patterns for stop_id in day_pattern.stop_ids}:
+            updated.stop_patterns[stop_id] = [entry for entry in updated.stop_patterns[stop_id] if id(entry[0]) not in old_ids]
+        # the lists of the new routes' stops are appended to, so copy them
+        for stop_id in {stop_id for route in routes for stop_id in route.stops}:
+            if stop_id in updated.stop_patterns:
+                updated.stop_patterns[stop_id] = list(updated.stop_patterns[stop_id])
+        for route in routes:
+            updated.add_route(route)
+        return updated
+
+    def get_trips(self, origins: list[api.Stop], destinations: list[api.Stop]) -> list[api.TripAB]:
+        """Same as lib.get_trips_routes_db for this day, sorted by departure"""
+        destinations_at: dict[int, list[tuple[api.Stop, int]]] = {}
+        for destination in destinations:
+            for day_pattern, position in self.stop_patterns.get(destination.id, ()):
+                destinations_at.setdefault(id(day_pattern), []).append((destination, position))
+        tripABs = []
+        for origin in origins:
+            for day_pattern, i in self.stop_patterns.get(origin.id, ()):
+                n = len(day_pattern.stop_ids)
+                for destination, j in destinations_at.get(id(day_pattern), ()):
+                    if j <= i:
+                        continue
+                    departures = day_pattern.departures[i::n]
+                    arrivals = day_pattern.arrivals[j::n]
+                    for trip, origin_time, destination_time in zip(day_pattern.trips, departures, arrivals):
+                        tripABs.append(api.TripAB(origin, destination, origin_time, destination_time, day_pattern.route, trip))
+        tripABs.sort(key=lambda x: x.origin_time)
+        return tripABs
+
+
+# day (YYYYMMDD) -> its timetable, replaced as a whole
+day_timetables: dict[str, DayTimetable] = {}
+_day_timetables_lock = threading.Lock()
+
+
+def _upcoming_days(n_days: int, today: Union[datetime.date, None] = None) -> list[str]:
+    if today is None:
+        today = datetime.date.today()
+    return [(today + datetime.timedelta(days=i)).strftime("%Y%m%d") for i in range(n_days)]
+
+
+def _day_filename(day: str) -> str:
+    return os.path.join(day_timetables_dir, day + ".pkl")
+
+
+def _save_day_timetable(day_timetable: DayTimetable) -> None:
+    os.makedirs(day_timetables_dir, exist_ok=True)
+    filename = _day_filename(day_timetable.day)
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_filename, "wb") as f:
+        pickle.dump(day_timetable, f)
+    os.replace(tmp_filename, filename)
+
+
+def _with_routes_changed_since(day_timetable: DayTimetable, data_version: int) -> DayTimetable:
+    """The day timetable with the routes written since its data version, as
+    of data_version
+    """
+    changed = api.get_routes_changed_since(day_timetable.data_version)
+    print(f"Updating {len(changed)} routes in the day timetable of {day_timetable.day}")
+    day_timetable = day_timetable.with_routes(list(api.get_routes_generator(changed)))
+    day_timetable.data_version = data_version
+    return day_timetable
+
+
+def build_day_timetables(days: list[str]) -> dict[str, DayTimetable]:
+    """Builds the timetables of the given days, in one pass over the routes"""
+    # read first, so that routes written meanwhile are replaced on next load
+    database_id, data_version = api.get_data_version()
+    built = {day: DayTimetable(day, database_id, data_version) for day in days}
+    for route in api.get_all_routes_generator():
+        for day_timetable in built.values():
+            day_timetable.add_route(route)
+    return built
+
+
+def find_or_build_day_timetables(n_days: int = 3, today: Union[datetime.date, None] = None) -> dict[str, DayTimetable]:
+    """Loads (or builds and saves) the timetables of today and the next days,
+    and makes them the ones queried. Saved days get the routes written since
+    they were saved, those of another route database are rebuilt, and past
+    ones are removed. Routes written while they are loaded or built are
+    applied to them before the swap, under the lock taken by _on_route_updated,
+    so the swap doesn't undo the updates made meanwhile.
+    """
+    global day_timetables
+    api.find_or_build_route_db()
+    days = _upcoming_days(n_days, today)
+    database_id, data_version = api.get_data_version()
+    loaded = {}
+    for day in days:
+        if day in day_timetables:
+            loaded[day] = day_timetables[day]
+        elif os.path.exists(_day_filename(day)):
+            with open(_day_filename(day), "rb") as f:
+                day_timetable = pickle.load(f)
+            if day_timetable.database_id != database_id:
+                continue
+            if day_timetable.data_version < data_version:
+                day_timetable = _with_routes_changed_since(day_timetable, data_version)
+                _save_day_timetable(day_timetable)
+            loaded[day] = day_timetable
+    missing = [day for day in days if day not in loaded]
+    if missing:
+        print(f"Building day timetables for {', '.join(missing)}")
+        for day_timetable in build_day_timetables(missing).values():
+            _save_day_timetable(day_timetable)
+            loaded[day_timetable.day] = day_timetable
+    updated = []
+    with _day_timetables_lock:
+        _, data_version = api.get_data_version()
+        for day, day_timetable in loaded.items():
+            if day_timetable.data_version < data_version:
+                loaded[day] = _with_routes_changed_since(day_timetable, data_version)
+                updated.append(loaded[day])
+        day_timetables = loaded
+    for day_timetable in updated:
+        _save_day_timetable(day_timetable)
+    if os.path.isdir(day_timetables_dir):
+        for filename in os.listdir(day_timetables_dir):
+            if filename.endswith(".pkl") and filename[:-len(".pkl")] < days[0]:
+                os.remove(os.path.join(day_timetables_dir, filename))
+    return day_timetables
+
+
+def get_trips_materialized(origins: list[api.Stop], destinations: list[api.Stop], day: str) -> list[api.TripAB]:
+    """Same as lib.get_trips_routes_db, sorted by departure, using the
+    materialized timetable of the day if there is one
+    """
+    day_timetable = day_timetables.get(day)
+    if day_timetable is None:
+        from . import lib
+        return sorted(lib.get_trips_routes_db(origins, destinations, day), key=lambda x: x.origin_time)
+    return day_timetable.get_trips(origins, destinations)
+
+
+def _on_route_updated(old_route: api.Route, new_route: api.Route) -> None:
+    """Replaces (and saves) the days on which the route runs, before or after
+    the update. The other days don't change, as the route has no trips on
+    them.
+    """
+    global day_timetables
+    _, data_version = api.get_data_version()
+    changed = []
+    with _day_timetables_lock:
+        updated = dict(day_timetables)
+        for day, day_timetable in day_timetables.items():
+            new_day_timetable = day_timetable.with_routes([new_route])
+            if new_route.id in day_timetable.route_patterns or new_route.id in new_day_timetable.route_patterns:
+                new_day_timetable.data_version = data_version
+                updated[day] = new_day_timetable
+                changed.append(new_day_timetable)
+        day_timetables = updated
+    for day_timetable in changed:
+        _save_day_timetable(day_timetable)
+
+api.route_update_listeners.append(_on_route_updated)
+
+
+def start_day_timetable_worker(n_days: int = 3, lead_seconds: int = 15 * 60) -> threading.Thread:
+    """Starts a thread which, lead_seconds before each midnight, builds the
+    timetable of the day entering the window of n_days and swaps it in. Today
+    is kept until the next swap.
+    """
+    def worker():
+        while True:
+            now = datetime.datetime.now()
+            midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+            wait = (midnight - now).total_seconds() - lead_seconds
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                find_or_build_day_timetables(n_days + 1, now.date())
+            except Exception as e:
+                print(f"Error building day timetables: {e}")
+            # past the lead time, wait for the next day
+            time.sleep(max((midnight - datetime.datetime.now()).total_seconds(), 0) + 1)
+
+    prewarmer = threading.Thread(target=worker, daemon=True)
+    prewarmer.start()
+    return prewarmer
@@ -0,0 +1,64 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+# Connections to a SQLite database file: each thread reuses its own read
+# connection, and all the writes go through a single writer connection, one
+# transaction at a time. The file is in WAL mode, so readers see the last
+# committed state while the writer works, and neither blocks the other.
+# Connections are reused, so the statements cached by sqlite3 for each
+# connection are prepared only once. Connections aren't shared with forked
+# processes (e.g. pool workers), which open their own.
+
+
+class Database:
+    def __init__(self, filename: os.PathLike, mmap_size: int = 256 * 2**20, cache_size_kib: int = 64 * 2**10,
+                 timeout: float = 30):
+        self.filename = filename
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writer: sqlite3.Connection = None
+        self._writer_pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.filename, timeout=self.timeout, check_same_thread=False, cached_statements=256)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        connection.execute(f"PRAGMA cache_size = {-self.cache_size_kib}")
+        return connection
+
+    def reader(self) -> sqlite3.Connection:
+        """The read connection of the calling thread"""
+        local = self._local
+        if getattr(local, "connection", None) is None or local.pid != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+        return local.connection
+
+    @contextlib.contextmanager
+    def writer(self):
+        """The writer connection, for one transaction, committed on exit (or
+        rolled back on an exception). Writers are serialized.
+        """
+        with self._lock:
+            if self._writer is None or self._writer_pid != os.getpid():
+                self._writer = self._connect()
+                self._writer_pid = os.getpid()
+            with self._writer:
+                yield self._writer
+
+    def close(self) -> None:
+        """Closes the writer, and makes every thread open a new read
+        connection, e.g. before the file is removed. Read connections are
+        closed by the garbage collector once replaced.
+        """
+        with self._lock:
+            if self._writer is not None and self._writer_pid == os.getpid():
+                self._writer.close()
+            self._writer = None
+            self._local = threading.local()
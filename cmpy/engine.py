@@ -0,0 +1,182 @@
+from . import api
+from . import lib
+from typing import Union
+import atexit
+import heapq
+import multiprocessing
+import os
+import threading
+import zlib
+
+# Parallel execution of get_trips_routes_db: the routes are split in shards by
+# a hash of their id, and each shard is kept loaded by its own long lived
+# process. A query sends each shard only its routes serving an origin and a
+# destination (found with the stop -> route index), the shards run at the same
+# time and return their trips sorted by departure, and the sorted lists are
+# merged. Queries with few candidate routes are run in-process, as sending
+# them to the workers would cost more than it saves.
+# Only plain tuples are sent back by the workers, so the returned trips have
+# no pattern (so no schedule), only their id, service and direction.
+
+
+def _shard_worker(connection, routes_database_file: str, route_ids: list[str]) -> None:
+    api.routes_database_file = routes_database_file
+    routes = {route.id: route for route in api.get_routes_generator(route_ids)}
+    connection.send(len(routes))
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        kind, *args = message
+        if kind == "query":
+            connection.send(_query_shard(routes, *args))
+        elif kind == "reload":
+            route = api.get_route(args[0])
+            if route is not None:
+                routes[route.id] = route
+    connection.close()
+
+
+def _query_shard(routes: dict[str, api.Route], route_ids: list[str], origin_ids: list[str], destination_ids: list[str], day: str):
+    """Returns the trips of the given routes, sorted by departure, as
+    (departure seconds, arrival seconds, origin index, destination index,
+    route id, trip id, service id, direction), and the headers of the routes
+    and the calendars of the services in them.
+    """
+    # placeholder stops, mapped back to the indexes of the caller's stops
+    origins = [api.Stop(stop_id, "", "", "") for stop_id in origin_ids]
+    destinations = [api.Stop(stop_id, "", "", "") for stop_id in destination_ids]
+    positions = {id(stop): i for i, stop in enumerate(origins)}
+    positions.update({id(stop): i for i, stop in enumerate(destinations)})
+    trips = []
+    headers = {}
+    calendars = {}
+    for route_id in route_ids:
+        route = routes.get(route_id)
+        if route is None:
+            continue
+        headers[route.id] = (route.id, route.short_name, route.long_name, route.color, route.text_color)
+        for tripAB in lib._get_route_trips(route, origins, destinations, day):
+            trip = tripAB.trip
+            calendars[trip.service_id] = (trip.calendar.start, trip.calendar.bits)
+            trips.append((tripAB.origin_time, tripAB.destination_time,
+                          positions[id(tripAB.origin_stop)], positions[id(tripAB.destination_stop)],
+                          route.id, trip.trip_id, trip.service_id, trip.direction))
+    trips.sort(key=lambda trip: trip[0])
+    return trips, headers, calendars
+
+
+class QueryEngine:
+    """Pool of n_workers shard processes answering get_trips queries. Queries
+    with fewer than threshold candidate routes are run in-process.
+    """
+
+    def __init__(self, n_workers: Union[int, None] = None, threshold: int = 16):
+        api.find_or_build_route_db()
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.threshold = threshold
+        route_ids = [route_id for (route_id,) in api._get_routes_db().reader().execute("SELECT id FROM routes")]
+        shards = [[] for _ in range(self.n_workers)]
+        for route_id in route_ids:
+            shards[self._shard(route_id)].append(route_id)
+        self.connections = []
+        self.processes = []
+        self.locks = [threading.Lock() for _ in range(self.n_workers)]
+        for shard in shards:
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child, api.routes_database_file, shard), daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        loaded = sum(connection.recv() for connection in self.connections)
+        print(f"Query engine started: {loaded} routes in {self.n_workers} shards")
+        self._routes: dict[str, api.Route] = {}
+        api.route_update_listeners.append(self._on_route_updated)
+
+    def _shard(self, route_id: str) -> int:
+        return zlib.crc32(route_id.encode()) % self.n_workers
+
+    def _route(self, header: tuple[str, str, str, str, str]) -> api.Route:
+        """The route, without stops or trips"""
+        route = self._routes.get(header[0])
+        if route is None or (route.id, route.short_name, route.long_name, route.color, route.text_color) != header:
+            route = self._routes[header[0]] = api.Route(*header, fetch=False)
+        return route
+
+    def _on_route_updated(self, old_route: api.Route, new_route: api.Route) -> None:
+        shard = self._shard(new_route.id)
+        with self.locks[shard]:
+            self.connections[shard].send(("reload", new_route.id))
+
+    def get_trips(self, origins: list[api.Stop], destinations: list[api.Stop], day: str) -> list[api.TripAB]:
+        """Same trips as lib.get_trips_routes_db, sorted by departure"""
+        route_ids = api.get_route_ids_serving(origins, destinations)
+        if len(route_ids) < self.threshold:
+            tripABs = []
+            for route in api.get_routes_generator(route_ids):
+                tripABs.extend(lib._get_route_trips(route, origins, destinations, day))
+            tripABs.sort(key=lambda x: x.origin_time)
+            return tripABs
+
+        shard_route_ids: dict[int, list[str]] = {}
+        for route_id in route_ids:
+            shard_route_ids.setdefault(self._shard(route_id), []).append(route_id)
+        origin_ids = [origin.id for origin in origins]
+        destination_ids = [destination.id for destination in destinations]
+        # locks taken in shard order, so concurrent queries can't deadlock
+        shards = sorted(shard_route_ids)
+        for shard in shards:
+            self.locks[shard].acquire()
+        try:
+            for shard in shards:
+                self.connections[shard].send(("query", shard_route_ids[shard], origin_ids, destination_ids, day))
+            replies = [self.connections[shard].recv() for shard in shards]
+        finally:
+            for shard in shards:
+                self.locks[shard].release()
+
+        calendars = {}
+        for _, headers, shard_calendars in replies:
+            for route_header in headers.values():
+                self._route(route_header)
+            for service_id, (start, bits) in shard_calendars.items():
+                calendars[service_id] = api._intern_calendar(service_id, start, bits)
+        return [
+            api.TripAB(origins[origin], destinations[destination], departure, arrival,
+                       self._routes[route_id], api.Trip(trip_id, service_id, calendars[service_id], direction))
+            for departure, arrival, origin, destination, route_id, trip_id, service_id, direction
+            in heapq.merge(*(trips for trips, _, _ in replies), key=lambda trip: trip[0])
+        ]
+
+    def close(self) -> None:
+        if self._on_route_updated in api.route_update_listeners:
+            api.route_update_listeners.remove(self._on_route_updated)
+        for lock, connection in zip(self.locks, self.connections):
+            with lock:
+                try:
+                    connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+                connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+
+
+query_engine = None
+
+
+def start_query_engine(n_workers: Union[int, None] = None, threshold: int = 16) -> QueryEngine:
+    """Starts the shared query engine, if it isn't running yet"""
+    global query_engine
+    if query_engine is None:
+        query_engine = QueryEngine(n_workers, threshold)
+        atexit.register(query_engine.close)
+    return query_engine
+
+
+def get_trips_parallel(origins: list[api.Stop], destinations: list[api.Stop], day: str) -> list[api.TripAB]:
+    """Same as lib.get_trips_routes_db, sorted by departure, run by the query
+    engine (started with the default settings if needed)
+    """
+    return start_query_engine().get_trips(origins, destinations, day)
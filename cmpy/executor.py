@@ -0,0 +1,75 @@
+from typing import Any, Callable, Hashable, Union
+import concurrent.futures
+import threading
+
+# Runs queries on a bounded pool of threads, off the request threads:
+# - identical queries (same key) running at the same time share one
+#   computation (single flight)
+# - at most max_pending queries are running or queued, further ones are
+#   rejected with QueueFullError instead of piling up
+# - callers wait at most timeout seconds. A query whose callers gave up keeps
+#   running, so its result still reaches any cache it fills
+
+
+class QueueFullError(Exception):
+    """Raised when a query is submitted while max_pending are pending"""
+
+
+class QueryExecutor:
+    def __init__(self, max_workers: int = 4, max_pending: int = 32):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="query")
+        self.max_pending = max_pending
+        self.in_flight: dict[Hashable, concurrent.futures.Future] = {}
+        # reentrant, as a done callback runs at once if the future is done
+        self.lock = threading.RLock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _done(self, key: Hashable, future: concurrent.futures.Future) -> None:
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    def submit(self, key: Hashable, fn: Callable[[], Any]) -> concurrent.futures.Future:
+        """Returns the future of the running query with this key, or runs
+        fn() as that query
+        """
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self.in_flight) >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError(f"{len(self.in_flight)} queries pending")
+            future = self.in_flight[key] = self.executor.submit(fn)
+            self.submitted += 1
+            future.add_done_callback(lambda future: self._done(key, future))
+        return future
+
+    def run(self, key: Hashable, fn: Callable[[], Any], timeout: Union[float, None] = None) -> Any:
+        """Same as submit, waiting for the result. Raises QueueFullError, or
+        concurrent.futures.TimeoutError after timeout seconds.
+        """
+        future = self.submit(key, fn)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "pending": len(self.in_flight),
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,324 @@
+from . import api
+from . import daily
+from .spatial import haversine
+from array import array
+from dataclasses import dataclass
+from typing import Union
+import bisect
+import collections
+import threading
+
+# Journey planning with the Connection Scan Algorithm (CSA). The timetable of
+# a day (see cmpy.daily) is flattened into connections, one per vehicle going
+# from a stop to the next, stored as parallel arrays sorted by departure. The
+# earliest arrivals from the origins are found in a single scan of the
+# connections departing after the departure time, in rounds: round r holds
+# the arrivals using exactly r trips, so journeys with up to max_transfers
+# changes come out of the same scan. Changes are at the same stop, or walking
+# to a nearby stop of the same name (usually the other way's stop).
+
+INFINITY = 2**31 - 1
+
+
+@dataclass
+class Walk:
+    origin_stop: api.Stop
+    destination_stop: api.Stop
+    # seconds since the start of the service day, see seconds_to_time
+    origin_time: int
+    destination_time: int
+
+
+@dataclass
+class Journey:
+    legs: list[Union[api.TripAB, Walk]]
+
+    @property
+    def departure_time(self) -> int:
+        return self.legs[0].origin_time
+
+    @property
+    def arrival_time(self) -> int:
+        return self.legs[-1].destination_time
+
+    @property
+    def transfers(self) -> int:
+        return sum(isinstance(leg, api.TripAB) for leg in self.legs) - 1
+
+
+class Connections:
+    """The connections of a day timetable, sorted by departure, as parallel
+    arrays. Stops are indexes in stop_ids, and trips indexes in trips, as
+    (pattern, row). walks[stop] lists (stop, seconds) of the walking
+    transfers from it.
+    """
+
+    def __init__(self, day_timetable: daily.DayTimetable, walks: dict[str, list[tuple[str, int]]]):
+        self.day = day_timetable.day
+        self.day_timetable = day_timetable
+        self.stop_ids: list[str] = []
+        self.stop_indexes: dict[str, int] = {}
+        self.trips: list[tuple[daily.DayPattern, int]] = []
+        # (departure, arrival, trip, position, departure stop, arrival stop),
+        # the position keeping the connections of a trip in order
+        found = []
+        for patterns in day_timetable.route_patterns.values():
+            for day_pattern in patterns:
+                stops = [self._stop_index(stop_id) for stop_id in day_pattern.stop_ids]
+                n = len(stops)
+                for row in range(len(day_pattern.trips)):
+                    trip = len(self.trips)
+                    self.trips.append((day_pattern, row))
+                    departures = day_pattern.departures[row * n:(row + 1) * n]
+                    arrivals = day_pattern.arrivals[row * n:(row + 1) * n]
+                    for k in range(n - 1):
+                        found.append((departures[k], arrivals[k + 1], trip, k, stops[k], stops[k + 1]))
+        found.sort()
+        self.departure_times = array('i', (connection[0] for connection in found))
+        self.arrival_times = array('i', (connection[1] for connection in found))
+        self.connection_trips = array('i', (connection[2] for connection in found))
+        self.departure_stops = array('i', (connection[4] for connection in found))
+        self.arrival_stops = array('i', (connection[5] for connection in found))
+        self.walks: list[list[tuple[int, int]]] = [
+            [(self.stop_indexes[to_id], seconds) for to_id, seconds in walks.get(stop_id, ()) if to_id in self.stop_indexes]
+            for stop_id in self.stop_ids
+        ]
+
+    def _stop_index(self, stop_id: str) -> int:
+        index = self.stop_indexes.get(stop_id)
+        if index is None:
+            index = self.stop_indexes[stop_id] = len(self.stop_ids)
+            self.stop_ids.append(stop_id)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.departure_times)
+
+
+@dataclass
+class _Scan:
+    """Result of a connection scan, by round: the arrival at each stop by
+    trip (or as an origin in round 0) and the connection it came with, the
+    arrival at each stop counting the walks and the stop walked from (-1 if
+    not walked), and the connection where each trip was boarded
+    """
+    trip_arrivals: list[list[int]]
+    via_connection: list[list[int]]
+    arrivals: list[list[int]]
+    via_walk: list[list[int]]
+    boarded: list[list[int]]
+
+
+class JourneyPlanner:
+    """Plans journeys over the day timetables. The stops give the names and
+    coordinates for the walking transfers, which are between stops of the
+    same name at most max_walk_m apart. The connections of a day are built on
+    its first query, and those of the last max_days days queried are kept.
+    """
+
+    def __init__(self, stops: list[api.Stop], max_walk_m: float = 500.0, walking_speed: float = 1.2,
+                 min_transfer_seconds: int = 60, max_days: int = 4):
+        self.stops_by_id: dict[str, api.Stop] = {}
+        groups: dict[str, list[api.Stop]] = {}
+        for stop in stops:
+            if stop.id not in self.stops_by_id:
+                self.stops_by_id[stop.id] = stop
+                groups.setdefault(stop.name, []).append(stop)
+        self.walks: dict[str, list[tuple[str, int]]] = {}
+        for group in groups.values():
+            for a in group:
+                for b in group:
+                    if a.id == b.id:
+                        continue
+                    try:
+                        distance = haversine(float(a.lat), float(a.lon), float(b.lat), float(b.lon))
+                    except (TypeError, ValueError):
+                        distance = 0.0  # stop without coordinates
+                    if distance <= max_walk_m:
+                        seconds = max(min_transfer_seconds, round(distance / walking_speed))
+                        self.walks.setdefault(a.id, []).append((b.id, seconds))
+        self.max_days = max_days
+        self._connections: collections.OrderedDict[str, Connections] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by each route update, so that connections built from the
+        # routes before an update aren't kept after it
+        self._version = 0
+        api.route_update_listeners.append(self._on_route_updated)
+
+    def _on_route_updated(self, old_route: api.Route, new_route: api.Route) -> None:
+        # materialized days are replaced by daily's listener, and noticed by
+        # identity, the others are rebuilt
+        with self._lock:
+            self._version += 1
+            for day in [day for day, connections in self._connections.items()
+                        if connections.day_timetable is not daily.day_timetables.get(day)]:
+                del self._connections[day]
+
+    def connections(self, day: str) -> Connections:
+        """The connections of the day (YYYYMMDD), from its materialized
+        timetable if there is one. They are built without the lock, so the
+        queries of the days already built don't wait for it.
+        """
+        day_timetable = daily.day_timetables.get(day)
+        with self._lock:
+            connections = self._connections.get(day)
+            if connections is not None and (day_timetable is None or connections.day_timetable is day_timetable):
+                self._connections.move_to_end(day)
+                return connections
+            version = self._version
+        if day_timetable is None:
+            print(f"Building the timetable of {day} for journeys")
+            day_timetable = daily.build_day_timetables([day])[day]
+        connections = Connections(day_timetable, self.walks)
+        with self._lock:
+            if version == self._version:
+                self._connections[day] = connections
+                self._connections.move_to_end(day)
+                while len(self._connections) > self.max_days:
+                    self._connections.popitem(last=False)
+        return connections
+
+    def _stop(self, stop_id: str) -> api.Stop:
+        stop = self.stops_by_id.get(stop_id)
+        if stop is None:
+            stop = api.Stop(stop_id, "", "", "")
+        return stop
+
+    def _scan(self, connections: Connections, origins: list[api.Stop], departure: int, rounds: int,
+              destinations: list[api.Stop] = (), end: int = INFINITY) -> _Scan:
+        """Scans the connections departing from departure to end, for up to
+        rounds trips. With destinations, stops at the arrival of the first
+        direct journey, as any later connection arrives after it.
+        """
+        if rounds < 1:
+            raise ValueError("max_transfers must not be negative")
+        n_stops = len(connections.stop_ids)
+        # walks only start from trip arrivals, which they never replace, so
+        # the stop a walk starts from keeps its trip
+        trip_arrivals = [[INFINITY] * n_stops for _ in range(rounds + 1)]
+        via_connection = [[-1] * n_stops for _ in range(rounds + 1)]
+        arrivals = [[INFINITY] * n_stops for _ in range(rounds + 1)]
+        via_walk = [[-1] * n_stops for _ in range(rounds + 1)]
+        boarded = [[-1] * len(connections.trips) for _ in range(rounds + 1)]
+        walks = connections.walks
+        # earliest arrival over the rounds a trip can be boarded from, and the
+        # trips boarded in any round, to skip most connections at once
+        reached = [INFINITY] * n_stops
+        boarded_any = bytearray(len(connections.trips))
+
+        origin_indexes = [connections.stop_indexes[stop.id] for stop in origins if stop.id in connections.stop_indexes]
+        for s in origin_indexes:
+            trip_arrivals[0][s] = arrivals[0][s] = reached[s] = departure
+        for s in origin_indexes:
+            for t, seconds in walks[s]:
+                if departure + seconds < arrivals[0][t]:
+                    arrivals[0][t] = reached[t] = departure + seconds
+                    via_walk[0][t] = s
+        targets = {connections.stop_indexes[stop.id] for stop in destinations if stop.id in connections.stop_indexes}
+
+        first = bisect.bisect_left(connections.departure_times, departure)
+        last = bisect.bisect_right(connections.departure_times, end)
+        for c, dep_stop, arr_stop, dep_time, arr_time, trip in zip(
+                range(first, last),
+                connections.departure_stops[first:last], connections.arrival_stops[first:last],
+                connections.departure_times[first:last], connections.arrival_times[first:last],
+                connections.connection_trips[first:last]):
+            if dep_time > end:
+                break
+            if not boarded_any[trip] and reached[dep_stop] > dep_time:
+                continue
+            for r in range(1, rounds + 1):
+                board = boarded[r]
+                if board[trip] < 0:
+                    if arrivals[r - 1][dep_stop] > dep_time:
+                        continue
+                    board[trip] = c
+                    boarded_any[trip] = 1
+                if arr_time >= trip_arrivals[r][arr_stop]:
+                    continue
+                trip_arrivals[r][arr_stop] = arr_time
+                via_connection[r][arr_stop] = c
+                arrival = arrivals[r]
+                if arr_time < arrival[arr_stop]:
+                    arrival[arr_stop] = arr_time
+                    via_walk[r][arr_stop] = -1
+                if r < rounds and arr_time < reached[arr_stop]:
+                    reached[arr_stop] = arr_time
+                for t, seconds in walks[arr_stop]:
+                    if arr_time + seconds < arrival[t]:
+                        arrival[t] = arr_time + seconds
+                        via_walk[r][t] = arr_stop
+                        if r < rounds and arr_time + seconds < reached[t]:
+                            reached[t] = arr_time + seconds
+                if r == 1 and arr_stop in targets and arr_time < end:
+                    end = arr_time
+        return _Scan(trip_arrivals, via_connection, arrivals, via_walk, boarded)
+
+    def _journey(self, connections: Connections, scan: _Scan, r: int, s: int) -> Journey:
+        """The journey of round r to stop s, followed back to the origin"""
+        legs = []
+        while True:
+            w = scan.via_walk[r][s]
+            if w >= 0:
+                legs.append(Walk(self._stop(connections.stop_ids[w]), self._stop(connections.stop_ids[s]),
+                                 scan.trip_arrivals[r][w], scan.arrivals[r][s]))
+                s = w
+            if r == 0:
+                assert scan.trip_arrivals[0][s] != INFINITY, "journey not starting at an origin"
+                break
+            c = scan.via_connection[r][s]
+            assert c >= 0, f"stop {connections.stop_ids[s]} not reached by a trip in round {r}"
+            trip = connections.connection_trips[c]
+            b = scan.boarded[r][trip]
+            day_pattern, row = connections.trips[trip]
+            legs.append(api.TripAB(self._stop(connections.stop_ids[connections.departure_stops[b]]),
+                                   self._stop(connections.stop_ids[s]),
+                                   connections.departure_times[b], connections.arrival_times[c],
+                                   day_pattern.route, day_pattern.trips[row]))
+            s = connections.departure_stops[b]
+            r -= 1
+        legs.reverse()
+        return Journey(legs)
+
+    def journeys(self, origins: list[api.Stop], destinations: list[api.Stop], day: str, departure: int,
+                 max_transfers: int = 1, max_duration: int = 3 * 60 * 60) -> list[Journey]:
+        """Journeys leaving any of the origins at or after departure (seconds)
+        on the day (YYYYMMDD) for any of the destinations, with at most
+        max_transfers changes: the earliest arrival with no change, and with
+        each more change only if it arrives earlier. Journeys arriving more
+        than max_duration after departure aren't looked for.
+        """
+        connections = self.connections(day)
+        rounds = max_transfers + 1
+        scan = self._scan(connections, origins, departure, rounds, destinations, departure + max_duration)
+        targets = [connections.stop_indexes[stop.id] for stop in destinations if stop.id in connections.stop_indexes]
+        found = []
+        best = departure + max_duration + 1
+        for r in range(1, rounds + 1):
+            arrival, s = min(((scan.arrivals[r][t], t) for t in targets), default=(INFINITY, -1))
+            if arrival < best:
+                best = arrival
+                found.append(self._journey(connections, scan, r, s))
+        return found
+
+    def earliest_arrivals(self, origins: list[api.Stop], day: str, departure: int, max_transfers: int = 2,
+                          max_duration: int = 3 * 60 * 60) -> tuple[list[str], array]:
+        """Earliest arrival (seconds, or INFINITY) at every stop leaving any
+        of the origins at or after departure on the day (YYYYMMDD), with at
+        most max_transfers changes, from one scan of the connections
+        departing within max_duration. Returns the stop ids, and the arrivals
+        in the same order.
+        """
+        connections = self.connections(day)
+        scan = self._scan(connections, origins, departure, max_transfers + 1, end=departure + max_duration)
+        return connections.stop_ids, array('i', map(min, *scan.arrivals))
+
+    def reachable(self, origins: list[api.Stop], day: str, departure: int, max_duration: int = 45 * 60,
+                  max_transfers: int = 2) -> list[tuple[api.Stop, int]]:
+        """Stops reachable from the origins within max_duration seconds of
+        departure, as (stop, arrival seconds), earliest first
+        """
+        stop_ids, arrivals = self.earliest_arrivals(origins, day, departure, max_transfers, max_duration)
+        end = departure + max_duration
+        reached = sorted((arrival, i) for i, arrival in enumerate(arrivals) if arrival <= end)
+        return [(self._stop(stop_ids[i]), arrival) for arrival, i in reached]
@@ -2,6 +2,7 @@ from . import api
 from typing import Union
 import pickle
 import os
+import datetime
 from dataclasses import dataclass, asdict
 
 
@@ -101,22 +102,20 @@ def get_all_stops(cache_dir="cache") -> list[api.Stop]:
         with open(cache_file, "rb") as f:
             stops = pickle.load(f)
     else:
-        stops = []
-        i = 0
-        j = 0
-        rt_i = 0
+        # stops are equal when their ids are, so a dict keyed by id dedupes
+        # them in linear time, keeping the first one seen
+        stops_by_id: dict[str, api.Stop] = {}
         routes = api.get_all_routes()
+        api.prefetch_routes([route.short_name for route in routes])
         rt_n = len(routes)
-        for route in routes:
-            rt_i += 1
-            # accessing route.stops will populate the stops dicts, so doing it
-            # in parallel is faster (TODO)
+        for rt_i, route in enumerate(routes, 1):
             for stop in route.stops.values():
-                if stop not in stops:
-                    stops.append(stop)
-                    j += 1
-                i += 1
-                print(f"{i: 05d} stops processed, {j: 05d} unique stops found ({rt_i: 03d}/{rt_n: 03d} routes processed)")
+                stops_by_id.setdefault(stop.id, stop)
+            # only the stops are needed, don't keep the trips of every route
+            route.release()
+            print(f"{rt_i: 03d}/{rt_n: 03d} routes processed, {len(stops_by_id): 05d} unique stops found")
+        stops = list(stops_by_id.values())
+        os.makedirs(cache_dir, exist_ok=True)
         with open(cache_file, "wb") as f:
             pickle.dump(stops, f)
     return stops
@@ -126,17 +125,48 @@ def get_trips_with_origin_before_destination(origins: list[api.Stop], destinatio
     """
     trips = []
     for route in routes:
+        for pattern in route.patterns:
+            for origin in origins:
+                for destination in destinations:
+                    # checked once for all the trips sharing the pattern
+                    if pattern.in_sequence(origin.id, destination.id):
+                        trips.extend(pattern.trips)
+    return trips
+
+
+def _get_route_trips_days(route: api.Route, origins: list[api.Stop], destinations: list[api.Stop], days: list[str]) -> dict[str, list[api.TripAB]]:
+    """Returns the tripABs of a route for each of the given days, which
+    contain an origin stop before a destination stop. The order of the stops
+    is checked once per pattern, the times of all its trips are taken in one
+    slice, and the days each service runs are found once.
+    """
+    tripABs: dict[str, list[api.TripAB]] = {day: [] for day in days}
+    active_days: dict[str, list[str]] = {}
+    for pattern in route.patterns:
         for origin in origins:
-            if not route.has_stop(origin):
+            i = pattern.stop_index.get(origin.id)
+            if i is None:
                 continue
             for destination in destinations:
-                if not route.has_stop(destination):
+                j = pattern.stop_index.get(destination.id)
+                if j is None or j <= i:
                     continue
-                # check if there is a trip where the origin stop is before the destination stop
-                for trip in route.trips:
-                    if trip.in_sequence(origin, destination):
-                        trips.append(trip)
-    return trips
+                departures = pattern.departure_times(i)
+                arrivals = pattern.arrival_times(j)
+                for trip, origin_time, destination_time in zip(pattern.trips, departures, arrivals):
+                    trip_days = active_days.get(trip.service_id)
+                    if trip_days is None:
+                        trip_days = active_days[trip.service_id] = [day for day in days if trip.is_active(day)]
+                    for day in trip_days:
+                        tripABs[day].append(api.TripAB(origin, destination, origin_time, destination_time, route, trip))
+    return tripABs
+
+
+def _get_route_trips(route: api.Route, origins: list[api.Stop], destinations: list[api.Stop], day: str) -> list[api.TripAB]:
+    """Returns the tripABs of a route for a given day, which contain an origin
+    stop before a destination stop.
+    """
+    return _get_route_trips_days(route, origins, destinations, [day])[day]
 
 
 def get_trips(origins: list[api.Stop], destinations: list[api.Stop], routes: list[api.Route], day: str) -> list[api.TripAB]:
@@ -145,21 +175,9 @@ def get_trips(origins: list[api.Stop], destinations: list[api.Stop], routes: lis
     """
     tripABs = []
     for route in routes:
-        for origin in origins:
-            if not route.has_stop(origin):
-                continue
-            for destination in destinations:
-                if not route.has_stop(destination):
-                    continue
-                for trip in route.trips:
-                    if day not in trip.dates:
-                        continue
-                    if trip.in_sequence(origin, destination):
-                        origin_time = trip.schedule[origin.id].departure_time
-                        destination_time = trip.schedule[destination.id].arrival_time
-                        tripABs.append(api.TripAB(origin, destination, origin_time, destination_time, route, trip))
+        tripABs.extend(_get_route_trips(route, origins, destinations, day))
 
-    tripABs.sort(key=lambda x: int(x.origin_time.split(':')[0])*60*60 + int(x.origin_time.split(':')[1])*60 + int(x.origin_time.split(':')[2]) )
+    tripABs.sort(key=lambda x: x.origin_time)
     return tripABs
 
 def get_trips_light(origins: list[api.Stop], destinations: list[api.Stop], day: str) -> list[api.TripAB]:
@@ -168,21 +186,9 @@ def get_trips_light(origins: list[api.Stop], destinations: list[api.Stop], day:
     for route in api.get_all_routes_generator():
         i+=1
         print(f"Processing route {i}")
-        for origin in origins:
-            if not route.has_stop(origin):
-                continue
-            for destination in destinations:
-                if not route.has_stop(destination):
-                    continue
-                for trip in route.trips:
-                    if day not in trip.dates:
-                        continue
-                    if trip.in_sequence(origin, destination):
-                        origin_time = trip.schedule[origin.id].departure_time
-                        destination_time = trip.schedule[destination.id].arrival_time
-                        tripABs.append(api.TripAB(origin, destination, origin_time, destination_time, route, trip))
+        tripABs.extend(_get_route_trips(route, origins, destinations, day))
 
-    tripABs.sort(key=lambda x: int(x.origin_time.split(':')[0])*60*60 + int(x.origin_time.split(':')[1])*60 + int(x.origin_time.split(':')[2]) )
+    tripABs.sort(key=lambda x: x.origin_time)
     return tripABs
 
 db = None
@@ -190,33 +196,110 @@ def get_trips_routes_db(origins: list[api.Stop], destinations: list[api.Stop], d
     """This is the most efficient implementation. The first time it is called,
     it will take a long time to build the database, but subsequent calls will be
     fast.
-    The database stores all the routes, and nothing else.
+    The database stores all the routes, and an index of the routes serving each
+    stop, so only the routes serving both an origin and a destination are
+    unpickled.
     It uses the fact that routes are static and pickleable.
     """
     tripABs = []
-    for route in api.get_all_routes_generator():
-        for origin in origins:
-            if not route.has_stop(origin):
-                continue
-            for destination in destinations:
-                if not route.has_stop(destination):
+    for route in api.get_routes_serving_generator(origins, destinations):
+        tripABs.extend(_get_route_trips(route, origins, destinations, day))
+    return tripABs
+
+def _days(days: Union[str, tuple[str, str]]) -> list[str]:
+    """A day (YYYYMMDD), or all the days of an inclusive (first, last) range"""
+    if isinstance(days, str):
+        return [days]
+    first, last = (datetime.datetime.strptime(day, "%Y%m%d").date() for day in days)
+    if last < first:
+        raise ValueError(f"range of days from {days[0]} to {days[1]} is reversed")
+    return [(first + datetime.timedelta(days=i)).strftime("%Y%m%d") for i in range((last - first).days + 1)]
+
+def get_trips_batch(queries: list[tuple[list[api.Stop], list[api.Stop], Union[str, tuple[str, str]]]]) -> list[dict[str, list[api.TripAB]]]:
+    """Answers several get_trips_routes_db queries at once. Each query is
+    (origins, destinations, day or inclusive (first day, last day) range).
+    Every route serving any of the queries is unpickled once, and the trips of
+    each route are checked for all its queries and days in one pass.
+    Returns, for each query, the tripABs of each day sorted by departure.
+    """
+    queries = [(origins, destinations, _days(days)) for origins, destinations, days in queries]
+    route_queries: dict[str, list[int]] = {}
+    for q, (origins, destinations, _) in enumerate(queries):
+        for route_id in api.get_route_ids_serving(origins, destinations):
+            route_queries.setdefault(route_id, []).append(q)
+
+    results: list[dict[str, list[api.TripAB]]] = [{day: [] for day in days} for _, _, days in queries]
+    for route in api.get_routes_generator(list(route_queries)):
+        for q in route_queries[route.id]:
+            origins, destinations, days = queries[q]
+            for day, tripABs in _get_route_trips_days(route, origins, destinations, days).items():
+                results[q][day].extend(tripABs)
+    for result in results:
+        for tripABs in result.values():
+            tripABs.sort(key=lambda x: x.origin_time)
+    return results
+
+def get_trips_page(origins: list[api.Stop], destinations: list[api.Stop], days: Union[str, tuple[str, str]],
+                   departure_window: Union[tuple[str, str], None] = None, page: int = 0,
+                   page_size: Union[int, None] = None) -> tuple[list[tuple[str, api.TripAB]], int]:
+    """Same as get_trips_routes_db, over a day or an inclusive (first day,
+    last day) range, and only for the trips departing within departure_window
+    ((HH:MM[:SS], HH:MM[:SS]), inclusive) if given. The window is looked up
+    in the sorted departures of each pattern, so trips outside it are never
+    visited, and only the trips of the requested page are built as TripABs.
+    Returns the page of (day, tripAB) sorted by day and departure, and the
+    total number of trips.
+    """
+    if page < 0 or (page_size is not None and page_size < 0):
+        raise ValueError("page and page_size must not be negative")
+    days = _days(days)
+    if departure_window is not None:
+        start, end = (api.time_to_seconds(time) for time in departure_window)
+    else:
+        start, end = 0, 2**31 - 1
+    # (day, departure, arrival, origin, destination, route, trip)
+    found = []
+    for route in api.get_routes_serving_generator(origins, destinations):
+        active_days: dict[str, list[str]] = {}
+        for pattern in route.patterns:
+            n = len(pattern.stop_ids)
+            for origin in origins:
+                i = pattern.stop_index.get(origin.id)
+                if i is None:
                     continue
-                for trip in route.trips:
-                    if day not in trip.dates:
+                rows = None
+                for destination in destinations:
+                    j = pattern.stop_index.get(destination.id)
+                    if j is None or j <= i:
                         continue
-                    if trip.in_sequence(origin, destination):
-                        origin_time = trip.schedule[origin.id].departure_time
-                        destination_time = trip.schedule[destination.id].arrival_time
-                        tripABs.append(api.TripAB(origin, destination, origin_time, destination_time, route, trip))
-    return tripABs
+                    if rows is None:
+                        rows = pattern.rows_departing_between(i, start, end)
+                    for row in rows:
+                        trip = pattern.trips[row]
+                        trip_days = active_days.get(trip.service_id)
+                        if trip_days is None:
+                            trip_days = active_days[trip.service_id] = [day for day in days if trip.is_active(day)]
+                        for day in trip_days:
+                            found.append((day, pattern.departures[row * n + i], pattern.arrivals[row * n + j],
+                                          origin, destination, route, trip))
+    found.sort(key=lambda x: (x[0], x[1]))
+    if page_size is not None:
+        found_page = found[page * page_size:(page + 1) * page_size]
+    else:
+        found_page = found
+    return [
+        (day, api.TripAB(origin, destination, departure, arrival, route, trip))
+        for day, departure, arrival, origin, destination, route, trip in found_page
+    ], len(found)
 
 def join_times(times1: list[api.StopTimes]) -> list[api.StopTimes]:
-    """Joins a list of StopTimes objects into a single list of times.
+    """Joins a list of StopTimes objects into a single list of times, one
+    StopTimes per time, sorted by time.
     """
     times: list[api.StopTimes] = []
     for time in times1:
-        for time_hhmm in time.times:
-            times.append(api.StopTimes(time.stop, [time_hhmm]))
+        for seconds in time.times:
+            times.append(api.StopTimes(time.stop, [seconds]))
 
-    times.sort(key=lambda x: int(x.times[0].split(':')[0])*60 + int(x.times[0].split(':')[1]))
+    times.sort(key=lambda x: x.times[0])
     return times
@@ -0,0 +1,183 @@
+from . import api
+from typing import Union
+import os
+import sqlite3
+
+# Alternative storage backend: instead of pickled Route objects, the timetable
+# is stored in normalized tables, so that the filtering done in Python by
+# get_trips_routes_db (has_stop, Trip.is_active, Trip.in_sequence) can be
+# done by SQLite, using its indexes. Like api.ServiceCalendar, the dates are
+# stored once per service, not once per trip.
+
+timetable_database_file = os.path.join("cache", "timetable.db")
+# bump whenever the schema changes
+TIMETABLE_DB_VERSION = 3
+timetable_db = None
+
+_SCHEMA = """
+CREATE TABLE routes (
+    id TEXT PRIMARY KEY,
+    short_name TEXT,
+    long_name TEXT,
+    color TEXT,
+    text_color TEXT
+);
+CREATE TABLE stops (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    lat TEXT,
+    lon TEXT
+);
+CREATE TABLE trips (
+    id INTEGER PRIMARY KEY,
+    trip_id TEXT,
+    route_id TEXT REFERENCES routes (id),
+    service_id TEXT,
+    direction TEXT
+);
+CREATE TABLE stop_times (
+    trip INTEGER REFERENCES trips (id),
+    stop_id TEXT REFERENCES stops (id),
+    stop_sequence INTEGER,
+    -- seconds since the start of the service day
+    arrival_time INTEGER,
+    departure_time INTEGER,
+    PRIMARY KEY (trip, stop_id)
+) WITHOUT ROWID;
+CREATE TABLE service_dates (
+    date TEXT,
+    service_id TEXT,
+    PRIMARY KEY (date, service_id)
+) WITHOUT ROWID;
+CREATE INDEX trips_route_id ON trips (route_id);
+CREATE INDEX stop_times_stop_id ON stop_times (stop_id, trip);
+"""
+
+
+def insert_route(db: sqlite3.Connection, route: api.Route) -> None:
+    """Inserts a route, with its stops, trips and service dates, in the
+    database. Does not commit.
+    """
+    db.execute("INSERT OR REPLACE INTO routes (id, short_name, long_name, color, text_color) VALUES (?, ?, ?, ?, ?)",
+               (route.id, route.short_name, route.long_name, route.color, route.text_color))
+    db.executemany("INSERT OR IGNORE INTO stops (id, name, lat, lon) VALUES (?, ?, ?, ?)",
+                   ((stop.id, stop.name, stop.lat, stop.lon) for stop in route.stops.values()))
+    for trip in route.trips:
+        cursor = db.execute("INSERT INTO trips (trip_id, route_id, service_id, direction) VALUES (?, ?, ?, ?)",
+                            (trip.trip_id, route.id, trip.service_id, trip.direction))
+        trip_key = cursor.lastrowid
+        # the schedule holds the last visit to each stop, which is also what
+        # the (trip, stop_id) primary key keeps
+        db.executemany("INSERT OR REPLACE INTO stop_times (trip, stop_id, stop_sequence, arrival_time, departure_time) VALUES (?, ?, ?, ?, ?)",
+                       ((trip_key, s.stop_id, s.stop_sequence, s.arrival_time, s.departure_time) for s in trip.schedule.values()))
+    for calendar in {trip.service_id: trip.calendar for trip in route.trips}.values():
+        db.execute("DELETE FROM service_dates WHERE service_id = ?", (calendar.service_id,))
+        db.executemany("INSERT INTO service_dates (date, service_id) VALUES (?, ?)",
+                       ((date, calendar.service_id) for date in calendar.dates()))
+
+
+def find_or_build_timetable_db() -> sqlite3.Connection:
+    """Same as api.find_or_build_route_db, but for the relational backend"""
+    global timetable_db
+    if timetable_db is None:
+        if os.path.exists(timetable_database_file):
+            timetable_db = sqlite3.connect(timetable_database_file, check_same_thread=False)
+            version = timetable_db.execute("PRAGMA user_version").fetchone()[0]
+            if version != TIMETABLE_DB_VERSION:
+                print(f"Found outdated timetable database (version {version}), rebuilding")
+                timetable_db.close()
+                timetable_db = None
+                os.remove(timetable_database_file)
+                return find_or_build_timetable_db()
+            print("Found existing timetable database")
+        else:
+            print("Building timetable database")
+            os.makedirs(os.path.dirname(timetable_database_file), exist_ok=True)
+            timetable_db = sqlite3.connect(timetable_database_file, check_same_thread=False)
+            timetable_db.executescript(_SCHEMA)
+            i = 0
+            for route in api.get_all_routes_naive_generator():
+                i += 1
+                print(f"Processing route {i}", end="\r")
+                insert_route(timetable_db, route)
+            # only mark the database as valid once it is complete
+            timetable_db.execute(f"PRAGMA user_version = {TIMETABLE_DB_VERSION}")
+            timetable_db.commit()
+            print("\nBuilt timetable database")
+
+    return timetable_db
+
+
+def _load_routes(db: sqlite3.Connection, route_ids: set[str]) -> dict[str, api.Route]:
+    """Builds the routes with the given ids, with their stops but no trips"""
+    marks = ','.join('?' * len(route_ids))
+    routes = {}
+    for row in db.execute(f"SELECT id, short_name, long_name, color, text_color FROM routes WHERE id IN ({marks})", list(route_ids)):
+        routes[row[0]] = api.Route(*row, fetch=False)
+    rows = db.execute(
+        "SELECT DISTINCT trips.route_id, stops.id, stops.name, stops.lat, stops.lon "
+        "FROM trips JOIN stop_times ON stop_times.trip = trips.id JOIN stops ON stops.id = stop_times.stop_id "
+        f"WHERE trips.route_id IN ({marks})", list(route_ids))
+    for route_id, *stop in rows:
+        routes[route_id].add_stop(api.Stop(*stop))
+    return routes
+
+
+def _load_trips(db: sqlite3.Connection, trip_keys: set[int], routes: dict[str, api.Route]) -> dict[int, api.Trip]:
+    """Builds the trips with the given keys, and adds them to their routes"""
+    marks = ','.join('?' * len(trip_keys))
+    rows = db.execute(f"SELECT id, trip_id, route_id, service_id, direction FROM trips WHERE id IN ({marks})", list(trip_keys)).fetchall()
+    calendars = {}
+    for service_id in {row[3] for row in rows}:
+        dates = [date for (date,) in db.execute("SELECT date FROM service_dates WHERE service_id = ?", (service_id,))]
+        calendars[service_id] = api.intern_calendar(service_id, dates)
+    schedules = {key: [] for key in trip_keys}
+    for key, *timed_stop in db.execute(
+            "SELECT stop_times.trip, stop_times.stop_id, stops.name, stop_times.stop_sequence, stop_times.arrival_time, stop_times.departure_time "
+            f"FROM stop_times JOIN stops ON stops.id = stop_times.stop_id WHERE stop_times.trip IN ({marks})", list(trip_keys)):
+        schedules[key].append(api.TimedStop(*timed_stop))
+    trips = {}
+    for key, trip_id, route_id, service_id, direction in rows:
+        route = routes[route_id]
+        trips[key] = route.add_trip(trip_id, service_id, calendars[service_id], direction, schedules[key])
+        route.trips.append(trips[key])
+    return trips
+
+
+def get_trips_sql(origins: list[Union[api.Stop, str]], destinations: list[Union[api.Stop, str]], day: str) -> list[api.TripAB]:
+    """Same as lib.get_trips_routes_db, but the join between the origin and
+    destination stop times of the trips active on the given day is done by
+    SQLite. Only the routes and trips in the result are built, and the routes
+    only carry the trips in the result. The result is sorted by departure time.
+    """
+    origins_by_id = {o.id: o for o in origins if isinstance(o, api.Stop)}
+    destinations_by_id = {d.id: d for d in destinations if isinstance(d, api.Stop)}
+    origin_ids = [o.id if isinstance(o, api.Stop) else o for o in origins]
+    destination_ids = [d.id if isinstance(d, api.Stop) else d for d in destinations]
+    if not origin_ids or not destination_ids:
+        return []
+
+    db = find_or_build_timetable_db()
+    rows = db.execute(
+        "SELECT trips.route_id, o.trip, o.stop_id, d.stop_id, o.departure_time, d.arrival_time "
+        "FROM stop_times AS o "
+        "JOIN stop_times AS d ON d.trip = o.trip "
+        "JOIN trips ON trips.id = o.trip "
+        "JOIN service_dates ON service_dates.date = ? AND service_dates.service_id = trips.service_id "
+        f"WHERE o.stop_id IN ({','.join('?' * len(origin_ids))}) "
+        f"AND d.stop_id IN ({','.join('?' * len(destination_ids))}) "
+        "AND o.stop_sequence < d.stop_sequence "
+        "ORDER BY o.departure_time",
+        [day] + origin_ids + destination_ids).fetchall()
+    if not rows:
+        return []
+
+    routes = _load_routes(db, {row[0] for row in rows})
+    trips = _load_trips(db, {row[1] for row in rows}, routes)
+    tripABs = []
+    for route_id, trip_key, origin_id, destination_id, origin_time, destination_time in rows:
+        route = routes[route_id]
+        origin = origins_by_id.get(origin_id) or route.get_stop(origin_id)
+        destination = destinations_by_id.get(destination_id) or route.get_stop(destination_id)
+        tripABs.append(api.TripAB(origin, destination, origin_time, destination_time, route, trips[trip_key]))
+    return tripABs
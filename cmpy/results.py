@@ -0,0 +1,108 @@
+from . import api
+from dataclasses import dataclass
+from typing import Any, Callable, Hashable, Union
+import collections
+import pickle
+import threading
+import time
+
+# Cache of query results (e.g. the trips of a timetable), least recently used
+# first out, with an optional time to live and size limit in bytes. Each entry
+# records the stops it depends on, so that an updated route only invalidates
+# the entries involving its stops. Every invalidation bumps the version of the
+# cache, and results computed from an older version are not stored, as they
+# may predate the update.
+
+
+@dataclass
+class _Entry:
+    value: Any
+    stop_ids: frozenset[str]
+    expires: float
+    size: int
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: Union[float, None] = None, max_bytes: Union[int, None] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.entries: collections.OrderedDict[Hashable, _Entry] = collections.OrderedDict()
+        self.version = 0
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self.entries.pop(key)
+        self.n_bytes -= entry.size
+
+    def get(self, key: Hashable) -> Union[Any, None]:
+        """Returns the cached value of key, or None (counted as a miss)"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+    def put(self, key: Hashable, value: Any, stop_ids: set[str], version: int) -> None:
+        """Stores the value of key, computed from the given version of the
+        cache and depending on stop_ids. Values from an older version are
+        dropped.
+        """
+        size = len(pickle.dumps(value)) if self.max_bytes is not None else 0
+        with self.lock:
+            if version != self.version or (self.max_bytes is not None and size > self.max_bytes):
+                return
+            if key in self.entries:
+                self._remove(key)
+            expires = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else float("inf")
+            self.entries[key] = _Entry(value, frozenset(stop_ids), expires, size)
+            self.n_bytes += size
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.n_bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, stop_ids: set[str], compute: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is None:
+            version = self.version
+            value = compute()
+            self.put(key, value, stop_ids, version)
+        return value
+
+    def invalidate_stops(self, stop_ids: set[str]) -> None:
+        """Drops the entries depending on any of the stops"""
+        with self.lock:
+            self.version += 1
+            for key in [key for key, entry in self.entries.items() if not entry.stop_ids.isdisjoint(stop_ids)]:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def on_route_updated(self, old_route: api.Route, new_route: api.Route) -> None:
+        """Route update listener (see api.route_update_listeners)"""
+        self.invalidate_stops(set(old_route.stops) | set(new_route.stops))
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.n_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "version": self.version,
+            }
@@ -0,0 +1,110 @@
+from . import api
+from typing import Union
+import bisect
+import unicodedata
+
+
+def normalize(text: str) -> str:
+    """Lowercases and removes the accents of text, for accent insensitive
+    matching ("Força Aérea" -> "forca aerea").
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def _ngrams(text: str, n: int) -> set[str]:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class StopIndex:
+    """Index over a list of stops, built once:
+    - by id
+    - by name (stops sharing a name are a group, usually one per way)
+    - by the 1, 2 and 3-grams of the normalized names, for substring search
+    - by sorted normalized names and ids, for prefix search
+    """
+
+    def __init__(self, stops: list[api.Stop]):
+        self.stops_by_id: dict[str, api.Stop] = {}
+        self.groups: dict[str, list[api.Stop]] = {}
+        for stop in stops:
+            self.stops_by_id[stop.id] = stop
+            self.groups.setdefault(stop.name, []).append(stop)
+        for group in self.groups.values():
+            group.sort(key=lambda stop: stop.id)
+
+        self.names = sorted(self.groups)
+        self.normalized_names = [normalize(name) for name in self.names]
+        # (normalized name, name index), for prefix search
+        self.sorted_names = sorted((normalized, i) for i, normalized in enumerate(self.normalized_names))
+        self.sorted_ids = sorted(self.stops_by_id)
+        self.ngrams: dict[str, list[int]] = {}
+        for i, normalized in enumerate(self.normalized_names):
+            for n in (1, 2, 3):
+                for ngram in _ngrams(normalized, n):
+                    self.ngrams.setdefault(ngram, []).append(i)
+
+    def get(self, stop_id: str) -> Union[api.Stop, None]:
+        return self.stops_by_id.get(stop_id)
+
+    def group(self, name: str) -> list[api.Stop]:
+        """Returns the stops with exactly this name"""
+        return self.groups.get(name, [])
+
+    def _names_containing(self, normalized_query: str) -> list[int]:
+        """Indexes of the names whose normalized form contains the query"""
+        if len(normalized_query) <= 3:
+            return self.ngrams.get(normalized_query, [])
+        postings = sorted((self.ngrams.get(trigram, []) for trigram in _ngrams(normalized_query, 3)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+        return sorted(i for i in candidates if normalized_query in self.normalized_names[i])
+
+    def _names_starting_with(self, normalized_query: str) -> list[int]:
+        start = bisect.bisect_left(self.sorted_names, (normalized_query,))
+        indexes = []
+        for normalized, i in self.sorted_names[start:]:
+            if not normalized.startswith(normalized_query):
+                break
+            indexes.append(i)
+        return sorted(indexes)
+
+    def stops_containing(self, match: str) -> list[api.Stop]:
+        """Same as lib.get_stops_containing(match, stops), using the index"""
+        if not match:
+            return [stop for name in self.names for stop in self.groups[name]]
+        stops = []
+        for i in self._names_containing(normalize(match)):
+            if match in self.names[i]:
+                stops.extend(self.groups[self.names[i]])
+        return stops
+
+    def search(self, query: str, prefix: bool = False) -> list[api.Stop]:
+        """Accent and case insensitive search of the stops whose name contains
+        (or starts with, if prefix) the query, or whose id starts with it.
+        Names starting with the query come first, and stops with the same name
+        are kept together.
+        """
+        normalized_query = normalize(query.strip())
+        if not normalized_query:
+            return []
+        starting = self._names_starting_with(normalized_query)
+        indexes = starting
+        if not prefix:
+            starting_set = set(starting)
+            indexes = starting + [i for i in self._names_containing(normalized_query) if i not in starting_set]
+        stops = []
+        for i in indexes:
+            stops.extend(self.groups[self.names[i]])
+
+        seen = {stop.id for stop in stops}
+        start = bisect.bisect_left(self.sorted_ids, normalized_query)
+        for stop_id in self.sorted_ids[start:]:
+            if not stop_id.startswith(normalized_query):
+                break
+            if stop_id not in seen:
+                stops.append(self.stops_by_id[stop_id])
+        return stops
@@ -0,0 +1,321 @@
+from . import api
+from . import lib
+from typing import Union
+from array import array
+import mmap
+import os
+import struct
+
+# Read-only snapshot of the timetable in a single file, made of flat arrays
+# (stops, routes, calendars, patterns, trips and their times) and a string
+# table. The file is memory mapped and the arrays are read in place, so every
+# process mapping it shares the same pages instead of holding its own copy of
+# the timetable.
+#
+# Layout: a header (magic, version, number of sections, and the id and data
+# version of the route database it was built from), a table of sections
+# (name, typecode, offset, number of items), then the sections, each aligned to
+# 8 bytes. Arrays are in native byte order, as the snapshot is built and read
+# on the same machine.
+
+snapshot_file = os.path.join("cache", "timetable.snap")
+SNAPSHOT_MAGIC = b"CMPYSNAP"
+SNAPSHOT_VERSION = 2
+_HEADER = struct.Struct("<8sII32sQ")
+_SECTION = struct.Struct("<16s4sQQ")
+
+
+class _StringTable:
+    """Builds the string table, storing each distinct string once"""
+
+    def __init__(self):
+        self.indexes: dict[str, int] = {}
+        self.offsets = array('I', [0])
+        self.data = bytearray()
+
+    def add(self, string: str) -> int:
+        index = self.indexes.get(string)
+        if index is None:
+            index = self.indexes[string] = len(self.offsets) - 1
+            self.data += string.encode("utf-8")
+            self.offsets.append(len(self.data))
+        return index
+
+
+def build_snapshot(filename: os.PathLike = snapshot_file) -> None:
+    """Builds the snapshot from the route database. The file is written under
+    a temporary name and moved in place, so processes never map a partial
+    snapshot.
+    """
+    api.find_or_build_route_db()
+    # read first, so that routes written meanwhile make it look outdated
+    database_id, data_version = api.get_data_version()
+    strings = _StringTable()
+    sections: dict[str, array] = {name: array(typecode) for name, typecode in [
+        ("route_id", 'I'), ("route_short", 'I'), ("route_long", 'I'), ("route_color", 'I'), ("route_text", 'I'),
+        ("cal_service", 'I'), ("cal_start", 'i'), ("cal_bits_off", 'I'), ("cal_bits", 'B'),
+        ("pat_route", 'I'), ("pat_dir", 'I'), ("pat_stops_off", 'I'), ("pat_trips_off", 'I'), ("pat_times_off", 'I'),
+        ("pat_stop", 'I'), ("pat_stop_seq", 'I'),
+        ("trip_id", 'I'), ("trip_cal", 'I'),
+        ("arrivals", 'i'), ("departures", 'i'),
+    ]}
+    stops: dict[str, api.Stop] = {}
+    stop_indexes: dict[str, int] = {}
+    calendar_indexes: dict[str, int] = {}
+    # (stop index, pattern index, position of the last visit)
+    stop_patterns: list[tuple[int, int, int]] = []
+
+    def stop_index(stop: api.Stop) -> int:
+        if stop.id not in stop_indexes:
+            stop_indexes[stop.id] = len(stop_indexes)
+            stops[stop.id] = stop
+        return stop_indexes[stop.id]
+
+    def calendar_index(calendar: api.ServiceCalendar) -> int:
+        if calendar.service_id not in calendar_indexes:
+            calendar_indexes[calendar.service_id] = len(calendar_indexes)
+            sections["cal_service"].append(strings.add(calendar.service_id))
+            sections["cal_start"].append(calendar.start)
+            sections["cal_bits_off"].append(len(sections["cal_bits"]))
+            sections["cal_bits"].frombytes(calendar.bits)
+        return calendar_indexes[calendar.service_id]
+
+    n_patterns = 0
+    for route_index, route in enumerate(api.get_all_routes_generator()):
+        for name, value in [("route_id", route.id), ("route_short", route.short_name), ("route_long", route.long_name),
+                            ("route_color", route.color), ("route_text", route.text_color)]:
+            sections[name].append(strings.add(value))
+        for pattern in route.patterns:
+            sections["pat_route"].append(route_index)
+            sections["pat_dir"].append(strings.add(pattern.direction))
+            sections["pat_stops_off"].append(len(sections["pat_stop"]))
+            sections["pat_trips_off"].append(len(sections["trip_id"]))
+            sections["pat_times_off"].append(len(sections["arrivals"]))
+            for stop_id, sequence in zip(pattern.stop_ids, pattern.stop_sequences):
+                sections["pat_stop"].append(stop_index(route.stops[stop_id]))
+                sections["pat_stop_seq"].append(sequence)
+            for stop_id, position in pattern.stop_index.items():
+                stop_patterns.append((stop_indexes[stop_id], n_patterns, position))
+            for trip in pattern.trips:
+                sections["trip_id"].append(strings.add(trip.trip_id))
+                sections["trip_cal"].append(calendar_index(trip.calendar))
+            sections["arrivals"].extend(pattern.arrivals)
+            sections["departures"].extend(pattern.departures)
+            n_patterns += 1
+    # closing offsets, so that item i spans [off[i], off[i + 1])
+    sections["cal_bits_off"].append(len(sections["cal_bits"]))
+    sections["pat_stops_off"].append(len(sections["pat_stop"]))
+    sections["pat_trips_off"].append(len(sections["trip_id"]))
+    sections["pat_times_off"].append(len(sections["arrivals"]))
+
+    sections["stop_id"] = array('I', (strings.add(stop.id) for stop in stops.values()))
+    sections["stop_name"] = array('I', (strings.add(stop.name) for stop in stops.values()))
+    sections["stop_lat"] = array('I', (strings.add(str(stop.lat)) for stop in stops.values()))
+    sections["stop_lon"] = array('I', (strings.add(str(stop.lon)) for stop in stops.values()))
+    # stop -> (pattern, position) inverted index, grouped by stop
+    stop_patterns.sort()
+    sections["stop_pat_off"] = array('I', [0] * (len(stops) + 1))
+    for stop, _, _ in stop_patterns:
+        sections["stop_pat_off"][stop + 1] += 1
+    for i in range(len(stops)):
+        sections["stop_pat_off"][i + 1] += sections["stop_pat_off"][i]
+    sections["stop_pat"] = array('I', (pattern for _, pattern, _ in stop_patterns))
+    sections["stop_pat_pos"] = array('I', (position for _, _, position in stop_patterns))
+    sections["str_off"] = strings.offsets
+    sections["str_data"] = array('B', bytes(strings.data))
+
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    table = []
+    for name, values in sections.items():
+        offset = (offset + 7) // 8 * 8
+        table.append((name, values, offset))
+        offset += len(values) * values.itemsize
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(tmp_filename, "wb") as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(sections), database_id.encode(), data_version))
+        for name, values, offset in table:
+            f.write(_SECTION.pack(name.encode(), values.typecode.encode(), offset, len(values)))
+        for name, values, offset in table:
+            f.write(b"\0" * (offset - f.tell()))
+            values.tofile(f)
+    os.replace(tmp_filename, filename)
+    print(f"Built snapshot: {len(stops)} stops, {n_patterns} patterns, {len(sections['trip_id'])} trips")
+
+
+class Snapshot:
+    """A mapped snapshot. The arrays are memoryviews over the mapping; only the
+    stop id -> index dict and the routes are built in each process.
+    """
+
+    def __init__(self, filename: os.PathLike = snapshot_file):
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_sections, database_id, self.data_version = _HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{filename} is not a version {SNAPSHOT_VERSION} snapshot")
+        self.database_id = database_id.decode()
+        view = memoryview(self._mmap)
+        self.arrays: dict[str, memoryview] = {}
+        for i in range(n_sections):
+            name, typecode, offset, length = _SECTION.unpack_from(self._mmap, _HEADER.size + i * _SECTION.size)
+            typecode = typecode.rstrip(b"\0").decode()
+            itemsize = array(typecode).itemsize
+            self.arrays[name.rstrip(b"\0").decode()] = view[offset:offset + length * itemsize].cast(typecode)
+        self.stop_indexes = {self.string(string): i for i, string in enumerate(self.arrays["stop_id"])}
+        self._routes: dict[int, api.Route] = {}
+        self._calendars: dict[int, api.ServiceCalendar] = {}
+
+    def string(self, index: int) -> str:
+        offsets = self.arrays["str_off"]
+        return bytes(self.arrays["str_data"][offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def stop(self, index: int) -> api.Stop:
+        a = self.arrays
+        return api.Stop(self.string(a["stop_id"][index]), self.string(a["stop_name"][index]),
+                        self.string(a["stop_lat"][index]), self.string(a["stop_lon"][index]))
+
+    def stops(self) -> list[api.Stop]:
+        return [self.stop(i) for i in range(len(self.arrays["stop_id"]))]
+
+    def route(self, index: int) -> api.Route:
+        """The route, without stops or trips"""
+        route = self._routes.get(index)
+        if route is None:
+            a = self.arrays
+            route = self._routes[index] = api.Route(
+                self.string(a["route_id"][index]), self.string(a["route_short"][index]), self.string(a["route_long"][index]),
+                self.string(a["route_color"][index]), self.string(a["route_text"][index]), fetch=False)
+        return route
+
+    def calendar(self, index: int) -> api.ServiceCalendar:
+        calendar = self._calendars.get(index)
+        if calendar is None:
+            a = self.arrays
+            bits = bytes(a["cal_bits"][a["cal_bits_off"][index]:a["cal_bits_off"][index + 1]])
+            calendar = self._calendars[index] = api._intern_calendar(self.string(a["cal_service"][index]), a["cal_start"][index], bits)
+        return calendar
+
+    def _is_active(self, calendar: int, ordinal: int) -> bool:
+        a = self.arrays
+        offset = ordinal - a["cal_start"][calendar]
+        start = a["cal_bits_off"][calendar]
+        if offset < 0 or start + (offset >> 3) >= a["cal_bits_off"][calendar + 1]:
+            return False
+        return bool(a["cal_bits"][start + (offset >> 3)] >> (offset & 7) & 1)
+
+    def _stop_patterns(self, stop_id: str) -> list[tuple[int, int]]:
+        """(pattern, position of the last visit) of the patterns visiting a stop"""
+        index = self.stop_indexes.get(stop_id)
+        if index is None:
+            return []
+        a = self.arrays
+        start, end = a["stop_pat_off"][index], a["stop_pat_off"][index + 1]
+        return list(zip(a["stop_pat"][start:end], a["stop_pat_pos"][start:end]))
+
+    def get_trips(self, origins: list[Union[api.Stop, str]], destinations: list[Union[api.Stop, str]], day: str) -> list[api.TripAB]:
+        """Same as lib.get_trips_routes_db, run on the snapshot. The trips of
+        the result have no pattern (so no schedule), only their id, service
+        and direction.
+        """
+        a = self.arrays
+        ordinal = api._day_ordinal(day)
+        destinations_at: dict[int, list[tuple[Union[api.Stop, str], int]]] = {}
+        for destination in destinations:
+            destination_id = destination.id if isinstance(destination, api.Stop) else destination
+            for pattern, position in self._stop_patterns(destination_id):
+                destinations_at.setdefault(pattern, []).append((destination, position))
+
+        tripABs = []
+        for origin in origins:
+            origin_id = origin.id if isinstance(origin, api.Stop) else origin
+            for pattern, origin_position in self._stop_patterns(origin_id):
+                for destination, destination_position in destinations_at.get(pattern, ()):
+                    if destination_position <= origin_position:
+                        continue
+                    route = self.route(a["pat_route"][pattern])
+                    direction = self.string(a["pat_dir"][pattern])
+                    n_stops = a["pat_stops_off"][pattern + 1] - a["pat_stops_off"][pattern]
+                    times = a["pat_times_off"][pattern]
+                    for row, trip in enumerate(range(a["pat_trips_off"][pattern], a["pat_trips_off"][pattern + 1])):
+                        calendar = a["trip_cal"][trip]
+                        if not self._is_active(calendar, ordinal):
+                            continue
+                        base = times + row * n_stops
+                        tripABs.append(api.TripAB(
+                            origin, destination,
+                            a["departures"][base + origin_position],
+                            a["arrivals"][base + destination_position],
+                            route,
+                            api.Trip(self.string(a["trip_id"][trip]), self.string(a["cal_service"][calendar]),
+                                     self.calendar(calendar), direction)))
+        return tripABs
+
+    def get_trips_batch(self, queries: list[tuple[list[api.Stop], list[api.Stop], Union[str, tuple[str, str]]]]) -> list[dict[str, list[api.TripAB]]]:
+        """Same as lib.get_trips_batch, run on the snapshot"""
+        return [
+            {day: sorted(self.get_trips(origins, destinations, day), key=lambda x: x.origin_time) for day in lib._days(days)}
+            for origins, destinations, days in queries
+        ]
+
+    def get_trips_page(self, origins: list[api.Stop], destinations: list[api.Stop], days: Union[str, tuple[str, str]],
+                       departure_window: Union[tuple[str, str], None] = None, page: int = 0,
+                       page_size: Union[int, None] = None) -> tuple[list[tuple[str, api.TripAB]], int]:
+        """Same as lib.get_trips_page, run on the snapshot"""
+        if page < 0 or (page_size is not None and page_size < 0):
+            raise ValueError("page and page_size must not be negative")
+        if departure_window is not None:
+            start, end = (api.time_to_seconds(time) for time in departure_window)
+        else:
+            start, end = 0, 2**31 - 1
+        found = []
+        for day in lib._days(days):
+            found.extend((day, tripAB) for tripAB in sorted(self.get_trips(origins, destinations, day), key=lambda x: x.origin_time)
+                         if start <= tripAB.origin_time <= end)
+        if page_size is not None:
+            return found[page * page_size:(page + 1) * page_size], len(found)
+        return found, len(found)
+
+
+snapshot = None
+
+
+def _read_stamp(filename: os.PathLike) -> Union[tuple[str, int], None]:
+    """(database id, data version) of the route database a snapshot was
+    built from, or None if there is no (readable) snapshot
+    """
+    try:
+        with open(filename, "rb") as f:
+            magic, version, _, database_id, data_version = _HEADER.unpack(f.read(_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    return database_id.decode(), data_version
+
+
+def find_or_build_snapshot(filename: os.PathLike = snapshot_file) -> Snapshot:
+    """Maps the snapshot, building it first if it doesn't exist or wasn't
+    built from the current data version of the route database
+    """
+    global snapshot
+    if snapshot is None:
+        api.find_or_build_route_db()
+        if _read_stamp(filename) != api.get_data_version():
+            print("Building snapshot")
+            build_snapshot(filename)
+        snapshot = Snapshot(filename)
+    return snapshot
+
+
+def get_trips_snapshot(origins: list[Union[api.Stop, str]], destinations: list[Union[api.Stop, str]], day: str) -> list[api.TripAB]:
+    return find_or_build_snapshot().get_trips(origins, destinations, day)
+
+
+if __name__ == "__main__":
+    # python -m cmpy.snapshot: (re)build the snapshot, and the departure boards
+    # if needed, e.g. before (re)starting the server workers, so that they
+    # only map them
+    from . import boards
+    build_snapshot()
+    boards.find_or_build_departure_boards()
@@ -0,0 +1,113 @@
+from . import api
+from array import array
+import heapq
+import math
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance in meters between two points given in degrees"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2)**2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class StopGrid:
+    """Spatial index over a list of stops: a uniform grid of cells of about
+    cell_size_m x cell_size_m. The coordinates are parsed to floats once, and
+    the stops are stored sorted by cell, so each cell is a contiguous slice of
+    the lat and lon arrays.
+    """
+
+    def __init__(self, stops: list[api.Stop], cell_size_m: float = 500.0):
+        located = []
+        for stop in stops:
+            try:
+                located.append((stop, float(stop.lat), float(stop.lon)))
+            except (TypeError, ValueError):
+                continue  # stop without coordinates
+
+        # degrees per cell, with the longitude step taken at the mean latitude
+        mean_lat = sum(lat for _, lat, _ in located) / len(located) if located else 0.0
+        self.cell_lat = math.degrees(cell_size_m / EARTH_RADIUS_M)
+        self.cell_lon = self.cell_lat / max(math.cos(math.radians(mean_lat)), 1e-6)
+        self.cell_size_m = cell_size_m
+
+        located.sort(key=lambda item: self._cell(item[1], item[2]))
+        self.stops: list[api.Stop] = [stop for stop, _, _ in located]
+        self.lats = array('d', (lat for _, lat, _ in located))
+        self.lons = array('d', (lon for _, _, lon in located))
+        # cell -> (start, end) in the arrays
+        self.cells: dict[tuple[int, int], tuple[int, int]] = {}
+        for i, (_, lat, lon) in enumerate(located):
+            cell = self._cell(lat, lon)
+            start, _ = self.cells.get(cell, (i, i))
+            self.cells[cell] = (start, i + 1)
+        # bounding box of the occupied cells, to know when to stop searching
+        self.min_cell = (min((i for i, _ in self.cells), default=0), min((j for _, j in self.cells), default=0))
+        self.max_cell = (max((i for i, _ in self.cells), default=0), max((j for _, j in self.cells), default=0))
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return (math.floor(lat / self.cell_lat), math.floor(lon / self.cell_lon))
+
+    def _ring(self, center: tuple[int, int], radius: int):
+        """Cells at Chebyshev distance radius from center"""
+        ci, cj = center
+        if radius == 0:
+            yield center
+            return
+        for j in range(cj - radius, cj + radius + 1):
+            yield (ci - radius, j)
+            yield (ci + radius, j)
+        for i in range(ci - radius + 1, ci + radius):
+            yield (i, cj - radius)
+            yield (i, cj + radius)
+
+    def stops_within(self, lat: float, lon: float, radius_m: float) -> list[tuple[api.Stop, float]]:
+        """Returns (stop, distance in meters) of the stops within radius_m of
+        the point, closest first.
+        """
+        ci, cj = self._cell(lat, lon)
+        n_cells = math.ceil(radius_m / self.cell_size_m) + 1
+        found = []
+        for i in range(max(ci - n_cells, self.min_cell[0]), min(ci + n_cells, self.max_cell[0]) + 1):
+            for j in range(max(cj - n_cells, self.min_cell[1]), min(cj + n_cells, self.max_cell[1]) + 1):
+                start, end = self.cells.get((i, j), (0, 0))
+                for k in range(start, end):
+                    distance = haversine(lat, lon, self.lats[k], self.lons[k])
+                    if distance <= radius_m:
+                        found.append((distance, k))
+        found.sort()
+        return [(self.stops[k], distance) for distance, k in found]
+
+    def nearest_stops(self, lat: float, lon: float, k: int = 10) -> list[tuple[api.Stop, float]]:
+        """Returns (stop, distance in meters) of the k stops closest to the
+        point, closest first. Rings of cells around the point are searched
+        until no unsearched cell can hold a closer stop.
+        """
+        if not self.stops or k <= 0:
+            return []
+        center = self._cell(lat, lon)
+        # max heap of the k best, as (-distance, index)
+        best: list[tuple[float, int]] = []
+        radius = 0
+        max_radius = max(center[0] - self.min_cell[0], self.max_cell[0] - center[0],
+                         center[1] - self.min_cell[1], self.max_cell[1] - center[1], 0)
+        while radius <= max_radius:
+            for cell in self._ring(center, radius):
+                start, end = self.cells.get(cell, (0, 0))
+                for i in range(start, end):
+                    distance = haversine(lat, lon, self.lats[i], self.lons[i])
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, i))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, i))
+            # every cell outside the searched rings is at least radius cells away
+            if len(best) == k and -best[0][0] <= radius * self.cell_size_m:
+                break
+            radius += 1
+        return [(self.stops[i], -distance) for distance, i in sorted(best, reverse=True)]
@@ -70,18 +70,18 @@ if __name__ == "__main__":
         print(f"Carapinheira -> Lisboa ({day}):")
         for tripAB in trips_c_l:
             f.write(
-                f"{tripAB.origin_time} -> {tripAB.destination_time}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})\n")
+                f"{cmpy.seconds_to_time(tripAB.origin_time)} -> {cmpy.seconds_to_time(tripAB.destination_time)}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})\n")
             print(
-                f"{tripAB.origin_time} -> {tripAB.destination_time}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})")
+                f"{cmpy.seconds_to_time(tripAB.origin_time)} -> {cmpy.seconds_to_time(tripAB.destination_time)}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})")
 
     with open("lisboa_carapinheira.txt", "w", encoding='utf8') as f:
         f.write(f"Lisboa -> Carapinheira ({day}):\n")
         print(f"Lisboa -> Carapinheira ({day}):")
         for tripAB in trips_l_c:
             f.write(
-                f"{tripAB.origin_time} -> {tripAB.destination_time}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})\n")
+                f"{cmpy.seconds_to_time(tripAB.origin_time)} -> {cmpy.seconds_to_time(tripAB.destination_time)}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})\n")
             print(
-                f"{tripAB.origin_time} -> {tripAB.destination_time}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})")
+                f"{cmpy.seconds_to_time(tripAB.origin_time)} -> {cmpy.seconds_to_time(tripAB.destination_time)}: {tripAB.trip.direction} - {tripAB.route.long_name} ({tripAB.route.id})")
 
     # for stat in snapshot2.compare_to(snapshot1, 'lineno'):
     #     print(stat)
@@ -1,34 +1,85 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, Response, render_template, request, redirect, url_for, session
 import cmpy
+import concurrent.futures
 import datetime
+import gzip
+import hashlib
+import math
+import msgspec
+import os
+from typing import Union
 
 log_file = 'usr-log.txt'
 
+# with CMPY_SNAPSHOT set, stops, timetables and trips (/timetable, /trips and
+# /trips/batch) come from the mapped snapshot (built with python -m
+# cmpy.snapshot, which also builds the departure boards), shared by all the
+# server processes. /departures reads the boards from routes.db, one stop at
+# a time. Journeys need the timetable of a whole day in each process, so
+# /journey and /isochrone aren't available. The snapshot is read-only, so the
+# cache renewal worker isn't started.
+use_snapshot = os.environ.get('CMPY_SNAPSHOT') is not None
+# with CMPY_QUERY_WORKERS=n, timetables are computed by n processes, each
+# keeping a shard of the routes loaded (see cmpy.engine)
+query_workers = os.environ.get('CMPY_QUERY_WORKERS')
+
 app = Flask(__name__)
 
 db = cmpy.find_or_build_route_db()
+cmpy.find_or_build_departure_boards()
+# started before any other thread, as the workers are forked
+query_engine = None
+if query_workers is not None and not use_snapshot:
+    query_engine = cmpy.start_query_engine(int(query_workers))
 
-stops = cmpy.get_all_stops()
-sendable_stops = []
+if use_snapshot:
+    snapshot = cmpy.find_or_build_snapshot()
+    stops = snapshot.stops()
+else:
+    stops = cmpy.get_all_stops()
+stop_index = cmpy.StopIndex(stops)
+stop_grid = cmpy.StopGrid(stops)
+journey_planner = None if use_snapshot else cmpy.JourneyPlanner(stops)
+# stops sorted alphabetically, deduped by id (first seen wins)
+sendable_stops = {}
 for stop in stops:
-    in_array = False
-    for sendable_stop in sendable_stops:
-        if sendable_stop['id'] == stop.id:
-            in_array = True
-            break
-    if not in_array:
-        sendable_stops.append({
+    if stop.id not in sendable_stops:
+        sendable_stops[stop.id] = {
             'id': stop.id,
             'name': stop.name,
             'lat': stop.lat,
             'lon': stop.lon,
             'location-identifiers': "",
-        })
+        }
+sendable_stops = sorted(sendable_stops.values(), key=lambda x: x['name'])
+
+# the /stops body is encoded and compressed once, and revalidated by ETag
+stops_body = msgspec.json.encode(sendable_stops)
+stops_body_gzip = gzip.compress(stops_body, mtime=0)
+stops_etag = hashlib.sha256(stops_body).hexdigest()[:32]
+
+# trips of the recent timetable queries, by origin and destination group and
+# day. Updated routes invalidate the entries involving their stops, and the
+# rest expire after an hour. CMPY_TIMETABLE_CACHE_BYTES limits its size.
+timetable_cache = cmpy.ResultCache(
+    max_entries=int(os.environ.get('CMPY_TIMETABLE_CACHE_ENTRIES', 1024)),
+    ttl_seconds=60 * 60,
+    max_bytes=int(os.environ['CMPY_TIMETABLE_CACHE_BYTES']) if 'CMPY_TIMETABLE_CACHE_BYTES' in os.environ else None)
+cmpy.route_update_listeners.append(timetable_cache.on_route_updated)
 
-renewer = cmpy.start_cache_renewal_worker()
+# timetable queries run on a few threads, identical concurrent queries share
+# one run, and when too many are pending new ones get a 503 instead of waiting
+query_executor = cmpy.QueryExecutor(
+    max_workers=int(os.environ.get('CMPY_QUERY_THREADS', 4)),
+    max_pending=int(os.environ.get('CMPY_QUERY_PENDING', 32)))
+query_timeout = float(os.environ.get('CMPY_QUERY_TIMEOUT', 30))
 
-# sort alphabetically
-sendable_stops.sort(key=lambda x: x['name'])
+if not use_snapshot:
+    # timetables of today and the next days, rebuilt before each midnight
+    cmpy.find_or_build_day_timetables()
+    prewarmer = cmpy.start_day_timetable_worker()
+    journey_planner.connections(datetime.date.today().strftime('%Y%m%d'))
+    renewer = cmpy.start_cache_renewal_worker()
 
 @app.route('/')
 def index():
@@ -45,31 +96,53 @@ def get_timetable():
     raw = request.args.get('raw')
 
     # print(f"origin: {originId}, destination: {destinationId}, date: {date}, raw: {raw}")
-    origin = cmpy.get_stops_containing([originId], stops, type='id')[0]
-    destination = cmpy.get_stops_containing(
-        [destinationId], stops, type='id')[0]
+    origin = stop_index.get(originId)
+    destination = stop_index.get(destinationId)
     
-    origins = cmpy.get_stops_containing([origin.name], stops)
-    destinations = cmpy.get_stops_containing([destination.name], stops)
+    origins = stop_index.stops_containing(origin.name)
+    destinations = stop_index.stops_containing(destination.name)
 
     # get time table from origin to destination
-    trips = cmpy.get_trips_routes_db(
-        origins, destinations, date.replace('-', ''))
+    def get_sendable_trips():
+        if use_snapshot:
+            trips = snapshot.get_trips(origins, destinations, date.replace('-', ''))
+        elif date.replace('-', '') in cmpy.daily.day_timetables:
+            trips = cmpy.get_trips_materialized(origins, destinations, date.replace('-', ''))
+        elif query_engine is not None:
+            trips = query_engine.get_trips(origins, destinations, date.replace('-', ''))
+        else:
+            trips = cmpy.get_trips_routes_db(
+                origins, destinations, date.replace('-', ''))
 
-    # convert to sendable format
-    sendable_trips = []
-    for trip in trips:
-        sendable_trips.append(
-            {
-                't0': trip.origin_time,
-                'tf': trip.destination_time,
-                'lineId': trip.route.short_name,
-                'route' : trip.route.long_name,
-                'way': trip.trip.direction,
-            }
-        )
-    # sort by departure time
-    sendable_trips.sort(key=lambda x: x['t0'])
+        # sort by departure time, and convert to sendable format
+        sendable_trips = []
+        for trip in sorted(trips, key=lambda trip: trip.origin_time):
+            sendable_trips.append(
+                {
+                    't0': cmpy.seconds_to_time(trip.origin_time),
+                    'tf': cmpy.seconds_to_time(trip.destination_time),
+                    'lineId': trip.route.short_name,
+                    'route' : trip.route.long_name,
+                    'way': trip.trip.direction,
+                }
+            )
+        return sendable_trips
+
+    key = (origin.name, destination.name, date)
+    sendable_trips = timetable_cache.get(key)
+    if sendable_trips is None:
+        version = timetable_cache.version
+        def compute():
+            sendable_trips = get_sendable_trips()
+            timetable_cache.put(key, sendable_trips,
+                                {stop.id for stop in origins} | {stop.id for stop in destinations}, version)
+            return sendable_trips
+        try:
+            sendable_trips = query_executor.run(key, compute, query_timeout)
+        except cmpy.QueueFullError:
+            return Response("Too many requests, try again later", status=503, headers={'Retry-After': '5'})
+        except concurrent.futures.TimeoutError:
+            return Response("The timetable took too long, try again later", status=504)
 
     raw_trips: dict = {
         'origin': {
@@ -98,6 +171,408 @@ def get_timetable():
     
     return render_template('timetable.html', origin=origin, destination=destination, trips=sendable_trips, date=date)
 
+# hit and miss counters of the timetable cache
+@app.route('/timetable/cache', methods=['GET'])
+def get_timetable_cache_stats():
+    return timetable_cache.stats()
+
+# counters of the timetable query executor
+@app.route('/timetable/executor', methods=['GET'])
+def get_timetable_executor_stats():
+    return query_executor.stats()
+
+# longest from/to range of dates of a query, as timed out queries keep one
+# of the few query threads busy until they finish
+max_range_days = 31
+
+def parse_date(text: str) -> datetime.datetime:
+    """YYYY-MM-DD (or YYYYMMDD). Raises ValueError if invalid."""
+    try:
+        return datetime.datetime.strptime(text.replace('-', ''), '%Y%m%d')
+    except (AttributeError, ValueError):
+        raise ValueError(f'invalid date {text!r}, expected YYYY-MM-DD')
+
+def parse_time(text: str) -> int:
+    """HH:MM (or HH:MM:SS) as seconds since the start of the service day.
+    Raises ValueError if invalid.
+    """
+    try:
+        seconds = cmpy.time_to_seconds(text)
+    except (AttributeError, ValueError):
+        seconds = -1
+    if seconds < 0:
+        raise ValueError(f'invalid time {text!r}, expected HH:MM')
+    return seconds
+
+def parse_days(args) -> Union[str, tuple[str, str]]:
+    """The date, or the from/to range of dates, of a query as YYYYMMDD.
+    Raises ValueError if they are missing or invalid, or the range is reversed
+    or longer than max_range_days.
+    """
+    if 'date' in args:
+        return parse_date(args['date']).strftime('%Y%m%d')
+    if 'from' in args and 'to' in args:
+        first, last = parse_date(args['from']), parse_date(args['to'])
+        if last < first:
+            raise ValueError('to is before from')
+        if (last - first).days >= max_range_days:
+            raise ValueError(f'at most {max_range_days} days per query')
+        return (first.strftime('%Y%m%d'), last.strftime('%Y%m%d'))
+    raise ValueError('expected date, or from and to')
+
+def parse_count(args, name: str, default: int) -> int:
+    """A non-negative integer argument. Raises ValueError otherwise."""
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise ValueError(f'{name} must be a non-negative integer')
+    return value
+
+# paginated trips between two stop groups, over a date or a from/to range of
+# dates, optionally departing between after and before (HH:MM), e.g. for the
+# next hour
+@app.route('/trips', methods=['GET'])
+def get_trips_page():
+    origin = stop_index.get(request.args.get('origin'))
+    destination = stop_index.get(request.args.get('destination'))
+    if origin is None or destination is None:
+        return {'error': 'unknown origin or destination'}, 400
+    window = None
+    try:
+        days = parse_days(request.args)
+        if 'after' in request.args or 'before' in request.args:
+            window = (request.args.get('after', '00:00'), request.args.get('before', '47:59'))
+            for time in window:
+                parse_time(time)
+        page = parse_count(request.args, 'page', 0)
+        page_size = min(max(parse_count(request.args, 'page_size', 50), 1), 500)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    origins = stop_index.stops_containing(origin.name)
+    destinations = stop_index.stops_containing(destination.name)
+    def compute():
+        if use_snapshot:
+            return snapshot.get_trips_page(origins, destinations, days, window, page, page_size)
+        return cmpy.get_trips_page(origins, destinations, days, window, page, page_size)
+    key = ('trips', origin.name, destination.name, days, window, page, page_size)
+    try:
+        trips, total = query_executor.run(key, compute, query_timeout)
+    except cmpy.QueueFullError:
+        return Response("Too many requests, try again later", status=503, headers={'Retry-After': '5'})
+    except concurrent.futures.TimeoutError:
+        return Response("The query took too long, try again later", status=504)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {
+        'page': page,
+        'page_size': page_size,
+        'total': total,
+        'trips': [
+            {
+                'date': f'{day[:4]}-{day[4:6]}-{day[6:]}',
+                't0': cmpy.seconds_to_time(trip.origin_time),
+                'tf': cmpy.seconds_to_time(trip.destination_time),
+                'lineId': trip.route.short_name,
+                'route': trip.route.long_name,
+                'way': trip.trip.direction,
+            }
+            for day, trip in trips
+        ],
+    }
+
+# journeys between two stop groups leaving at or after time (HH:MM) on date
+# (one of the materialized days), with up to transfers changes (1 by default,
+# at most max_journey_transfers): the earliest arrival with no change, and
+# with each more change if it arrives earlier
+max_journey_transfers = 3
+
+def parse_journey_day(args) -> str:
+    """The date of a journey (or isochrone) query as YYYYMMDD. Only the days
+    with a materialized timetable can be queried, as building the timetable
+    of another day would keep a query thread busy for a long time. Raises
+    ValueError otherwise.
+    """
+    if 'date' not in args:
+        raise ValueError('expected date')
+    day = parse_date(args['date']).strftime('%Y%m%d')
+    if day not in cmpy.daily.day_timetables:
+        days = [f'{day[:4]}-{day[4:6]}-{day[6:]}' for day in sorted(cmpy.daily.day_timetables)]
+        raise ValueError(f'only the dates from {days[0]} to {days[-1]} are available' if days else 'no dates are available yet')
+    return day
+
+@app.route('/journey', methods=['GET'])
+def get_journey():
+    if journey_planner is None:
+        return {'error': 'journeys are not available in snapshot mode'}, 501
+    origin = stop_index.get(request.args.get('origin'))
+    destination = stop_index.get(request.args.get('destination'))
+    if origin is None or destination is None:
+        return {'error': 'unknown origin or destination'}, 400
+    time = request.args.get('time', '00:00')
+    try:
+        day = parse_journey_day(request.args)
+        departure = parse_time(time)
+        transfers = min(parse_count(request.args, 'transfers', 1), max_journey_transfers)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    origins = stop_index.group(origin.name)
+    destinations = stop_index.group(destination.name)
+    def compute():
+        return journey_planner.journeys(origins, destinations, day, departure, transfers)
+    key = ('journey', origin.name, destination.name, day, time, transfers)
+    try:
+        journeys = query_executor.run(key, compute, query_timeout)
+    except cmpy.QueueFullError:
+        return Response("Too many requests, try again later", status=503, headers={'Retry-After': '5'})
+    except concurrent.futures.TimeoutError:
+        return Response("The journey took too long, try again later", status=504)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    def sendable_leg(leg):
+        sendable = {
+            'from': leg.origin_stop.id,
+            'fromName': leg.origin_stop.name,
+            'to': leg.destination_stop.id,
+            'toName': leg.destination_stop.name,
+            't0': cmpy.seconds_to_time(leg.origin_time),
+            'tf': cmpy.seconds_to_time(leg.destination_time),
+        }
+        if isinstance(leg, cmpy.Walk):
+            sendable['type'] = 'walk'
+        else:
+            sendable.update({
+                'type': 'trip',
+                'lineId': leg.route.short_name,
+                'route': leg.route.long_name,
+                'way': leg.trip.direction,
+            })
+        return sendable
+
+    return {
+        'origin': origin.id,
+        'destination': destination.id,
+        'date': request.args['date'],
+        'journeys': [
+            {
+                't0': cmpy.seconds_to_time(journey.departure_time),
+                'tf': cmpy.seconds_to_time(journey.arrival_time),
+                'transfers': journey.transfers,
+                'legs': [sendable_leg(leg) for leg in journey.legs],
+            }
+            for journey in journeys
+        ],
+    }
+
+# stops reachable from a stop group within minutes (45 by default, 1 to
+# max_isochrone_minutes) leaving at or after time (HH:MM) on date (one of the
+# materialized days), with up to transfers changes (2 by default, at most
+# max_journey_transfers), earliest first, e.g. to draw an isochrone
+max_isochrone_minutes = 180
+
+@app.route('/isochrone', methods=['GET'])
+def get_isochrone():
+    if journey_planner is None:
+        return {'error': 'isochrones are not available in snapshot mode'}, 501
+    origin = stop_index.get(request.args.get('origin'))
+    if origin is None:
+        return {'error': 'unknown origin'}, 400
+    time = request.args.get('time', '00:00')
+    try:
+        day = parse_journey_day(request.args)
+        departure = parse_time(time)
+        minutes = min(max(parse_count(request.args, 'minutes', 45), 1), max_isochrone_minutes)
+        transfers = min(parse_count(request.args, 'transfers', 2), max_journey_transfers)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    origins = stop_index.group(origin.name)
+    def compute():
+        return journey_planner.reachable(origins, day, departure, minutes * 60, transfers)
+    key = ('isochrone', origin.name, day, time, minutes, transfers)
+    try:
+        reached = query_executor.run(key, compute, query_timeout)
+    except cmpy.QueueFullError:
+        return Response("Too many requests, try again later", status=503, headers={'Retry-After': '5'})
+    except concurrent.futures.TimeoutError:
+        return Response("The isochrone took too long, try again later", status=504)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {
+        'origin': origin.id,
+        'date': request.args['date'],
+        'time': time,
+        'minutes': minutes,
+        'stops': [
+            {
+                'id': stop.id,
+                'name': stop.name,
+                'lat': stop.lat,
+                'lon': stop.lon,
+                'tf': cmpy.seconds_to_time(arrival),
+            }
+            for stop, arrival in reached
+        ],
+    }
+
+# many timetables at once, e.g. for nightly integrations. The body is
+# {"queries": [{"origin": id, "destination": id, "date": "YYYY-MM-DD"}, ...]},
+# with "from" and "to" dates instead of "date" for a range. Origins and
+# destinations are expanded to their stop groups, as in /timetable. Each
+# range is capped as in /trips, and so are the days of the whole batch
+max_batch_queries = 1000
+max_batch_days = 1000
+
+@app.route('/trips/batch', methods=['POST'])
+def get_trips_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+        return {'error': 'expected {"queries": [...]}'}, 400
+    if len(body['queries']) > max_batch_queries:
+        return {'error': f'at most {max_batch_queries} queries per batch'}, 400
+
+    queries = []
+    n_days = 0
+    for query in body['queries']:
+        if not isinstance(query, dict) or not isinstance(query.get('origin'), str) or not isinstance(query.get('destination'), str):
+            return {'error': f'expected {{"origin": id, "destination": id, ...}}, got {query!r}'}, 400
+        origin = stop_index.get(query['origin'])
+        destination = stop_index.get(query['destination'])
+        if origin is None or destination is None:
+            return {'error': f'unknown stop in {query}'}, 400
+        try:
+            days = parse_days(query)
+        except ValueError as e:
+            return {'error': f'{e} in {query}'}, 400
+        n_days += 1 if isinstance(days, str) else (parse_date(days[1]) - parse_date(days[0])).days + 1
+        if n_days > max_batch_days:
+            return {'error': f'at most {max_batch_days} days per batch'}, 400
+        queries.append((stop_index.stops_containing(origin.name), stop_index.stops_containing(destination.name), days))
+
+    def compute():
+        if use_snapshot:
+            return snapshot.get_trips_batch(queries)
+        return cmpy.get_trips_batch(queries)
+    key = ('batch', msgspec.json.encode(body['queries']))
+    try:
+        results = query_executor.run(key, compute, query_timeout)
+    except cmpy.QueueFullError:
+        return Response("Too many requests, try again later", status=503, headers={'Retry-After': '5'})
+    except concurrent.futures.TimeoutError:
+        return Response("The batch took too long, try again later", status=504)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {
+        'results': [
+            {
+                'origin': query['origin'],
+                'destination': query['destination'],
+                'days': {
+                    f'{day[:4]}-{day[4:6]}-{day[6:]}': [
+                        {
+                            't0': cmpy.seconds_to_time(trip.origin_time),
+                            'tf': cmpy.seconds_to_time(trip.destination_time),
+                            'lineId': trip.route.short_name,
+                            'route': trip.route.long_name,
+                            'way': trip.trip.direction,
+                        }
+                        for trip in trips
+                    ]
+                    for day, trips in result.items()
+                },
+            }
+            for query, result in zip(body['queries'], results)
+        ]
+    }
+
+# next departures from one or more stops, for all lines. The stops and the
+# departures of a request are capped, as each stop is a board lookup
+max_departure_stops = 50
+max_departures = 100
+
+@app.route('/departures', methods=['GET'])
+def get_departures():
+    # stops comes as comma separated ids, when (optional) in ISO format
+    stop_ids = [stop_id for stop_id in request.args.get('stops', '').split(',') if stop_id]
+    if not stop_ids:
+        return {'error': 'expected stops'}, 400
+    if len(stop_ids) > max_departure_stops:
+        return {'error': f'at most {max_departure_stops} stops per request'}, 400
+    try:
+        n = min(parse_count(request.args, 'n', 10), max_departures)
+        when = request.args.get('when')
+        if when is not None:
+            try:
+                when = datetime.datetime.fromisoformat(when)
+            except ValueError:
+                raise ValueError(f'invalid when {when!r}, expected YYYY-MM-DDTHH:MM')
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    departures = cmpy.next_departures(stop_ids, when, n)
+
+    return [
+        {
+            'stopId': departure.stop_id,
+            'time': departure.time.isoformat(),
+            't0': cmpy.seconds_to_time(departure.departure_time),
+            'lineId': departure.route_short_name,
+            'route': departure.route_long_name,
+            'way': departure.direction,
+        }
+        for departure in departures
+    ]
+
+# stops near a location: the k closest, or all within radius meters. Both
+# are capped, as the whole answer is built and sent at once
+max_near_stops = 100
+max_near_radius = 5000
+
+def parse_number(args, name: str, low: float, high: float) -> float:
+    """A finite number argument between low and high. Raises ValueError
+    otherwise."""
+    try:
+        value = float(args.get(name))
+    except (TypeError, ValueError):
+        value = math.nan
+    if not low <= value <= high:
+        if high == math.inf:
+            raise ValueError(f'{name} must be a number of at least {low}')
+        raise ValueError(f'{name} must be a number between {low} and {high}')
+    return value
+
+@app.route('/stops/near', methods=['GET'])
+def get_stops_near():
+    try:
+        lat = parse_number(request.args, 'lat', -90, 90)
+        lon = parse_number(request.args, 'lon', -180, 180)
+        if request.args.get('radius') is not None:
+            radius = min(parse_number(request.args, 'radius', 0, math.inf), max_near_radius)
+            near = stop_grid.stops_within(lat, lon, radius)
+        else:
+            k = min(parse_count(request.args, 'k', 10), max_near_stops)
+            near = stop_grid.nearest_stops(lat, lon, k)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return [
+        {
+            'id': stop.id,
+            'name': stop.name,
+            'lat': stop.lat,
+            'lon': stop.lon,
+            'distance': round(distance),
+        }
+        for stop, distance in near
+    ]
+
 # for css, javascript, images, etc.
 @app.route('/<path:path>.<ext>')
 def static_files(path, ext):
@@ -108,7 +583,48 @@ def static_files(path, ext):
 def get_stops():
     if request.method == 'OPTIONS':
         return ""
-    return sendable_stops
+    headers = {
+        'ETag': f'"{stops_etag}"',
+        'Cache-Control': 'public, max-age=3600',
+        'Vary': 'Accept-Encoding',
+    }
+    if stops_etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    if 'gzip' in request.accept_encodings:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(stops_body_gzip, mimetype='application/json', headers=headers)
+    return Response(stops_body, mimetype='application/json', headers=headers)
+
+# paginated accent insensitive search over the stop names and ids
+@app.route('/stops/search', methods=['GET'])
+def search_stops():
+    query = request.args.get('q', '')
+    prefix = request.args.get('prefix') is not None
+    try:
+        page = parse_count(request.args, 'page', 0)
+        page_size = min(max(parse_count(request.args, 'page_size', 50), 1), 200)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    matches = stop_index.search(query, prefix=prefix)
+    page_stops = matches[page * page_size:(page + 1) * page_size]
+
+    return {
+        'q': query,
+        'page': page,
+        'page_size': page_size,
+        'total': len(matches),
+        'stops': [
+            {
+                'id': stop.id,
+                'name': stop.name,
+                'lat': stop.lat,
+                'lon': stop.lon,
+                'location-identifiers': "",
+            }
+            for stop in page_stops
+        ],
+    }
 
 
 @app.after_request
@@ -0,0 +1,172 @@
+import collections
+import hashlib
+import http.server
+import importlib.util
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+
+import pytest
+
+# the tests import cmpy from this checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cmpy
+from cmpy import api, boards, daily
+
+# responses of the schedules API, by path: the summary and 3 routes around
+# Saldanha (Lisbon), running on 2023-06-29 to 2023-07-03
+API_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "api.json")
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+
+class ApiStub(http.server.ThreadingHTTPServer):
+    """Local schedules API serving the recorded responses, with an ETag
+    (answering 304 when it matches, unless etags is False). failures maps a
+    path to the statuses of its next responses (e.g. [503] fails once),
+    statuses records the status of each response, and max_in_flight the most
+    requests handled at the same time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _ApiStubHandler)
+        with open(API_RESPONSES, "rb") as f:
+            self.bodies = {path: json.dumps(body).encode() for path, body in json.load(f).items()}
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/api"
+        self.delay = delay
+        self.etags = True
+        self.failures: dict[str, list[int]] = {}
+        self.statuses: list[tuple[str, int]] = []
+        self.hits: dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+
+class _ApiStubHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server: ApiStub = self.server
+        path = self.path[len("/api"):]
+        with server.lock:
+            server.hits[path] = server.hits.get(path, 0) + 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failures = server.failures.get(path)
+            status = failures.pop(0) if failures else None
+        try:
+            time.sleep(server.delay)
+            body = server.bodies.get(path)
+            etag = None if body is None else f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+            if status is None:
+                status = 404 if body is None else 200
+                if server.etags and etag is not None and self.headers.get("If-None-Match") == etag:
+                    status = 304
+            with server.lock:
+                server.statuses.append((path, status))
+            self.send_response(status)
+            if status != 200:
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if server.etags:
+                self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api_stub(tmp_path, monkeypatch):
+    """The stub API, as the API of cmpy, with the cache in a temporary
+    directory (the working directory of the test)
+    """
+    stub = ApiStub()
+    # polled often, as shutdown waits for the next poll
+    thread = threading.Thread(target=stub.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api, "API_BASE_URL", stub.url)
+    monkeypatch.setattr(api, "_caches", {})
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+@pytest.fixture
+def routes_db(api_stub, tmp_path, monkeypatch):
+    """A route database built from the stub API, with the state derived from
+    it (boards, day timetables, snapshot) starting empty
+    """
+    monkeypatch.setattr(api, "routes_database_file", str(tmp_path / "cache" / "routes.db"))
+    monkeypatch.setattr(api, "_routes_db", None)
+    monkeypatch.setattr(api, "db", None)
+    monkeypatch.setattr(boards, "departure_boards", collections.OrderedDict())
+    monkeypatch.setattr(daily, "day_timetables", {})
+    # cmpy.snapshot is shadowed by its snapshot global, star-exported by cmpy
+    monkeypatch.setattr(sys.modules["cmpy.snapshot"], "snapshot", None)
+    # listeners added by the test (e.g. by a JourneyPlanner, or server.py
+    # through cmpy.route_update_listeners) go with it: the list is shared, so
+    # it is restored in place
+    listeners = list(api.route_update_listeners)
+    api.find_or_build_route_db()
+    yield api._get_routes_db()
+    api._get_routes_db().close()
+    api.route_update_listeners[:] = listeners
+
+
+@pytest.fixture
+def update_route(routes_db):
+    """update_route(route_short_name, edit, notify=True): stores a new
+    response of a route, its recorded one edited by edit(route detail), and
+    writes the route as the cache renewal worker does, calling the route
+    update listeners if notify
+    """
+    def update_route(route_short_name, edit, notify=True):
+        detail = json.loads(api._get_cache().get(route_short_name))
+        edit(detail[0])
+        api._get_cache().put(route_short_name, api._route_url(route_short_name), json.dumps(detail).encode())
+        old_route = next(route for route in api.get_all_routes_generator() if route.short_name == route_short_name)
+        new_route = api.Route(old_route.id, old_route.short_name, old_route.long_name, old_route.color, old_route.text_color)
+        new_route.load(use_db=False)
+        with routes_db.writer() as writer:
+            writer.execute("UPDATE routes SET route = ? WHERE id = ?", (pickle.dumps(new_route), new_route.id))
+            api._index_route(writer, new_route)
+            api._bump_data_version(writer, [new_route.id])
+        if notify:
+            for listener in api.route_update_listeners:
+                listener(old_route, new_route)
+        return new_route
+    return update_route
+
+
+@pytest.fixture
+def start_server(routes_db, monkeypatch):
+    """start_server(snapshot=False): runs server.py on the route database
+    built from the stub API (in snapshot mode if snapshot), without its
+    background workers, and returns the module
+    """
+    monkeypatch.setattr(cmpy, "start_cache_renewal_worker", lambda *args, **kwargs: None)
+    monkeypatch.setattr(cmpy, "start_day_timetable_worker", lambda *args, **kwargs: None)
+
+    def start_server(snapshot=False):
+        if snapshot:
+            monkeypatch.setenv("CMPY_SNAPSHOT", "1")
+        else:
+            monkeypatch.delenv("CMPY_SNAPSHOT", raising=False)
+        spec = importlib.util.spec_from_file_location("server", SERVER)
+        server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(server)
+        return server
+    return start_server
@@ -0,0 +1,81 @@
+import datetime
+
+from cmpy import api, boards
+
+
+def departures(stop_ids, when, n=10):
+    return [(departure.time.strftime("%d %H:%M"), departure.route_short_name, departure.trip_id)
+            for departure in boards.next_departures(stop_ids, when, n)]
+
+
+def test_next_departures(routes_db):
+    boards.find_or_build_departure_boards()
+    # Thursday: the weekday trips, and the night route
+    assert departures(["060002"], datetime.datetime(2023, 6, 29, 8, 0)) == [
+        ("29 08:06", "1001", "1001_0_1"),
+        ("29 08:36", "1001", "1001_0_2"),
+        ("29 17:05", "1001", "1001_1_1"),
+        ("29 23:55", "1003", "1003_0_1"),
+    ]
+    assert departures(["060002"], datetime.datetime(2023, 6, 29, 8, 0), n=1) == [("29 08:06", "1001", "1001_0_1")]
+    # Saturday: only the weekend trip, and no departures from the last stop
+    assert departures(["060002", "060003"], datetime.datetime(2023, 7, 1, 0, 0)) == [
+        ("01 09:07", "1001", "1001_0_3"),
+        ("01 23:55", "1003", "1003_0_1"),
+    ]
+
+
+def test_departures_past_midnight(routes_db):
+    boards.find_or_build_departure_boards()
+    # the night trip of Friday leaves Marquês de Pombal at 24:05:30
+    departure = boards.next_departures(["060005"], datetime.datetime(2023, 7, 1, 0, 0), n=1)[0]
+    assert (departure.time, departure.trip_id) == (datetime.datetime(2023, 7, 1, 0, 5, 30), "1003_0_1")
+    assert departure.departure_time == api.time_to_seconds("24:05:30")
+
+
+def test_boards_rebuilt_after_resumed_build(routes_db, monkeypatch):
+    # a build interrupted before writing 1003_0, with the boards built then
+    with routes_db.writer() as writer:
+        writer.execute("DELETE FROM routes WHERE id = '1003_0'")
+        writer.execute("DELETE FROM stop_routes WHERE route_id = '1003_0'")
+        writer.execute("CREATE TABLE build_checkpoints (route_id TEXT PRIMARY KEY, built_at REAL)")
+        writer.execute("INSERT INTO build_checkpoints (route_id, built_at) VALUES ('1001_0', 0), ('1002_0', 0)")
+        writer.execute(f"PRAGMA user_version = {-api.ROUTES_DB_VERSION}")
+    boards.find_or_build_departure_boards()
+    # the next start resumes the build
+    monkeypatch.setattr(api, "db", None)
+    api.find_or_build_route_db()
+    boards.find_or_build_departure_boards()
+    assert [departure.trip_id for departure in boards.next_departures(["060005"], datetime.datetime(2023, 6, 29, 20, 0))] == [
+        "1003_0_1"]
+
+
+def test_route_update_before_the_boards_are_built(routes_db, update_route):
+    # the boards of the stops of 1002 alone must not pass for all the boards
+    update_route("1002", lambda detail: detail["directions"][0]["trips"].pop())
+    boards.find_or_build_departure_boards()
+    assert sorted(stop_id for (stop_id,) in routes_db.reader().execute("SELECT stop_id FROM departure_boards")) == [
+        "060001", "060002", "060003", "060004", "060005"]
+
+
+def test_route_update_rebuilds_the_boards_of_its_stops(routes_db, update_route):
+    boards.find_or_build_departure_boards()
+    assert [departure.trip_id for departure in boards.next_departures(["060005"], datetime.datetime(2023, 6, 29, 8, 0))] == [
+        "1002_0_1", "1002_0_2", "1003_0_1"]
+    update_route("1002", lambda detail: detail["directions"][0]["trips"].pop())
+    assert [departure.trip_id for departure in boards.next_departures(["060005"], datetime.datetime(2023, 6, 29, 8, 0))] == [
+        "1002_0_1", "1003_0_1"]
+
+
+def test_departures_endpoint(start_server):
+    client = start_server().app.test_client()
+    response = client.get("/departures?stops=060002,060005&when=2023-06-29T08:10&n=2")
+    assert response.status_code == 200
+    assert [(departure["stopId"], departure["t0"], departure["lineId"]) for departure in response.json] == [
+        ("060005", "08:24:30", "1002"), ("060002", "08:36:30", "1001")]
+    assert len(client.get("/departures?stops=060002&when=2023-06-29T00:00&n=1000").json) == 4
+    for query in ["", "stops=", "stops=" + ",".join(["060002"] * 51), "stops=060002&n=x", "stops=060002&n=-1",
+                  "stops=060002&when=tomorrow"]:
+        response = client.get("/departures?" + query)
+        assert response.status_code == 400, query
+        assert "error" in response.json
@@ -0,0 +1,59 @@
+import os
+import pickle
+
+import requests
+
+from cmpy import cache
+
+
+def pickled_response(path, url, body, etag=None):
+    """Writes a requests.Response as the old cache pickled it"""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = body
+    if etag is not None:
+        response.headers["ETag"] = etag
+    with open(path, "wb") as f:
+        pickle.dump(response, f)
+
+
+def test_put_get(tmp_path):
+    response_cache = cache.ResponseCache(tmp_path)
+    assert response_cache.get("1001") is None
+    response_cache.put("1001", "http://api/1001", b'[{"route_id": "1001_0"}]', etag='"a"')
+    assert response_cache.get("1001") == b'[{"route_id": "1001_0"}]'
+    entry = response_cache.get_entry("1001")
+    assert (entry.url, entry.etag, entry.last_modified) == ("http://api/1001", '"a"', None)
+    response_cache.delete("1001")
+    assert response_cache.get("1001") is None and response_cache.get_entry("1001") is None
+
+
+def test_migrate_pickles(tmp_path):
+    pickled_response(tmp_path / "1001.pkl", "http://api/1001", b'[{"route_id": "1001_0"}]', etag='"a"')
+    pickled_response(tmp_path / "routes_summary.pkl", "http://api/summary", b"[]")
+    os.utime(tmp_path / "1001.pkl", (1_600_000_000, 1_600_000_000))
+    # pickles of other objects are left alone
+    with open(tmp_path / "stops.pkl", "wb") as f:
+        pickle.dump({"060001": "Campo Grande"}, f)
+    with open(tmp_path / "broken.pkl", "wb") as f:
+        f.write(b"not a pickle")
+
+    response_cache = cache.ResponseCache(tmp_path)
+    assert response_cache.migrate_pickles() == 2
+    assert response_cache.get("1001") == b'[{"route_id": "1001_0"}]'
+    entry = response_cache.get_entry("1001")
+    assert (entry.url, entry.etag, entry.fetched_at) == ("http://api/1001", '"a"', 1_600_000_000)
+    assert response_cache.get("routes_summary") == b"[]"
+    pickles = {filename for filename in os.listdir(tmp_path) if filename.endswith(".pkl")}
+    assert pickles == {"stops.pkl", "broken.pkl"}
+    assert response_cache.migrate_pickles() == 0
+
+
+def test_migrate_pickles_keeps_newer_entries(tmp_path):
+    response_cache = cache.ResponseCache(tmp_path)
+    response_cache.put("1001", "http://api/1001", b"new")
+    pickled_response(tmp_path / "1001.pkl", "http://api/1001", b"old")
+    assert response_cache.migrate_pickles() == 1
+    assert response_cache.get("1001") == b"new"
+    assert not os.path.exists(tmp_path / "1001.pkl")
@@ -0,0 +1,99 @@
+import datetime
+import os
+import pickle
+
+from cmpy import api, daily, lib
+
+THURSDAY = datetime.date(2023, 6, 29)
+DAYS = ["20230629", "20230630", "20230701"]
+SALDANHA = [api.Stop("060003", "Saldanha", "", ""), api.Stop("060004", "Saldanha", "", "")]
+QUERIES = [
+    ([api.Stop("060001", "Campo Grande", "", "")], SALDANHA),
+    (SALDANHA, [api.Stop("060006", "Rossio", "", "")]),
+    ([api.Stop("060002", "Entrecampos", "", "")], [api.Stop("060005", "Marquês de Pombal", "", "")]),
+    (SALDANHA, [api.Stop("060001", "Campo Grande", "", "")]),
+]
+
+
+def trips(tripABs):
+    return [(tripAB.origin_stop.id, tripAB.destination_stop.id, tripAB.origin_time, tripAB.destination_time, tripAB.trip.trip_id)
+            for tripAB in tripABs]
+
+
+def assert_same_as_routes_db():
+    for day in DAYS:
+        for origins, destinations in QUERIES:
+            expected = sorted(lib.get_trips_routes_db(origins, destinations, day), key=lambda x: x.origin_time)
+            assert trips(daily.get_trips_materialized(origins, destinations, day)) == trips(expected)
+
+
+def drop_last_trip(detail):
+    detail["directions"][0]["trips"].pop()
+
+
+def test_day_timetables(routes_db):
+    day_timetables = daily.find_or_build_day_timetables(3, THURSDAY)
+    assert sorted(day_timetables) == DAYS
+    assert sorted(os.listdir(daily.day_timetables_dir)) == [day + ".pkl" for day in DAYS]
+    assert_same_as_routes_db()
+    assert trips(daily.get_trips_materialized(*QUERIES[1], "20230629")) == [
+        ("060003", "060006", 30000, 30750, "1002_0_1"),
+        ("060003", "060006", 31800, 32550, "1002_0_2"),
+    ]
+    # not materialized
+    assert trips(daily.get_trips_materialized(*QUERIES[1], "20230703"))[0][4] == "1002_0_1"
+
+
+def test_saved_day_timetables_get_the_routes_written_since(routes_db, update_route, monkeypatch):
+    daily.find_or_build_day_timetables(3, THURSDAY)
+    # written by another process, e.g. before a restart
+    update_route("1002", drop_last_trip, notify=False)
+    monkeypatch.setattr(daily, "day_timetables", {})
+    day_timetables = daily.find_or_build_day_timetables(3, THURSDAY)
+    assert [trip_id for *_, trip_id in trips(daily.get_trips_materialized(*QUERIES[1], "20230629"))] == ["1002_0_1"]
+    assert_same_as_routes_db()
+    _, data_version = api.get_data_version()
+    assert all(day_timetable.data_version == data_version for day_timetable in day_timetables.values())
+
+
+def test_saved_day_timetables_of_another_database_are_rebuilt(routes_db, monkeypatch):
+    daily.find_or_build_day_timetables(3, THURSDAY)
+    with routes_db.writer() as writer:
+        writer.execute("UPDATE meta SET value = 'another' WHERE key = 'database_id'")
+    monkeypatch.setattr(daily, "day_timetables", {})
+    day_timetables = daily.find_or_build_day_timetables(3, THURSDAY)
+    assert {day_timetable.database_id for day_timetable in day_timetables.values()} == {"another"}
+    assert_same_as_routes_db()
+
+
+def test_route_update_replaces_the_days_it_runs_on(routes_db, update_route):
+    before = dict(daily.find_or_build_day_timetables(3, THURSDAY))
+    update_route("1002", drop_last_trip)
+    # 1002 only runs on weekdays
+    assert daily.day_timetables["20230701"] is before["20230701"]
+    assert daily.day_timetables["20230629"] is not before["20230629"]
+    assert_same_as_routes_db()
+    with open(os.path.join(daily.day_timetables_dir, "20230630.pkl"), "rb") as f:
+        saved = pickle.load(f)
+    assert trips(saved.get_trips(*QUERIES[1])) == trips(daily.get_trips_materialized(*QUERIES[1], "20230630"))
+    assert saved.data_version == api.get_data_version()[1]
+
+
+def test_route_update_during_the_build(routes_db, update_route, monkeypatch):
+    daily.find_or_build_day_timetables(3, THURSDAY)
+    build_day_timetables = daily.build_day_timetables
+
+    def build_then_update(days):
+        built = build_day_timetables(days)
+        # written by the cache renewal worker while the new day was built
+        update_route("1002", drop_last_trip)
+        return built
+    monkeypatch.setattr(daily, "build_day_timetables", build_then_update)
+    # Thursday to Monday, which is built
+    day_timetables = daily.find_or_build_day_timetables(5, THURSDAY)
+    assert sorted(day_timetables) == DAYS + ["20230702", "20230703"]
+    for day in ["20230629", "20230703"]:
+        assert [trip_id for *_, trip_id in trips(daily.get_trips_materialized(*QUERIES[1], day))] == ["1002_0_1"]
+        with open(os.path.join(daily.day_timetables_dir, day + ".pkl"), "rb") as f:
+            assert [trip_id for *_, trip_id in trips(pickle.load(f).get_trips(*QUERIES[1]))] == ["1002_0_1"]
+    assert_same_as_routes_db()
@@ -0,0 +1,54 @@
+import pytest
+
+from cmpy import api, engine, lib
+
+SALDANHA = ["060003", "060004"]
+QUERIES = [(["060001"], SALDANHA), (SALDANHA, ["060006"]), (["060002"], ["060005", "060006"]), (SALDANHA, ["060001"])]
+DAYS = ["20230629", "20230701", "20230702", "20230704"]
+
+
+def trips(tripABs):
+    return [(tripAB.origin_stop.id, tripAB.destination_stop.id, tripAB.origin_time, tripAB.destination_time,
+             tripAB.route.short_name, tripAB.trip.trip_id, tripAB.trip.service_id, tripAB.trip.direction)
+            for tripAB in tripABs]
+
+
+def sort(tripABs):
+    return sorted(tripABs, key=lambda x: (x.origin_time, x.trip.trip_id, x.destination_stop.id))
+
+
+@pytest.fixture
+def stops(routes_db):
+    return {stop_id: api.Stop(stop_id, "", "", "") for stop_id in ["060001", "060002", "060003", "060004", "060005", "060006"]}
+
+
+@pytest.mark.parametrize("threshold", [0, 16])
+def test_get_trips(stops, threshold):
+    # threshold 0 sends every query to the shards, 16 runs them all in-process
+    query_engine = engine.QueryEngine(n_workers=2, threshold=threshold)
+    try:
+        for origin_ids, destination_ids in QUERIES:
+            origins = [stops[stop_id] for stop_id in origin_ids]
+            destinations = [stops[stop_id] for stop_id in destination_ids]
+            for day in DAYS:
+                tripABs = query_engine.get_trips(origins, destinations, day)
+                assert [tripAB.origin_time for tripAB in tripABs] == sorted(tripAB.origin_time for tripAB in tripABs)
+                assert trips(sort(tripABs)) == trips(sort(lib.get_trips_routes_db(origins, destinations, day)))
+                # the caller's stops are returned
+                assert all(tripAB.origin_stop in origins and tripAB.destination_stop in destinations for tripAB in tripABs)
+    finally:
+        query_engine.close()
+    assert query_engine._on_route_updated not in api.route_update_listeners
+    assert not any(process.is_alive() for process in query_engine.processes)
+
+
+def test_shards_reload_updated_routes(stops, update_route):
+    query_engine = engine.QueryEngine(n_workers=2, threshold=0)
+    try:
+        origins, destinations = [stops["060003"]], [stops["060006"]]
+        assert [tripAB.trip.trip_id for tripAB in query_engine.get_trips(origins, destinations, "20230629")] == [
+            "1002_0_1", "1002_0_2"]
+        update_route("1002", lambda detail: detail["directions"][0]["trips"].pop())
+        assert [tripAB.trip.trip_id for tripAB in query_engine.get_trips(origins, destinations, "20230629")] == ["1002_0_1"]
+    finally:
+        query_engine.close()
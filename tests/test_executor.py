@@ -0,0 +1,68 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from cmpy import executor
+
+
+def test_identical_queries_share_a_run():
+    query_executor = executor.QueryExecutor(max_workers=2)
+    release = threading.Event()
+    runs = []
+
+    def compute():
+        runs.append(1)
+        release.wait(5)
+        return "trips"
+
+    futures = [query_executor.submit("key", compute) for _ in range(5)]
+    other = query_executor.submit("other", lambda: "other trips")
+    release.set()
+    assert [future.result(5) for future in futures] == ["trips"] * 5
+    assert other.result(5) == "other trips"
+    assert len(runs) == 1
+    stats = query_executor.stats()
+    assert (stats["submitted"], stats["coalesced"]) == (2, 4)
+    # finished queries run again
+    assert query_executor.run("key", lambda: "new trips", 5) == "new trips"
+    query_executor.shutdown()
+
+
+def test_queue_full():
+    query_executor = executor.QueryExecutor(max_workers=1, max_pending=2)
+    release = threading.Event()
+    query_executor.submit(1, lambda: release.wait(5))
+    query_executor.submit(2, lambda: release.wait(5))
+    with pytest.raises(executor.QueueFullError):
+        query_executor.submit(3, lambda: None)
+    # joining a pending query is still possible
+    query_executor.submit(2, lambda: None)
+    release.set()
+    assert query_executor.stats()["rejected"] == 1
+    query_executor.shutdown()
+
+
+def test_timeout():
+    query_executor = executor.QueryExecutor(max_workers=1)
+    release = threading.Event()
+    with pytest.raises(concurrent.futures.TimeoutError):
+        query_executor.run("slow", lambda: release.wait(5) and "done", timeout=0.05)
+    assert query_executor.stats()["timeouts"] == 1
+    # the query keeps running, and later callers get its result
+    future = query_executor.submit("slow", lambda: "again")
+    release.set()
+    assert future.result(5) == "done"
+    query_executor.shutdown()
+
+
+def test_busy_server(start_server):
+    server = start_server()
+    server.query_executor = executor.QueryExecutor(max_workers=1, max_pending=1)
+    release = threading.Event()
+    server.query_executor.submit("busy", lambda: release.wait(5))
+    client = server.app.test_client()
+    response = client.get("/trips?origin=060003&destination=060006&date=2023-06-29")
+    assert (response.status_code, response.headers["Retry-After"]) == (503, "5")
+    release.set()
+    server.query_executor.shutdown()
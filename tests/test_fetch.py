@@ -0,0 +1,64 @@
+import json
+
+import requests
+
+from cmpy import api
+
+
+def route_path(route_short_name: str) -> str:
+    return f"/routes/route_short_name/{route_short_name}"
+
+
+def test_prefetch_is_concurrent(api_stub):
+    # 8 copies of a recorded route, each answered after 0.1 s
+    api_stub.delay = 0.1
+    names = [f"90{i:02d}" for i in range(8)]
+    for name in names:
+        api_stub.bodies[route_path(name)] = api_stub.bodies[route_path("1001")]
+    assert api.prefetch_routes(names, workers=4, progress=lambda *args: None) == {}
+    assert 1 < api_stub.max_in_flight <= 4
+    for name in names:
+        assert json.loads(api._get_cache().get(name))[0]["route_id"] == "1001_0"
+
+
+def test_prefetch_retries_a_failing_route(api_stub):
+    api_stub.failures[route_path("1002")] = [503]
+    assert api.prefetch_routes(["1001", "1002"], progress=lambda *args: None) == {}
+    assert api_stub.hits[route_path("1002")] == 2
+    assert json.loads(api._get_cache().get("1002"))[0]["route_id"] == "1002_0"
+
+
+def test_prefetch_reports_permanent_failures(api_stub):
+    failed = api.prefetch_routes(["1001", "9999", "1003"], progress=lambda *args: None)
+    assert list(failed) == ["9999"]
+    assert isinstance(failed["9999"], requests.exceptions.HTTPError)
+    assert api._get_cache().get_entry("9999") is None
+    # only the failed route is fetched again
+    assert api.prefetch_routes(["1001", "9999", "1003"], progress=lambda *args: None).keys() == {"9999"}
+    assert api_stub.hits == {route_path("1001"): 1, route_path("9999"): 2, route_path("1003"): 1}
+
+
+def test_prefetch_progress(api_stub):
+    calls = []
+    failed = api.prefetch_routes(["1001", "1002", "1003", "9999"], workers=2,
+                                 progress=lambda done, total, name: calls.append((done, total, name)))
+    assert [(done, total) for done, total, _ in calls] == [(1, 4), (2, 4), (3, 4), (4, 4)]
+    assert sorted(name for _, _, name in calls) == ["1001", "1002", "1003", "9999"]
+    assert list(failed) == ["9999"]
+    # cached routes aren't fetched, nor reported
+    calls.clear()
+    assert api.prefetch_routes(["1001", "1002"], progress=lambda *args: calls.append(args)) == {}
+    assert calls == []
+
+
+def test_route_db_built_from_the_api(routes_db):
+    assert sorted(route.id for route in api.get_all_routes_generator()) == ["1001_0", "1002_0", "1003_0"]
+    assert sorted(api.get_route_ids_serving(["060002"], ["060006"])) == ["1003_0"]
+    assert sorted(api.get_route_ids_serving(["060003"], ["060002"])) == ["1001_0"]
+    route = api.get_route("1001_0")
+    assert route.long_name == "Campo Grande - Saldanha"
+    assert sorted(trip.trip_id for trip in route.trips) == ["1001_0_1", "1001_0_2", "1001_0_3", "1001_1_1"]
+    _, version = api.get_data_version()
+    assert version > 0
+    assert sorted(api.get_routes_changed_since(0)) == ["1001_0", "1002_0", "1003_0"]
+    assert api.get_routes_changed_since(version) == []
@@ -0,0 +1,161 @@
+import datetime
+
+import pytest
+
+import cmpy
+from cmpy import api, daily, journey
+
+
+DAY = "20230629"
+CALENDAR = api.intern_calendar("weekday", [DAY])
+
+
+def day_timetable(trips: dict[str, list[tuple[str, int]]]) -> daily.DayTimetable:
+    """A timetable with one route per trip, trips given as (stop id, seconds)"""
+    day_timetable = daily.DayTimetable(DAY)
+    for trip_id, stop_times in trips.items():
+        route = api.Route(trip_id, trip_id, f"Linha {trip_id}", "", "", fetch=False)
+        day_pattern = daily.DayPattern(route, "0", tuple(stop_id for stop_id, _ in stop_times))
+        day_pattern.trips.append(api.Trip(trip_id, "weekday", CALENDAR, "0"))
+        day_pattern.arrivals.extend(seconds for _, seconds in stop_times)
+        day_pattern.departures.extend(seconds for _, seconds in stop_times)
+        day_timetable.route_patterns[route.id] = [day_pattern]
+        day_timetable._index([day_pattern])
+    return day_timetable
+
+
+def planner(monkeypatch, stops, trips) -> journey.JourneyPlanner:
+    monkeypatch.setattr(daily, "day_timetables", {DAY: day_timetable(trips)})
+    return journey.JourneyPlanner(stops)
+
+
+# A, B and C share a name, A-B and B-C are about 400 m apart, A-C about 800 m,
+# so only A-B and B-C are walking transfers
+O = api.Stop("O", "Origem", "38.70", "-9.10")
+A = api.Stop("A", "Praça", "38.70", "-9.0000")
+B = api.Stop("B", "Praça", "38.70", "-9.0046")
+C = api.Stop("C", "Praça", "38.70", "-9.0092")
+D = api.Stop("D", "Destino", "38.80", "-9.00")
+
+
+def test_walk_from_a_stop_keeps_its_trip(monkeypatch):
+    # T1 reaches B, and C by walking from B. T2, scanned later, reaches A
+    # earlier, and walking from A improves B. The walk to C must still start
+    # from T1's arrival at B
+    trips = {
+        "T1": [("O", 0), ("B", 1000)],
+        "T2": [("O", 10), ("A", 500)],
+        "T3": [("C", 1400), ("D", 2000)],
+    }
+    journeys = planner(monkeypatch, [O, A, B, C, D], trips).journeys([O], [D], DAY, 0, max_transfers=1)
+    assert len(journeys) == 1
+    legs = journeys[0].legs
+    assert [type(leg) for leg in legs] == [api.TripAB, journey.Walk, api.TripAB]
+    assert (legs[0].origin_stop.id, legs[0].destination_stop.id, legs[0].trip.trip_id) == ("O", "B", "T1")
+    assert (legs[1].origin_stop.id, legs[1].destination_stop.id) == ("B", "C")
+    assert legs[1].origin_time == 1000 and legs[1].destination_time <= 1400
+    assert (legs[2].origin_stop.id, legs[2].destination_stop.id, legs[2].trip.trip_id) == ("C", "D", "T3")
+    assert journeys[0].transfers == 1
+
+
+def test_direct_and_faster_transfer(monkeypatch):
+    trips = {
+        "T1": [("O", 100), ("D", 3000)],
+        "T2": [("O", 200), ("A", 800)],
+        "T3": [("A", 900), ("D", 1500)],
+    }
+    journeys = planner(monkeypatch, [O, A, D], trips).journeys([O], [D], DAY, 0, max_transfers=1)
+    assert [(j.transfers, j.departure_time, j.arrival_time) for j in journeys] == [(0, 100, 3000), (1, 200, 1500)]
+
+
+def test_missed_connection(monkeypatch):
+    trips = {
+        "T2": [("O", 200), ("A", 800)],
+        "T3": [("A", 700), ("D", 1500)],
+    }
+    assert planner(monkeypatch, [O, A, D], trips).journeys([O], [D], DAY, 0, max_transfers=1) == []
+
+
+def test_reachable(monkeypatch):
+    trips = {
+        "T1": [("O", 0), ("B", 1000)],
+        "T3": [("C", 1400), ("D", 2000)],
+    }
+    reached = planner(monkeypatch, [O, A, B, C, D], trips).reachable([O], DAY, 0, max_duration=1800)
+    assert [(stop.id, seconds) for stop, seconds in reached] == [("O", 0), ("B", 1000), ("C", 1333)]
+
+
+def test_days_are_built_outside_the_lock(routes_db, update_route, monkeypatch):
+    stops = cmpy.get_all_stops()
+    journey_planner = journey.JourneyPlanner(stops)
+    build_day_timetables = daily.build_day_timetables
+    locked = []
+
+    def build(days):
+        locked.append(journey_planner._lock.locked())
+        built = build_day_timetables(days)
+        # 1002 loses its last trip while the day is built
+        if len(locked) == 1:
+            update_route("1002", lambda detail: detail["directions"][0]["trips"].pop())
+        return built
+    monkeypatch.setattr(daily, "build_day_timetables", build)
+    saldanha = [stop for stop in stops if stop.id == "060003"]
+    rossio = [stop for stop in stops if stop.id == "060006"]
+    journeys = journey_planner.journeys(saldanha, rossio, "20230629", api.time_to_seconds("08:30"))
+    assert locked == [False]
+    # built before the update, so not kept: the next query builds the day again
+    assert [journey.legs[0].trip.trip_id for journey in journeys] == ["1002_0_2"]
+    assert journey_planner.journeys(saldanha, rossio, "20230629", api.time_to_seconds("08:30")) == []
+    assert locked == [False, False]
+    journey_planner.journeys(saldanha, rossio, "20230629", 0)
+    assert len(locked) == 2
+    with pytest.raises(ValueError):
+        journey_planner.journeys(saldanha, rossio, "20230629", 0, max_transfers=-1)
+
+
+def test_journey_endpoint(start_server):
+    server = start_server()
+    daily.find_or_build_day_timetables(3, datetime.date(2023, 6, 29))
+    client = server.app.test_client()
+    response = client.get("/journey?origin=060001&destination=060006&date=2023-06-29&time=07:00")
+    assert response.status_code == 200
+    assert [[(leg["type"], leg["from"], leg["to"], leg["t0"]) for leg in journey["legs"]] for journey in response.json["journeys"]] == [
+        [("trip", "060001", "060003", "08:00:00"), ("trip", "060003", "060006", "08:20:00")]]
+    assert client.get("/journey?origin=060001&destination=060006&date=2023-06-29&time=07:00&transfers=0").json["journeys"] == []
+    # more transfers are capped
+    assert client.get("/journey?origin=060001&destination=060006&date=2023-06-29&time=07:00&transfers=100").status_code == 200
+    for query in ["origin=060001&destination=060006", "origin=060001&destination=060006&date=tomorrow",
+                  "origin=060001&destination=999999&date=2023-06-29",
+                  # not materialized
+                  "origin=060001&destination=060006&date=2023-07-03",
+                  "origin=060001&destination=060006&date=2023-06-29&time=x",
+                  "origin=060001&destination=060006&date=2023-06-29&time=8",
+                  "origin=060001&destination=060006&date=2023-06-29&time=-1:00",
+                  "origin=060001&destination=060006&date=2023-06-29&transfers=-1",
+                  "origin=060001&destination=060006&date=2023-06-29&transfers=x"]:
+        response = client.get("/journey?" + query)
+        assert response.status_code == 400, query
+        assert "error" in response.json
+    assert "2023-06-29 to 2023-07-01" in client.get("/journey?origin=060001&destination=060006&date=2023-07-03").json["error"]
+
+
+def test_isochrone_endpoint(start_server):
+    server = start_server()
+    daily.find_or_build_day_timetables(3, datetime.date(2023, 6, 29))
+    client = server.app.test_client()
+    response = client.get("/isochrone?origin=060003&date=2023-06-29&time=08:15&minutes=20")
+    assert response.status_code == 200
+    assert [(stop["id"], stop["tf"]) for stop in response.json["stops"]] == [
+        ("060003", "08:15:00"), ("060004", "08:15:00"), ("060005", "08:24:00"), ("060006", "08:32:30")]
+    assert [stop["id"] for stop in client.get("/isochrone?origin=060003&date=2023-06-29&time=08:15&minutes=10").json["stops"]] == [
+        "060003", "060004", "060005"]
+    # minutes are kept within 1 and max_isochrone_minutes
+    assert client.get("/isochrone?origin=060003&date=2023-06-29&minutes=0").json["minutes"] == 1
+    assert client.get("/isochrone?origin=060003&date=2023-06-29&minutes=100000").json["minutes"] == server.max_isochrone_minutes
+    assert client.get("/isochrone?origin=060003&date=2023-06-29&transfers=100").status_code == 200
+    for query in ["origin=060003", "origin=999999&date=2023-06-29", "origin=060003&date=2023-07-03",
+                  "origin=060003&date=2023-06-29&time=x", "origin=060003&date=2023-06-29&minutes=-5",
+                  "origin=060003&date=2023-06-29&minutes=1.5", "origin=060003&date=2023-06-29&transfers=-1"]:
+        response = client.get("/isochrone?" + query)
+        assert response.status_code == 400, query
+        assert "error" in response.json
@@ -0,0 +1,139 @@
+import gzip
+import os
+import pickle
+
+import pytest
+
+from cmpy import api, lib
+
+
+def test_get_all_stops(api_stub):
+    stops = lib.get_all_stops()
+    # Saldanha and Entrecampos are served by several routes, found once
+    assert sorted(stop.id for stop in stops) == ["060001", "060002", "060003", "060004", "060005", "060006"]
+    assert os.path.exists(os.path.join("cache", "stops.pkl"))
+    # later calls load the saved catalog, without the API
+    api_stub.bodies.clear()
+    assert lib.get_all_stops() == stops
+
+
+def test_stops_endpoint(start_server):
+    client = start_server().app.test_client()
+    response = client.get("/stops")
+    assert response.status_code == 200
+    assert [stop["id"] for stop in response.json] == ["060001", "060002", "060005", "060006", "060003", "060004"]
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "public, max-age=3600"
+    assert client.get("/stops", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/stops", headers={"If-None-Match": '"other"'}).status_code == 200
+    response = client.get("/stops", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data) == client.get("/stops").data
+
+
+def trips(tripABs):
+    return [(tripAB.origin_stop.id, tripAB.destination_stop.id, tripAB.origin_time, tripAB.trip.trip_id) for tripAB in tripABs]
+
+
+def test_get_trips_batch(routes_db):
+    stops = {stop.id: stop for stop in lib.get_all_stops()}
+    saldanha = [stops["060003"], stops["060004"]]
+    queries = [
+        ([stops["060001"]], saldanha, "20230629"),
+        (saldanha, [stops["060006"]], ("20230629", "20230702")),
+        ([stops["060002"]], [stops["060005"], stops["060006"]], ("20230630", "20230701")),
+        # no route from Rossio
+        ([stops["060006"]], [stops["060001"]], "20230629"),
+    ]
+    results = lib.get_trips_batch(queries)
+    assert [list(result) for result in results] == [
+        ["20230629"], ["20230629", "20230630", "20230701", "20230702"], ["20230630", "20230701"], ["20230629"]]
+    for (origins, destinations, _), result in zip(queries, results):
+        for day, tripABs in result.items():
+            expected = sorted(lib.get_trips_routes_db(origins, destinations, day), key=lambda x: x.origin_time)
+            assert trips(tripABs) == trips(expected), day
+    assert trips(results[1]["20230701"]) == []
+    assert [tripAB.trip.trip_id for tripAB in results[2]["20230701"]] == ["1003_0_1", "1003_0_1"]
+
+
+def test_trips_batch_endpoint(start_server):
+    client = start_server().app.test_client()
+    response = client.post("/trips/batch", json={"queries": [
+        {"origin": "060003", "destination": "060006", "date": "2023-06-29"},
+        {"origin": "060001", "destination": "060004", "from": "2023-06-30", "to": "2023-07-01"},
+    ]})
+    assert response.status_code == 200
+    first, second = response.json["results"]
+    assert [trip["t0"] for trip in first["days"]["2023-06-29"]] == ["08:20:00", "08:50:00"]
+    assert {day: [trip["t0"] for trip in day_trips] for day, day_trips in second["days"].items()} == {
+        "2023-06-30": ["08:00:00", "08:30:00"], "2023-07-01": ["09:00:00"]}
+    for body in [None, {}, {"queries": "x"}, {"queries": [1]}, {"queries": [{"origin": "060003"}]},
+                 {"queries": [{"origin": "060003", "destination": "999999", "date": "2023-06-29"}]},
+                 {"queries": [{"origin": "060003", "destination": "060006", "date": 20230629}]},
+                 {"queries": [{"origin": "060003", "destination": "060006", "from": "2023-07-01", "to": "2023-06-29"}]},
+                 {"queries": [{"origin": "060003", "destination": "060006", "from": "2023-01-01", "to": "2023-12-31"}]},
+                 {"queries": [{"origin": "060003", "destination": "060006", "date": "2023-06-29"}] * 1001},
+                 {"queries": [{"origin": "060003", "destination": "060006", "from": "2023-06-01", "to": "2023-06-30"}] * 40}]:
+        response = client.post("/trips/batch", json=body)
+        assert response.status_code == 400, body
+        assert "error" in response.json
+
+
+def page(origin_ids, destination_ids, days, window=None, page=0, page_size=None):
+    stops = {stop.id: stop for stop in lib.get_all_stops()}
+    tripABs, total = lib.get_trips_page([stops[stop_id] for stop_id in origin_ids], [stops[stop_id] for stop_id in destination_ids],
+                                        days, window, page, page_size)
+    return [(day, api.seconds_to_time(tripAB.origin_time), tripAB.trip.trip_id) for day, tripAB in tripABs], total
+
+
+def test_get_trips_page_window(routes_db):
+    assert page(["060003"], ["060006"], "20230629", ("08:20", "08:50")) == (
+        [("20230629", "08:20:00", "1002_0_1"), ("20230629", "08:50:00", "1002_0_2")], 2)
+    # the window is inclusive at both ends
+    assert page(["060003"], ["060006"], "20230629", ("08:20:01", "08:50")) == ([("20230629", "08:50:00", "1002_0_2")], 1)
+    assert page(["060003"], ["060006"], "20230629", ("08:00", "08:49:59")) == ([("20230629", "08:20:00", "1002_0_1")], 1)
+    assert page(["060003"], ["060006"], "20230629", ("08:21", "08:49")) == ([], 0)
+    # at an intermediate stop, and past midnight
+    assert page(["060005"], ["060006"], "20230629", ("08:24:30", "24:05:30")) == (
+        [("20230629", "08:24:30", "1002_0_1"), ("20230629", "08:54:30", "1002_0_2"), ("20230629", "24:05:30", "1003_0_1")], 3)
+
+
+def test_get_trips_page_paging(routes_db):
+    everything = [("20230629", "08:20:00", "1002_0_1"), ("20230629", "08:50:00", "1002_0_2"),
+                  ("20230630", "08:20:00", "1002_0_1"), ("20230630", "08:50:00", "1002_0_2"),
+                  ("20230703", "08:20:00", "1002_0_1"), ("20230703", "08:50:00", "1002_0_2")]
+    # the weekend has no trips, and the total counts every page
+    assert page(["060003"], ["060006"], ("20230629", "20230703")) == (everything, 6)
+    assert page(["060003"], ["060006"], ("20230629", "20230703"), page_size=4) == (everything[:4], 6)
+    assert page(["060003"], ["060006"], ("20230629", "20230703"), page=1, page_size=4) == (everything[4:], 6)
+    assert page(["060003"], ["060006"], ("20230629", "20230703"), page=2, page_size=4) == ([], 6)
+    assert page(["060003"], ["060006"], ("20230630", "20230702"), ("08:30", "09:00")) == ([("20230630", "08:50:00", "1002_0_2")], 1)
+    with pytest.raises(ValueError):
+        page(["060003"], ["060006"], "20230629", page=-1, page_size=10)
+
+
+def test_rows_departing_between():
+    calendar = api.intern_calendar("DU", ["20230629"])
+    # the express (row 1) leaves after the first trip and overtakes it
+    overtaking = api.Pattern("0", ("A", "B", "C"), ("A", "B", "C"), (1, 2, 3))
+    for trip_id, departures in [("slow", [100, 200, 300]), ("express", [150, 180, 210]), ("last", [400, 500, 600])]:
+        overtaking.add_trip(api.Trip(trip_id, "DU", calendar, "0"), departures, departures)
+    in_order = api.Pattern("0", ("A", "B"), ("A", "B"), (1, 2))
+    for trip_id, departures in [("c", [200, 400]), ("a", [100, 200]), ("b", [200, 300])]:
+        in_order.add_trip(api.Trip(trip_id, "DU", calendar, "0"), departures, departures)
+    for pattern, fifo in [(overtaking, False), (in_order, True)]:
+        n = len(pattern.stop_ids)
+        for position in range(n):
+            for start in range(0, 700, 50):
+                for end in range(start, 700, 50):
+                    expected = sorted(row for row in range(len(pattern.trips)) if start <= pattern.departures[row * n + position] <= end)
+                    assert sorted(pattern.rows_departing_between(position, start, end)) == expected, (position, start, end)
+        assert pattern.fifo == fifo
+        # the order goes with the pattern
+        unpickled = pickle.loads(pickle.dumps(pattern))
+        assert (unpickled.departure_order, unpickled.fifo) == (pattern.departure_order, fifo)
+
+
+def test_departure_order_in_the_database(routes_db):
+    for pattern in api.get_route("1001_0").patterns:
+        assert pattern.departure_order is not None and pattern.fifo
@@ -0,0 +1,101 @@
+import hashlib
+import json
+
+import pytest
+
+from cmpy import api
+
+
+def route_path(route_short_name: str) -> str:
+    return f"/routes/route_short_name/{route_short_name}"
+
+
+def drop_last_trip(api_stub, route_short_name):
+    """Serves the route without the last trip of its first direction"""
+    detail = json.loads(api_stub.bodies[route_path(route_short_name)])
+    detail[0]["directions"][0]["trips"].pop()
+    api_stub.bodies[route_path(route_short_name)] = json.dumps(detail).encode()
+
+
+def test_revalidate_not_modified(api_stub):
+    api.prefetch_routes(["1001"], progress=lambda *args: None)
+    cached = api._get_cache().get_entry("1001")
+    body, changed = api._revalidate_cached_request(api._route_url("1001"), "1001")
+    assert api_stub.statuses[-1] == (route_path("1001"), 304)
+    assert (body, changed) == (api._get_cache().get("1001"), False)
+    # only its age is renewed
+    entry = api._get_cache().get_entry("1001")
+    assert entry.fetched_at >= cached.fetched_at and entry.sha256 == cached.sha256
+
+
+def test_revalidate_same_body(api_stub):
+    # without validators the body comes again, and is compared by its hash
+    api_stub.etags = False
+    api.prefetch_routes(["1001"], progress=lambda *args: None)
+    body, changed = api._revalidate_cached_request(api._route_url("1001"), "1001")
+    assert api_stub.statuses[-1] == (route_path("1001"), 200)
+    assert not changed
+    drop_last_trip(api_stub, "1001")
+    body, changed = api._revalidate_cached_request(api._route_url("1001"), "1001")
+    assert changed
+    assert api._get_cache().get("1001") == body == api_stub.bodies[route_path("1001")]
+
+
+def test_revalidate_error_keeps_body(api_stub):
+    api.prefetch_routes(["1001"], progress=lambda *args: None)
+    cached = api._get_cache().get("1001")
+    api_stub.failures[route_path("1001")] = [500] * 4
+    with pytest.raises(Exception):
+        api._revalidate_cached_request(api._route_url("1001"), "1001")
+    assert api._get_cache().get("1001") == cached
+
+
+def test_build_records_route_sources(api_stub, routes_db):
+    for route_short_name in ["1001", "1002", "1003"]:
+        assert api._get_route_source(f"{route_short_name}_0") == hashlib.sha256(api_stub.bodies[route_path(route_short_name)]).digest()
+
+
+@pytest.mark.parametrize("etags", [True, False])
+def test_renew_route(api_stub, routes_db, monkeypatch, etags):
+    api_stub.etags = etags
+    updated = []
+    monkeypatch.setattr(api, "route_update_listeners", [lambda old_route, new_route: updated.append(new_route.id)])
+    version = api.get_data_version()[1]
+    # built from the current responses
+    assert not api._renew_route("1002_0", "1002")
+    assert api.get_data_version()[1] == version and updated == []
+
+    drop_last_trip(api_stub, "1002")
+    assert api._renew_route("1002_0", "1002")
+    assert [trip.trip_id for trip in api.get_route("1002_0").trips] == ["1002_0_1"]
+    assert api.get_routes_changed_since(version) == ["1002_0"]
+    assert updated == ["1002_0"]
+    assert not api._renew_route("1002_0", "1002")
+
+
+def test_renew_route_retries_failed_write(api_stub, routes_db, monkeypatch):
+    drop_last_trip(api_stub, "1002")
+
+    def fail(*args):
+        raise OSError("disk full")
+    with monkeypatch.context() as m:
+        m.setattr(api, "_index_route", fail)
+        with pytest.raises(OSError):
+            api._renew_route("1002_0", "1002")
+    # the cache has the new response, yet the route was not written
+    assert api._get_cache().get("1002") == api_stub.bodies[route_path("1002")]
+    assert len(api.get_route("1002_0").trips) == 2
+    assert api._renew_route("1002_0", "1002")
+    assert len(api.get_route("1002_0").trips) == 1
+
+
+def test_renew_route_failing_listener(api_stub, routes_db, monkeypatch):
+    updated = []
+
+    def fail(old_route, new_route):
+        raise ValueError("listener error")
+    monkeypatch.setattr(api, "route_update_listeners", [fail, lambda old_route, new_route: updated.append(new_route.id)])
+    drop_last_trip(api_stub, "1002")
+    assert api._renew_route("1002_0", "1002")
+    assert updated == ["1002_0"]
+    assert not api._renew_route("1002_0", "1002")
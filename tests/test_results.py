@@ -0,0 +1,72 @@
+import time
+
+from cmpy import api, results
+
+
+def test_lru_eviction():
+    cache = results.ResultCache(max_entries=2)
+    cache.put("a", 1, {"s1"}, cache.version)
+    cache.put("b", 2, {"s2"}, cache.version)
+    assert cache.get("a") == 1
+    cache.put("c", 3, {"s3"}, cache.version)
+    # b was the least recently used
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats() == {"entries": 2, "bytes": 0, "hits": 3, "misses": 1, "evictions": 1, "version": 0}
+
+
+def test_invalidate_stops():
+    cache = results.ResultCache()
+    cache.put(("Saldanha", "Rossio"), ["trip"], {"060003", "060004", "060006"}, cache.version)
+    cache.put(("Campo Grande", "Entrecampos"), ["trip"], {"060001", "060002"}, cache.version)
+    route = api.Route("1002_0", "1002", "Saldanha - Rossio", "", "", fetch=False)
+    route.add_stop(api.Stop("060006", "Rossio", "", ""))
+    cache.on_route_updated(route, route)
+    assert cache.get(("Saldanha", "Rossio")) is None
+    assert cache.get(("Campo Grande", "Entrecampos")) == ["trip"]
+
+
+def test_results_of_an_older_version_are_dropped():
+    cache = results.ResultCache()
+    version = cache.version
+    # a route is updated while the result is computed
+    cache.invalidate_stops({"060006"})
+    cache.put("a", 1, {"060001"}, version)
+    assert cache.get("a") is None
+    assert cache.get_or_compute("a", {"060001"}, lambda: 2) == 2
+    assert cache.get("a") == 2
+
+
+def test_ttl():
+    cache = results.ResultCache(ttl_seconds=0.05)
+    cache.put("a", 1, set(), cache.version)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_max_bytes():
+    cache = results.ResultCache(max_bytes=1000)
+    cache.put("big", b"x" * 2000, set(), cache.version)
+    assert cache.get("big") is None
+    for i in range(10):
+        cache.put(i, b"x" * 200, set(), cache.version)
+    stats = cache.stats()
+    assert stats["bytes"] <= 1000 and stats["entries"] == 4
+    assert cache.get(9) is not None and cache.get(0) is None
+
+
+def test_timetable_cache(start_server, update_route):
+    server = start_server()
+    client = server.app.test_client()
+    query = "/timetable?origin=060003&destination=060006&date=2023-06-29&raw=1"
+    first = client.get(query).data
+    assert b"08:50:00" in first
+    assert client.get(query).data == first
+    assert {key: value for key, value in client.get("/timetable/cache").json.items() if key in ("entries", "hits", "misses")} == {
+        "entries": 1, "hits": 1, "misses": 1}
+    # an update of a route serving Rossio drops the timetable
+    update_route("1002", lambda detail: detail["directions"][0]["trips"].pop())
+    assert b"08:50:00" not in client.get(query).data
+    assert client.get("/timetable/executor").json["submitted"] == 2
@@ -0,0 +1,64 @@
+from cmpy import api, lib, search
+
+STOPS = [
+    api.Stop("060003", "Saldanha", "38.7350", "-9.1450"),
+    api.Stop("060004", "Saldanha", "38.7352", "-9.1455"),
+    api.Stop("060005", "Marquês de Pombal", "38.7255", "-9.1500"),
+    api.Stop("060017", "Alfragide (Força Aérea)", "38.7646", "-9.2944"),
+    api.Stop("060020", "Av. Força Aérea", "38.7000", "-9.3000"),
+    api.Stop("070001", "Rossio", "38.7139", "-9.1394"),
+]
+
+
+def ids(stops):
+    return [stop.id for stop in stops]
+
+
+def test_normalize():
+    assert search.normalize("Força Aérea") == "forca aerea"
+    assert search.normalize("MARQUÊS") == "marques"
+
+
+def test_get_and_group():
+    index = search.StopIndex(STOPS)
+    assert index.get("060005").name == "Marquês de Pombal"
+    assert index.get("999999") is None
+    assert ids(index.group("Saldanha")) == ["060003", "060004"]
+    assert index.group("Saldanh") == []
+
+
+def test_stops_containing_is_lib_get_stops_containing():
+    index = search.StopIndex(STOPS)
+    for match in ["Saldanha", "Força", "a", "ç", "Pombal", "pombal", "Rossio", "xyz", ""]:
+        assert sorted(ids(index.stops_containing(match))) == sorted(ids(lib.get_stops_containing(match, STOPS))), match
+
+
+def test_search():
+    index = search.StopIndex(STOPS)
+    # accent and case insensitive, names starting with the query first
+    assert ids(index.search("forca")) == ["060017", "060020"]
+    assert ids(index.search("FORÇA AÉREA")) == ["060017", "060020"]
+    assert ids(index.search("s")) == ["060003", "060004", "060005", "070001"]
+    assert ids(index.search("av")) == ["060020"]
+    assert ids(index.search("marques")) == ["060005"]
+    assert ids(index.search("aérea", prefix=True)) == []
+    assert ids(index.search("  saldanha ")) == ["060003", "060004"]
+    # by id prefix, after the names
+    assert ids(index.search("0700")) == ["070001"]
+    assert index.search("") == []
+
+
+def test_search_endpoint(start_server):
+    client = start_server().app.test_client()
+    response = client.get("/stops/search?q=saldanha")
+    assert (response.json["total"], [stop["id"] for stop in response.json["stops"]]) == (2, ["060003", "060004"])
+    response = client.get("/stops/search?q=a&page=1&page_size=2")
+    assert response.json["total"] == 5
+    assert [stop["id"] for stop in response.json["stops"]] == ["060005", "060003"]
+    assert client.get("/stops/search?q=a&page=3&page_size=2").json["stops"] == []
+    assert client.get("/stops/search?q=a&page_size=0").json["page_size"] == 1
+    assert client.get("/stops/search?q=a&page_size=1000").json["page_size"] == 200
+    for query in ["q=a&page=-1", "q=a&page=x", "q=a&page_size=-5", "q=a&page_size=1.5"]:
+        response = client.get("/stops/search?" + query)
+        assert response.status_code == 400, query
+        assert "error" in response.json
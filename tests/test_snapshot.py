@@ -0,0 +1,84 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+from cmpy import api, boards, lib
+
+# cmpy.snapshot is shadowed by its snapshot global, star-exported by cmpy
+snapshot = sys.modules["cmpy.snapshot"]
+
+SALDANHA = ["060003", "060004"]
+QUERIES = [(["060001"], SALDANHA), (SALDANHA, ["060006"]), (["060002"], ["060005", "060006"]), (SALDANHA, ["060001"])]
+DAYS = ["20230629", "20230630", "20230701", "20230702", "20230703", "20230704"]
+
+
+def trips(tripABs):
+    return [(tripAB.origin_stop.id, tripAB.destination_stop.id, tripAB.origin_time, tripAB.destination_time, tripAB.trip.trip_id)
+            for tripAB in tripABs]
+
+
+def sort(tripABs):
+    return sorted(tripABs, key=lambda x: (x.origin_time, x.trip.trip_id, x.destination_stop.id))
+
+
+def test_snapshot_trips(routes_db):
+    snap = snapshot.find_or_build_snapshot()
+    stops = {stop.id: stop for stop in snap.stops()}
+    assert sorted(stops) == ["060001", "060002", "060003", "060004", "060005", "060006"]
+    for origin_ids, destination_ids in QUERIES:
+        origins = [stops[stop_id] for stop_id in origin_ids]
+        destinations = [stops[stop_id] for stop_id in destination_ids]
+        for day in DAYS:
+            assert trips(sort(snap.get_trips(origins, destinations, day))) == trips(sort(lib.get_trips_routes_db(origins, destinations, day)))
+        page, total = snap.get_trips_page(origins, destinations, ("20230629", "20230702"), ("08:00", "09:00"), page=1, page_size=1)
+        expected_page, expected_total = lib.get_trips_page(origins, destinations, ("20230629", "20230702"), ("08:00", "09:00"), page=1, page_size=1)
+        assert total == expected_total
+        assert [(day, trips([tripAB])) for day, tripAB in page] == [(day, trips([tripAB])) for day, tripAB in expected_page]
+    with pytest.raises(ValueError):
+        snap.get_trips_page([stops["060003"]], [stops["060006"]], "20230629", page=-1, page_size=10)
+
+
+def test_snapshot_rebuilt_when_the_routes_change(routes_db, update_route, monkeypatch):
+    # kept mapped, so that a new file can't get the inode of the old one
+    first = snapshot.find_or_build_snapshot()
+    built = os.stat(snapshot.snapshot_file)
+    # a restart with the same routes maps the same snapshot
+    monkeypatch.setattr(snapshot, "snapshot", None)
+    snapshot.find_or_build_snapshot()
+    assert os.stat(snapshot.snapshot_file).st_ino == built.st_ino
+    # routes written by another process (the build or the renewal worker)
+    update_route("1002", lambda detail: detail["directions"][0]["trips"].pop(), notify=False)
+    monkeypatch.setattr(snapshot, "snapshot", None)
+    snap = snapshot.find_or_build_snapshot()
+    assert os.stat(snapshot.snapshot_file).st_ino != built.st_ino
+    assert (snap.database_id, snap.data_version) == api.get_data_version()
+    assert [tripAB.trip.trip_id for tripAB in snap.get_trips(SALDANHA, ["060006"], "20230629")] == ["1002_0_1"]
+    assert len(first.get_trips(SALDANHA, ["060006"], "20230629")) == 2
+
+
+def test_loaded_boards_are_bounded(routes_db, update_route, monkeypatch):
+    boards.find_or_build_departure_boards()
+    monkeypatch.setattr(boards, "max_loaded_boards", 2)
+    for stop_id in ["060001", "060002", "060005"]:
+        assert boards.get_departure_board(stop_id).stop_id == stop_id
+    assert list(boards.departure_boards) == ["060002", "060005"]
+    # the least recently used board goes first
+    boards.get_departure_board("060002")
+    boards.get_departure_board("060003")
+    assert list(boards.departure_boards) == ["060002", "060003"]
+    # a dropped board is read again, with the updates made since
+    update_route("1002", lambda detail: detail["directions"][0]["trips"].pop())
+    assert [departure.trip_id for departure in boards.next_departures(["060005"], datetime.datetime(2023, 6, 29, 8, 0))] == [
+        "1002_0_1", "1003_0_1"]
+    assert len(boards.departure_boards) == 2
+
+
+def test_snapshot_server(start_server):
+    client = start_server(snapshot=True).app.test_client()
+    response = client.get("/trips?origin=060003&destination=060006&date=2023-06-29")
+    assert [(trip["t0"], trip["lineId"]) for trip in response.json["trips"]] == [("08:20:00", "1002"), ("08:50:00", "1002")]
+    response = client.get("/departures?stops=060002&when=2023-06-29T08:10&n=1")
+    assert [departure["t0"] for departure in response.json] == ["08:36:30"]
+    assert client.get("/journey?origin=060001&destination=060006&date=2023-06-29&time=08:00").status_code == 501
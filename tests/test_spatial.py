@@ -0,0 +1,68 @@
+import random
+
+import pytest
+
+from cmpy import api, spatial
+
+
+def random_stops(n, seed=0):
+    rng = random.Random(seed)
+    return [api.Stop(f"{i:06d}", f"Paragem {i}", f"{38.6 + rng.random() * 0.3:.6f}", f"{-9.3 + rng.random() * 0.4:.6f}")
+            for i in range(n)]
+
+
+def brute_force(stops, lat, lon):
+    return sorted((spatial.haversine(lat, lon, float(stop.lat), float(stop.lon)), stop.id) for stop in stops)
+
+
+def test_haversine():
+    assert spatial.haversine(38.7, -9.1, 38.7, -9.1) == 0
+    # a degree of latitude is about 111.2 km
+    assert spatial.haversine(38.0, -9.0, 39.0, -9.0) == pytest.approx(111195, rel=1e-3)
+
+
+@pytest.mark.parametrize("cell_size_m", [250.0, 1000.0])
+def test_nearest_stops(cell_size_m):
+    stops = random_stops(500)
+    grid = spatial.StopGrid(stops, cell_size_m)
+    for lat, lon in [(38.75, -9.1), (38.6, -9.3), (38.95, -8.85), (38.55, -9.35)]:
+        expected = brute_force(stops, lat, lon)
+        for k in (1, 7, 100):
+            nearest = grid.nearest_stops(lat, lon, k)
+            assert [stop.id for stop, _ in nearest] == [stop_id for _, stop_id in expected[:k]]
+            assert [distance for _, distance in nearest] == pytest.approx([distance for distance, _ in expected[:k]])
+    assert grid.nearest_stops(38.75, -9.1, 0) == []
+    # fewer stops than k
+    assert len(spatial.StopGrid(stops[:5], cell_size_m).nearest_stops(38.75, -9.1, 10)) == 5
+
+
+@pytest.mark.parametrize("cell_size_m", [250.0, 1000.0])
+def test_stops_within(cell_size_m):
+    stops = random_stops(500)
+    grid = spatial.StopGrid(stops, cell_size_m)
+    for lat, lon in [(38.75, -9.1), (38.6, -9.3)]:
+        expected = brute_force(stops, lat, lon)
+        for radius in (0, 300, 1500, 10000):
+            assert [stop.id for stop, _ in grid.stops_within(lat, lon, radius)] == [
+                stop_id for distance, stop_id in expected if distance <= radius]
+
+
+def test_stops_without_coordinates():
+    stops = random_stops(10) + [api.Stop("999999", "Sem coordenadas", "", None)]
+    grid = spatial.StopGrid(stops)
+    assert "999999" not in [stop.id for stop, _ in grid.nearest_stops(38.75, -9.1, 20)]
+    assert spatial.StopGrid([]).nearest_stops(38.75, -9.1) == []
+
+
+def test_near_endpoint(start_server):
+    client = start_server().app.test_client()
+    # between the two Saldanha stops
+    response = client.get("/stops/near?lat=38.7351&lon=-9.1452&k=3")
+    assert [stop["id"] for stop in response.json] == ["060003", "060004", "060005"]
+    assert [stop["id"] for stop in client.get("/stops/near?lat=38.7351&lon=-9.1452&radius=100").json] == ["060003", "060004"]
+    assert len(client.get("/stops/near?lat=38.7351&lon=-9.1452&k=1000").json) == 6
+    for query in ["", "lat=38.7", "lat=x&lon=-9.1", "lat=nan&lon=-9.1", "lat=91&lon=-9.1", "lat=38.7&lon=-9.1&k=-1",
+                  "lat=38.7&lon=-9.1&radius=-3"]:
+        response = client.get("/stops/near?" + query)
+        assert response.status_code == 400, query
+        assert "error" in response.json